@@ -16,10 +16,13 @@ def connect(
     api_secret=None,
     app_id=None,
     version="v1.0",
-    timeout=3.0,
+    timeout=None,
     location=None,
     base_url=None,
     use_async=False,
+    connect_timeout=None,
+    read_timeout=None,
+    **client_options,
 ):
     """
     Returns a Client object
@@ -27,10 +30,18 @@ def connect(
     :param api_key: your api key or heroku url
     :param api_secret: the api secret
     :param app_id: the app id (used for listening to feed changes)
+    :param timeout: the total time in seconds a single request may take,
+     defaults to 3 seconds (20 when the LOCAL env variable is set)
     :param use_async: flag to set AsyncClient
+    :param connect_timeout: optional limit for establishing the connection
+    :param read_timeout: optional limit for waiting on the response
+    :param client_options: extra options for the client, i.e. coalesce_reads
     """
     from stream.client import AsyncStreamClient, StreamClient
 
+    if timeout is None:
+        timeout = 20.0 if os.environ.get("LOCAL") else 3.0
+
     if location is None:
         location = os.environ.get("STREAM_REGION")
 
@@ -56,6 +67,9 @@ def connect(
             timeout,
             location=location,
             base_url=base_url,
+            connect_timeout=connect_timeout,
+            read_timeout=read_timeout,
+            **client_options,
         )
 
     return StreamClient(
@@ -66,4 +80,7 @@ def connect(
         timeout,
         location=location,
         base_url=base_url,
+        connect_timeout=connect_timeout,
+        read_timeout=read_timeout,
+        **client_options,
     )
@@ -0,0 +1,379 @@
+import asyncio
+import atexit
+import json
+import threading
+import zlib
+from collections import deque
+
+from stream.bulk import async_call_with_retries, call_with_retries, chunked
+from stream.deadline import detach_deadline
+
+"""
+Buffered sending of analytics events
+
+track_impression and track_engagement queue the event and return at once.
+The events are sent in the background with track_impressions and
+track_engagements requests, when a batch is full or every `interval`
+seconds. The queue is bounded, when it is full events are dropped following
+the drop policy, analytics must never hold back or exhaust the application.
+
+Before they are sent the impressions of a batch are compacted: impressions
+which only differ by their content are merged and their repeated content ids
+are removed, so the analytics see the same content shown to the same users
+with fewer and smaller requests. Engagements are kept as they are, two equal
+engagements can be two real clicks. They are only deduped when the emitter
+is asked to, for applications which know they fire some events twice.
+"""
+
+IMPRESSION = "impression"
+ENGAGEMENT = "engagement"
+
+
+def _event_key(value, exclude=()):
+    if isinstance(value, dict):
+        value = {k: v for k, v in value.items() if k not in exclude}
+    return json.dumps(value, sort_keys=True, default=str)
+
+
+def compact_impressions(impressions):
+    """
+    Merges the impressions with the same user_data, features, feed_id and
+    other fields into one, with the content ids of all of them listed once
+    """
+    merged = {}
+    for impression in impressions:
+        key = _event_key(impression, ("content_list",))
+        entry = merged.get(key)
+        if entry is None:
+            entry = merged[key] = (dict(impression, content_list=[]), set())
+        compacted, seen = entry
+        for content in impression.get("content_list") or []:
+            content_key = _event_key(content)
+            if content_key not in seen:
+                seen.add(content_key)
+                compacted["content_list"].append(content)
+    return [compacted for compacted, _ in merged.values()]
+
+
+def compact_engagements(engagements):
+    """
+    Removes the engagements repeating an engagement with the same fields,
+    such as the events fired twice by a re-render
+    """
+    return list({_event_key(e): e for e in engagements}.values())
+
+
+def in_sample(event, sample_rate):
+    """
+    Returns True when the user of event is part of the sample
+
+    The sample is picked by user, a user is always in or out of it so the
+    sampled users keep all their events.
+    """
+    if sample_rate >= 1:
+        return True
+    user = event.get("user_data")
+    if isinstance(user, dict):
+        user = user.get("id", user)
+    return zlib.crc32(_event_key(user).encode("utf-8")) < sample_rate * 2**32
+
+
+class BaseAnalyticsEmitter:
+    """
+    :param client: the client sending the events
+    :param batch_size: how many events of a kind are sent in one request
+    :param interval: how many seconds an event waits for its batch to fill
+    :param max_queue: how many events are held at most
+    :param drop: "oldest" drops the oldest queued event to make room for a
+     new one, "newest" drops the new event
+    :param retries: how many times a batch failing with a transient error is
+     sent again, the events of a batch which still fails are lost
+    :param compact: merge the impressions queued together with
+     compact_impressions
+    :param sample_rate: the share of the users whose events are kept
+    :param spool: a stream.spool.Spool storing the batches which failed, so
+     they are sent when it is replayed instead of being lost
+    :param dedupe_engagements: remove the repeated engagements queued
+     together with compact_engagements, this changes the engagement counts
+     when equal engagements are real
+    """
+
+    def __init__(
+        self,
+        client,
+        batch_size=100,
+        interval=1.0,
+        max_queue=10000,
+        drop="oldest",
+        retries=2,
+        compact=True,
+        sample_rate=1.0,
+        spool=None,
+        dedupe_engagements=False,
+    ):
+        if drop not in ("oldest", "newest"):
+            raise ValueError("drop must be 'oldest' or 'newest'")
+        if batch_size < 1 or max_queue < 1:
+            raise ValueError("batch_size and max_queue must be at least 1")
+        self.client = client
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_queue = max_queue
+        self.drop = drop
+        self.retries = retries
+        self.compact = compact
+        self.sample_rate = sample_rate
+        self.spool = spool
+        self.dedupe_engagements = dedupe_engagements
+        self.closed = False
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        self.batches = 0
+        self.compacted = 0
+        self.sampled_out = 0
+        self.spooled = 0
+        self._queue = deque()
+
+    def _enqueue(self, kind, events):
+        """
+        Queues the events, returns True when a batch is ready to be sent
+        """
+        if self.closed:
+            raise RuntimeError("the emitter is closed")
+        for event in events:
+            if not in_sample(event, self.sample_rate):
+                self.sampled_out += 1
+                continue
+            if len(self._queue) >= self.max_queue:
+                self.dropped += 1
+                if self.drop == "newest":
+                    continue
+                self._queue.popleft()
+            self._queue.append((kind, event))
+        return len(self._queue) >= self.batch_size
+
+    def _take(self):
+        """
+        Removes the queued events and returns them in batches by kind
+        """
+        events = {IMPRESSION: [], ENGAGEMENT: []}
+        while self._queue:
+            kind, event = self._queue.popleft()
+            events[kind].append(event)
+        compacted = dict(events)
+        if self.compact:
+            compacted[IMPRESSION] = compact_impressions(events[IMPRESSION])
+        if self.dedupe_engagements:
+            compacted[ENGAGEMENT] = compact_engagements(events[ENGAGEMENT])
+        for kind, kind_events in compacted.items():
+            self.compacted += len(events[kind]) - len(kind_events)
+        events = compacted
+        batches = []
+        for kind, kind_events in events.items():
+            for chunk in chunked(kind_events, self.batch_size):
+                batches.append((kind, chunk))
+        return batches
+
+    def _sender(self, kind):
+        if kind == IMPRESSION:
+            return self.client.track_impressions
+        return self.client.track_engagements
+
+    def _record(self, kind, events, exception):
+        self.batches += 1
+        if exception is None:
+            self.sent += len(events)
+        elif self.spool is not None:
+            self.spooled += len(events)
+            self.spool.append(f"track_{kind}s", events)
+        else:
+            self.failed += len(events)
+
+    def stats(self):
+        """
+        Returns the number of queued events and of events sent, dropped
+        because the queue was full, lost because their request failed,
+        merged into other events, left out of the sample and stored in the
+        spool
+        """
+        return {
+            "queued": len(self._queue),
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "batches": self.batches,
+            "compacted": self.compacted,
+            "sampled_out": self.sampled_out,
+            "spooled": self.spooled,
+        }
+
+
+class AnalyticsEmitter(BaseAnalyticsEmitter):
+    """
+    Sends the events from a daemon thread
+
+    The pending events are sent when the emitter is closed, or when the
+    interpreter exits for an emitter which wasn't.
+
+    **Example**::
+
+        emitter = client.analytics_emitter(interval=2)
+        emitter.track_impression(
+            {"content_list": ["1", "2"], "user_data": "tommaso"}
+        )
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        # only one thread sends at a time, so batches keep their order
+        self._send_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def track_impression(self, impression):
+        self.track_impressions([impression])
+
+    def track_impressions(self, impressions):
+        self._track(IMPRESSION, impressions)
+
+    def track_engagement(self, engagement):
+        self.track_engagements([engagement])
+
+    def track_engagements(self, engagements):
+        self._track(ENGAGEMENT, engagements)
+
+    def _track(self, kind, events):
+        with self._lock:
+            if self._enqueue(kind, events):
+                self._wake.notify()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self.closed and len(self._queue) < self.batch_size:
+                    self._wake.wait(self.interval)
+                if self.closed:
+                    return
+            self.flush()
+
+    def flush(self):
+        """
+        Sends the queued events and waits for the requests
+        """
+        with self._send_lock:
+            with self._lock:
+                batches = self._take()
+            for kind, events in batches:
+                send = self._sender(kind)
+                try:
+                    call_with_retries(lambda: send(events), self.retries)
+                except Exception as e:
+                    exception = e
+                else:
+                    exception = None
+                with self._lock:
+                    self._record(kind, events, exception)
+
+    def close(self):
+        """
+        Stops the background thread and sends the queued events
+        """
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            self._wake.notify()
+        atexit.unregister(self.close)
+        self._thread.join()
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class AsyncAnalyticsEmitter(BaseAnalyticsEmitter):
+    """
+    Sends the events from a task of the running event loop, the task starts
+    with the first event
+
+    Close the emitter (or use it as an async context manager) before the
+    loop stops to send the pending events.
+
+    **Example**::
+
+        async with client.analytics_emitter() as emitter:
+            emitter.track_engagement({"content": "1", "label": "click"})
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._task = None
+        self._wake = None
+        self._send_lock = None
+
+    def track_impression(self, impression):
+        self.track_impressions([impression])
+
+    def track_impressions(self, impressions):
+        self._track(IMPRESSION, impressions)
+
+    def track_engagement(self, engagement):
+        self.track_engagements([engagement])
+
+    def track_engagements(self, engagements):
+        self._track(ENGAGEMENT, engagements)
+
+    def _track(self, kind, events):
+        full = self._enqueue(kind, events)
+        if self._task is None:
+            self._wake = asyncio.Event()
+            self._send_lock = asyncio.Lock()
+            self._task = asyncio.ensure_future(self._run())
+        if full:
+            self._wake.set()
+
+    async def _run(self):
+        # the requests outlive the call which started the task
+        detach_deadline()
+        while not self.closed:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    async def flush(self):
+        if self._send_lock is None:
+            return
+        async with self._send_lock:
+            for kind, events in self._take():
+                send = self._sender(kind)
+                try:
+                    await async_call_with_retries(lambda: send(events), self.retries)
+                except Exception as e:
+                    self._record(kind, events, e)
+                else:
+                    self._record(kind, events, None)
+
+    async def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self._task is not None:
+            self._wake.set()
+            await self._task
+        await self.flush()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
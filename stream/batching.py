@@ -0,0 +1,228 @@
+import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+"""
+Batching of single add_activity calls
+
+Activities added to the same feed within a short window are sent together
+with one add_activities request. Every caller gets a future which resolves
+to its own activity from the response, or to the error of the request.
+"""
+
+
+class Batch:
+    def __init__(self, feed):
+        self.feed = feed
+        self.activities = []
+        self.futures = []
+        self.timer = None
+
+
+class BaseActivityBatcher:
+    """
+    :param window: how many seconds the first activity of a batch waits for
+     more activities to the same feed
+    :param max_size: the batch is sent as soon as it holds this many
+     activities, add_activities accepts at most 100
+    """
+
+    def __init__(self, window=0.05, max_size=100):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+        self.window = window
+        self.max_size = max_size
+        self.closed = False
+        self.batches = 0
+        self.activities = 0
+        self._pending = {}
+
+    def _validate(self, activity_data):
+        if activity_data.get("to") and not isinstance(
+            activity_data.get("to"), (list, tuple, set)
+        ):
+            raise TypeError(
+                "please provide the activity's to field as a list not a string"
+            )
+        if self.closed:
+            raise RuntimeError("the batcher is closed")
+
+    def _resolve(self, batch, response):
+        activities = response["activities"]
+        for i, future in enumerate(batch.futures):
+            # a caller may have cancelled its future
+            if future.done():
+                continue
+            if i < len(activities):
+                future.set_result(activities[i])
+            else:
+                future.set_exception(
+                    ValueError("the response is missing activities of the batch")
+                )
+
+    def _fail(self, batch, exception):
+        for future in batch.futures:
+            if not future.done():
+                future.set_exception(exception)
+
+    def stats(self):
+        """
+        Returns the number of requests sent and of activities they carried
+        """
+        return {"batches": self.batches, "activities": self.activities}
+
+
+class ActivityBatcher(BaseActivityBatcher):
+    """
+    Groups the add_activity calls made from any thread
+
+    Batches are sent from a pool of `max_workers` threads, call close (or
+    use the batcher as a context manager) to send what is still pending.
+
+    **Example**::
+
+        with client.activity_batcher(window=0.02) as batcher:
+            futures = [batcher.add_activity(feed, a) for a in activities]
+        ids = [f.result()['id'] for f in futures]
+    """
+
+    def __init__(self, window=0.05, max_size=100, max_workers=4):
+        super().__init__(window, max_size)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers)
+
+    def add_activity(self, feed, activity_data):
+        """
+        Queues activity_data for feed and returns a concurrent.futures.Future
+        """
+        future = Future()
+        with self._lock:
+            self._validate(activity_data)
+            batch = self._pending.get(feed.id)
+            if batch is None:
+                batch = self._pending[feed.id] = Batch(feed)
+                batch.timer = threading.Timer(self.window, self._dispatch, (batch,))
+                batch.timer.daemon = True
+                batch.timer.start()
+            batch.activities.append(activity_data)
+            batch.futures.append(future)
+            full = len(batch.activities) >= self.max_size
+        if full:
+            self._dispatch(batch)
+        return future
+
+    def _dispatch(self, batch):
+        with self._lock:
+            # the timer and a full batch can race, only the first one sends
+            if self._pending.get(batch.feed.id) is not batch:
+                return
+            del self._pending[batch.feed.id]
+            batch.timer.cancel()
+            self.batches += 1
+            self.activities += len(batch.activities)
+            # submitted under the lock, a batch a timer took from the
+            # pending ones is always queued before close shuts the pool down
+            self._executor.submit(self._send, batch)
+
+    def _send(self, batch):
+        try:
+            response = batch.feed.add_activities(batch.activities)
+        except Exception as e:
+            self._fail(batch, e)
+        else:
+            self._resolve(batch, response)
+
+    def flush(self):
+        """
+        Sends all the pending batches without waiting for their window
+        """
+        with self._lock:
+            batches = list(self._pending.values())
+        for batch in batches:
+            self._dispatch(batch)
+
+    def close(self):
+        """
+        Sends the pending batches and waits for all the requests to finish
+        """
+        with self._lock:
+            self.closed = True
+        self.flush()
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class AsyncActivityBatcher(BaseActivityBatcher):
+    """
+    Groups the add_activity calls made from the coroutines of an event loop
+
+    **Example**::
+
+        async with client.activity_batcher(window=0.02) as batcher:
+            activity = await batcher.add_activity(feed, activity_data)
+    """
+
+    def __init__(self, window=0.05, max_size=100):
+        super().__init__(window, max_size)
+        self._tasks = set()
+
+    def add_activity(self, feed, activity_data):
+        """
+        Queues activity_data for feed and returns an awaitable future
+        """
+        self._validate(activity_data)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = self._pending.get(feed.id)
+        if batch is None:
+            batch = self._pending[feed.id] = Batch(feed)
+            batch.timer = loop.call_later(self.window, self._dispatch, batch)
+        batch.activities.append(activity_data)
+        batch.futures.append(future)
+        if len(batch.activities) >= self.max_size:
+            self._dispatch(batch)
+        return future
+
+    def _dispatch(self, batch):
+        if self._pending.get(batch.feed.id) is not batch:
+            return
+        del self._pending[batch.feed.id]
+        batch.timer.cancel()
+        self.batches += 1
+        self.activities += len(batch.activities)
+        task = asyncio.ensure_future(self._send(batch))
+        # the loop only keeps weak references to its tasks
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch):
+        try:
+            response = await batch.feed.add_activities(batch.activities)
+        except Exception as e:
+            self._fail(batch, e)
+        else:
+            self._resolve(batch, response)
+
+    async def flush(self):
+        """
+        Sends all the pending batches and waits for their requests
+        """
+        for batch in list(self._pending.values()):
+            self._dispatch(batch)
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def close(self):
+        self.closed = True
+        await self.flush()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
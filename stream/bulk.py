@@ -0,0 +1,380 @@
+import asyncio
+import contextvars
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+import aiohttp
+import requests
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+from stream import serializer
+from stream.deadline import remaining_time
+from stream.exceptions import DeadlineExceeded, StreamApiException
+
+"""
+Helpers for the bulk operations
+
+Large inputs are split into chunks which fit in one request, the chunks
+are sent concurrently with a bounded number in flight and the ones failing
+with a transient error are retried. Results are produced in input order.
+"""
+
+# the budget of a comma separated query param, it leaves room for the rest
+# of the url under the 8KB limit common to servers and proxies
+MAX_QUERY_BYTES = 4000
+
+
+def json_size(item):
+    # the item and the comma separating it from the previous one
+    return len(serializer.dumps(item).encode("utf-8")) + 1
+
+
+def query_size(value):
+    # the quoted value and the quoted comma separating it from the previous one
+    return len(quote(str(value), safe="")) + 3
+
+
+def chunked(items, size, max_bytes=None, overhead=0, measure=json_size):
+    """
+    Lazily splits items in lists of at most `size` items
+
+    :param items: any iterable
+    :param size: the maximum number of items in a chunk, None for no limit
+    :param max_bytes: the maximum serialized size of a chunk, an item larger
+     than that still gets a chunk of its own
+    :param overhead: the bytes of the request which are not items
+    :param measure: returns the bytes an item adds to the request, json_size
+     for request bodies and query_size for comma separated query params
+    """
+    chunk = []
+    chunk_bytes = overhead
+    for item in items:
+        item_bytes = 0
+        if max_bytes is not None:
+            item_bytes = measure(item)
+        if chunk and (
+            (size is not None and len(chunk) >= size)
+            or (max_bytes is not None and chunk_bytes + item_bytes > max_bytes)
+        ):
+            yield chunk
+            chunk = []
+            chunk_bytes = overhead
+        chunk.append(item)
+        chunk_bytes += item_bytes
+    if chunk:
+        yield chunk
+
+
+def chunked_unique(items, size, key):
+    """
+    Lazily splits items in lists of at most `size` items, an item with the
+    same key as an item of the current chunk starts a new chunk
+    """
+    chunk = []
+    keys = set()
+    for item in items:
+        item_key = key(item)
+        if len(chunk) >= size or item_key in keys:
+            yield chunk
+            chunk = []
+            keys = set()
+        chunk.append(item)
+        keys.add(item_key)
+    if chunk:
+        yield chunk
+
+
+def merge_outcomes(outcomes, get_items):
+    """
+    Returns the response of the first chunk and the items of all the chunks
+    in input order, raises the exception of the first chunk which failed
+    """
+    merged = None
+    items = []
+    for _, response, exception in outcomes:
+        if exception is not None:
+            raise exception
+        if merged is None:
+            merged = response
+        items.extend(get_items(response))
+    return merged, items
+
+
+def is_transient(exception):
+    """
+    Returns True for the errors which can go away by trying again
+    """
+    if isinstance(exception, DeadlineExceeded):
+        return False
+    if isinstance(exception, StreamApiException):
+        status_code = getattr(exception, "status_code", None)
+        return status_code is not None and (status_code == 429 or status_code >= 500)
+    return isinstance(
+        exception,
+        (
+            requests.ConnectionError,
+            requests.Timeout,
+            aiohttp.ClientConnectionError,
+            asyncio.TimeoutError,
+        ),
+    )
+
+
+# raised by aiohttp >= 3.10 when the connection can't be established in time
+_AIOHTTP_CONNECT_ERRORS = (aiohttp.ClientConnectorError,) + tuple(
+    e for e in (getattr(aiohttp, "ConnectionTimeoutError", None),) if e is not None
+)
+
+
+def is_unsent(exception):
+    """
+    Returns True for the errors showing the API never got the request, the
+    only ones after which a write which isn't idempotent can be sent again
+
+    A timeout while waiting for the response or a server error leaves the
+    request applied or not, sending it again could apply it twice.
+    """
+    if isinstance(exception, StreamApiException):
+        # rate limited requests are refused before they are processed
+        return getattr(exception, "status_code", None) == 429
+    if isinstance(exception, (requests.ConnectTimeout,) + _AIOHTTP_CONNECT_ERRORS):
+        return True
+    if isinstance(exception, requests.ConnectionError) and exception.args:
+        reason = getattr(exception.args[0], "reason", None)
+        return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+    return False
+
+
+def _backoff(attempt, backoff):
+    """
+    Returns the delay before the next attempt or None when the current
+    deadline doesn't leave time for it
+    """
+    delay = backoff * 2**attempt
+    budget = remaining_time()
+    if budget is not None and budget <= delay:
+        return None
+    return delay
+
+
+def call_with_retries(fn, retries=2, backoff=0.1, idempotent=True):
+    """
+    Calls fn and calls it again up to `retries` times after transient errors
+
+    :param idempotent: False for the writes which can't be applied twice
+     safely, they are only called again when the request wasn't sent
+    """
+    retryable = is_transient if idempotent else is_unsent
+    attempt = 0
+    while True:
+        try:
+            return fn()
+        except Exception as e:
+            if attempt >= retries or not retryable(e):
+                raise
+            delay = _backoff(attempt, backoff)
+            if delay is None:
+                raise
+            time.sleep(delay)
+            attempt += 1
+
+
+async def async_call_with_retries(fn, retries=2, backoff=0.1, idempotent=True):
+    retryable = is_transient if idempotent else is_unsent
+    attempt = 0
+    while True:
+        try:
+            return await fn()
+        except Exception as e:
+            if attempt >= retries or not retryable(e):
+                raise
+            delay = _backoff(attempt, backoff)
+            if delay is None:
+                raise
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+def _outcome(item, future):
+    try:
+        return item, future.result(), None
+    except Exception as e:
+        return item, None, e
+
+
+def map_concurrently(fn, items, concurrency=4, keys=None):
+    """
+    Calls fn on every item from a pool of threads and yields the
+    (item, result, exception) tuples in input order
+
+    Items are consumed lazily and at most `concurrency` calls are pending,
+    so a slow consumer holds back the producer. The calls run in a copy of
+    the caller's context and share its deadline.
+
+    :param keys: returns the set of keys of an item, an item sharing a key
+     with a pending item waits for it to complete before it is sent
+    """
+    with ThreadPoolExecutor(concurrency) as executor:
+        pending = deque()
+        for item in items:
+            item_keys = set() if keys is None else keys(item)
+            while pending and (
+                len(pending) >= concurrency or any(item_keys & k for _, _, k in pending)
+            ):
+                head, future, _ = pending.popleft()
+                yield _outcome(head, future)
+            context = contextvars.copy_context()
+            future = executor.submit(context.run, fn, item)
+            pending.append((item, future, item_keys))
+        while pending:
+            head, future, _ = pending.popleft()
+            yield _outcome(head, future)
+
+
+async def async_map_concurrently(fn, items, concurrency=4, keys=None):
+    """
+    Awaits fn on every item with at most `concurrency` calls in flight and
+    yields the (item, result, exception) tuples in input order
+    """
+    pending = deque()
+    try:
+        for item in items:
+            item_keys = set() if keys is None else keys(item)
+            while pending and (
+                len(pending) >= concurrency or any(item_keys & k for _, _, k in pending)
+            ):
+                head, task, _ = pending.popleft()
+                await asyncio.wait([task])
+                yield _outcome(head, task)
+            pending.append((item, asyncio.ensure_future(fn(item)), item_keys))
+        while pending:
+            head, task, _ = pending.popleft()
+            await asyncio.wait([task])
+            yield _outcome(head, task)
+    finally:
+        # the consumer stopped early
+        for _, task, _ in pending:
+            task.cancel()
+
+
+def _is_rejection(exception):
+    """
+    Returns True when the API refused the content of a request
+    """
+    return isinstance(exception, StreamApiException) and getattr(
+        exception, "status_code", None
+    ) in (400, 404)
+
+
+def isolate_failures(fn, items):
+    """
+    Calls fn(items) and returns the (item, exception) failures
+
+    A chunk rejected by the API is split in halves which are sent again,
+    so the items causing the rejection are singled out and the others go
+    through. Other errors fail the whole chunk.
+    """
+    try:
+        fn(items)
+    except Exception as e:
+        if len(items) == 1 or not _is_rejection(e):
+            return [(item, e) for item in items]
+        middle = len(items) // 2
+        return isolate_failures(fn, items[:middle]) + isolate_failures(
+            fn, items[middle:]
+        )
+    return []
+
+
+async def async_isolate_failures(fn, items):
+    try:
+        await fn(items)
+    except Exception as e:
+        if len(items) == 1 or not _is_rejection(e):
+            return [(item, e) for item in items]
+        middle = len(items) // 2
+        failures = await async_isolate_failures(fn, items[:middle])
+        return failures + await async_isolate_failures(fn, items[middle:])
+    return []
+
+
+class Checkpoint:
+    """
+    Progress of a bulk operation stored in a json file
+
+    :param path: the file, it is created on the first save
+
+    The offset is the number of input items which were processed, failed
+    items included. Passing the same checkpoint to a new call with the same
+    input skips them, so an interrupted operation resumes where it stopped.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        if os.path.exists(path):
+            with open(path) as f:
+                self.offset = json.load(f)["offset"]
+
+    def save(self, offset):
+        self.offset = offset
+        # written next to the file and renamed, a crash never leaves half
+        # of a checkpoint behind
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"offset": offset}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+
+class BulkReport:
+    """
+    Collects the outcomes of the chunks of a bulk operation in input order
+    and advances its checkpoint
+    """
+
+    def __init__(self, checkpoint=None):
+        self.started = time.monotonic()
+        self.checkpoint = checkpoint
+        self.offset = 0 if checkpoint is None else checkpoint.offset
+        self.chunks = 0
+        self.processed = 0
+        self.failed = []
+        self.exceptions = []
+
+    def add(self, chunk, failures, exception=None):
+        if exception is not None:
+            failures = [(item, exception) for item in chunk]
+        self.chunks += 1
+        self.processed += len(chunk)
+        self.offset += len(chunk)
+        for item, e in failures:
+            self.failed.append(item)
+            self.exceptions.append(e)
+        if self.checkpoint is not None:
+            self.checkpoint.save(self.offset)
+
+    def stats(self):
+        """
+        Returns the progress so far and the throughput in items per second
+        """
+        seconds = time.monotonic() - self.started
+        return {
+            "chunks": self.chunks,
+            "processed": self.processed,
+            "failed": len(self.failed),
+            "seconds": seconds,
+            "per_second": self.processed / seconds if seconds else 0.0,
+        }
+
+    def result(self, failed_key):
+        result = self.stats()
+        del result["failed"]
+        result[failed_key] = self.failed
+        result["exceptions"] = self.exceptions
+        return result
@@ -0,0 +1,8 @@
+from .base import AbstractCache, ReadThroughCache
+from .entities import EntityCache
+from .feeds import FeedCache
+from .memory import MemoryCache
+from .og import OgCache
+from .resp import RESPCache, RESPError
+from .shared import SharedMemoryCache
+from .sqlite import SQLiteCache
@@ -0,0 +1,291 @@
+import asyncio
+import math
+import random
+import threading
+import time
+from abc import ABC, abstractmethod
+
+from stream.deadline import detach_deadline
+
+# the states of a cached value, see ReadThroughCache._unwrap
+FRESH = "fresh"
+EARLY = "early"
+STALE = "stale"
+MISS = "miss"
+
+
+class AbstractCache(ABC):
+    """
+    The interface cache backends implement
+
+    Keys are strings, values are the parsed API responses. A cache miss is
+    reported by returning None, so None itself can't be stored.
+
+    get_many and set_many fall back to one call per key, backends which can
+    do better in a single round trip override them.
+    """
+
+    @abstractmethod
+    def get(self, key):
+        """
+        Returns the value stored for key or None
+        """
+        pass
+
+    @abstractmethod
+    def set(self, key, value, ttl=None):
+        """
+        Stores value for key, ttl is the time to live in seconds
+        """
+        pass
+
+    @abstractmethod
+    def delete(self, key):
+        """
+        Removes key from the cache
+        """
+        pass
+
+    @abstractmethod
+    def clear(self):
+        """
+        Removes all the keys from the cache
+        """
+        pass
+
+    def get_many(self, keys):
+        """
+        Returns a dict with the values found for the given keys
+        """
+        result = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                result[key] = value
+        return result
+
+    def set_many(self, mapping, ttl=None):
+        """
+        Stores all the key, value pairs of mapping with the same ttl
+        """
+        for key, value in mapping.items():
+            self.set(key, value, ttl=ttl)
+
+
+class ReadThroughCache:
+    """
+    Serves reads from a cache backend and loads the missing values
+
+    :param backend: the cache backend
+    :param ttl: how many seconds a loaded value is served from the cache
+    :param stale_ttl: how many seconds past its ttl a value is still served
+     while a single background refresh replaces it, 0 disables it
+    :param beta: how eagerly values are refreshed ahead of their expiration,
+     0 disables it
+
+    The cache never fails the calls it serves: a backend which raises, eg.
+    a cache server which can't be reached, counts as a miss on reads and
+    writes to it are skipped, the values are loaded from the API instead.
+
+    Every value is stored with the time it took to load it. A read close to
+    the expiration of a value reloads it with a probability growing as the
+    expiration gets nearer and the load gets slower (XFetch), so a hot entry
+    is usually refreshed by a single reader before it expires instead of by
+    all of them at once after.
+    """
+
+    def __init__(self, backend, ttl, stale_ttl=0, beta=1.0):
+        self.backend = backend
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.beta = beta
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.early_refreshes = 0
+        self.errors = 0
+        self._refreshing = set()
+        self._tasks = set()
+        self._lock = threading.Lock()
+
+    def _backend_call(self, method, *args, default=None, **kwargs):
+        """
+        Calls a method of the backend, returns default when it fails
+        """
+        try:
+            return getattr(self.backend, method)(*args, **kwargs)
+        except Exception:
+            self.errors += 1
+            return default
+
+    def _wrap(self, value, delta, ttl):
+        return {"value": value, "delta": delta, "expires_at": time.time() + ttl}
+
+    def _unwrap(self, entry):
+        """
+        Returns the value of a stored entry and whether it is FRESH, EARLY,
+        STALE or MISS
+        """
+        if entry is None:
+            return None, MISS
+        now = time.time()
+        if now >= entry["expires_at"]:
+            if self.stale_ttl:
+                return entry["value"], STALE
+            return None, MISS
+        # XFetch: log(random) is negative, 1 - random() avoids log(0)
+        gap = entry["delta"] * self.beta * math.log(1.0 - random.random())
+        if now - gap >= entry["expires_at"]:
+            return entry["value"], EARLY
+        return entry["value"], FRESH
+
+    def get(self, key):
+        value, state = self._unwrap(self._backend_call("get", key))
+        if state is MISS:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value, delta=0.0, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        self._backend_call(
+            "set", key, self._wrap(value, delta, ttl), ttl=ttl + self.stale_ttl
+        )
+
+    def delete(self, key):
+        self._backend_call("delete", key)
+
+    def load_failed(self, key, exception):
+        """
+        Called when the loader raised, subclasses can cache the failure
+        """
+        pass
+
+    def served(self, key, value):
+        """
+        Called with every value returned from the cache, subclasses can
+        raise for the failures they cached
+        """
+        return value
+
+    def _claim(self, keys):
+        with self._lock:
+            keys = [k for k in keys if k not in self._refreshing]
+            self._refreshing.update(keys)
+        return keys
+
+    def _release(self, keys):
+        with self._lock:
+            self._refreshing.difference_update(keys)
+
+    def refresh(self, keys, refresh):
+        """
+        Calls refresh(keys) in a background thread with the keys which
+        aren't already being refreshed
+        """
+        keys = self._claim(keys)
+        if not keys:
+            return
+
+        def run():
+            # the refresh outlives the read which started it
+            detach_deadline()
+            try:
+                refresh(keys)
+            except Exception:
+                # the stale values are served until the next attempt
+                pass
+            finally:
+                self._release(keys)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def async_refresh(self, keys, refresh):
+        """
+        Awaits refresh(keys) in a background task with the keys which
+        aren't already being refreshed
+        """
+        keys = self._claim(keys)
+        if not keys:
+            return
+
+        async def run():
+            detach_deadline()
+            try:
+                await refresh(keys)
+            except Exception:
+                pass
+            finally:
+                self._release(keys)
+
+        task = asyncio.ensure_future(run())
+        # the loop only keeps weak references to its tasks
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _load(self, key, loader):
+        started = time.monotonic()
+        try:
+            value = loader()
+        except Exception as e:
+            self.load_failed(key, e)
+            raise
+        self.set(key, value, delta=time.monotonic() - started)
+        return value
+
+    async def _async_load(self, key, loader):
+        started = time.monotonic()
+        try:
+            value = await loader()
+        except Exception as e:
+            self.load_failed(key, e)
+            raise
+        self.set(key, value, delta=time.monotonic() - started)
+        return value
+
+    def _lookup(self, key):
+        """
+        Returns the cached value for key and whether it has to be loaded
+        """
+        value, state = self._unwrap(self._backend_call("get", key))
+        if state is FRESH:
+            self.hits += 1
+        elif state is STALE:
+            self.stale_hits += 1
+        elif state is EARLY:
+            self.early_refreshes += 1
+        else:
+            self.misses += 1
+        return value, state
+
+    def fetch(self, key, loader):
+        """
+        Returns the cached value for key or calls loader and caches its result
+        """
+        value, state = self._lookup(key)
+        if state is STALE:
+            self.refresh([key], lambda keys: self._load(key, loader))
+        elif state is not FRESH:
+            return self._load(key, loader)
+        return self.served(key, value)
+
+    async def async_fetch(self, key, loader):
+        value, state = self._lookup(key)
+        if state is STALE:
+            self.async_refresh([key], lambda keys: self._async_load(key, loader))
+        elif state is not FRESH:
+            return await self._async_load(key, loader)
+        return self.served(key, value)
+
+    def stats(self):
+        hits = self.hits + self.stale_hits
+        total = hits + self.misses + self.early_refreshes
+        return {
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "early_refreshes": self.early_refreshes,
+            "misses": self.misses,
+            "errors": self.errors,
+            "hit_ratio": hits / total if total else 0.0,
+        }
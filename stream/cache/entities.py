@@ -0,0 +1,106 @@
+from stream.cache.base import EARLY, MISS, STALE, ReadThroughCache
+from stream.cache.memory import MemoryCache
+from stream.exceptions import DoesNotExistException
+
+
+class EntityCache(ReadThroughCache):
+    """
+    Cache for collection entries and users
+
+    :param backend: the cache backend, an in-memory LRU cache by default
+    :param ttl: how many seconds an entity is served from the cache
+    :param missing_ttl: how many seconds a DoesNotExistException is remembered
+    :param stale_ttl: how many seconds past its ttl an entity is still served
+     while it is refreshed in the background
+    :param beta: how eagerly entities are refreshed ahead of their expiration
+
+    Entities are refreshed with the responses of add and update calls and
+    evicted by upsert and delete calls made through the same client.
+
+    **Example**::
+
+        client = stream.connect(key, secret, entity_cache=EntityCache(ttl=60))
+    """
+
+    MISSING = {"__stream_missing__": True}
+
+    def __init__(self, backend=None, ttl=60, missing_ttl=5, stale_ttl=0, beta=1.0):
+        if backend is None:
+            backend = MemoryCache(max_size=4096)
+        super().__init__(backend, ttl, stale_ttl=stale_ttl, beta=beta)
+        self.missing_ttl = missing_ttl
+        self.missing_hits = 0
+
+    def collection_key(self, collection_name, id):
+        return f"collection:{collection_name}:{id}"
+
+    def user_key(self, user_id):
+        return f"user:{user_id}"
+
+    def served(self, key, value):
+        if value == self.MISSING:
+            self.missing_hits += 1
+            raise DoesNotExistException(f"{key} does not exist", status_code=404)
+        return value
+
+    def get(self, key):
+        """
+        Returns the cached entity or None, raises DoesNotExistException when
+        the entity is known not to exist
+        """
+        value = super().get(key)
+        if value is None:
+            return None
+        return self.served(key, value)
+
+    def get_many(self, keys):
+        """
+        Returns the cached entities by key, the keys known not to exist and
+        the keys of the stale entities which should be refreshed
+
+        Entities picked for an early refresh are left out, so they are
+        fetched along with the missing ones.
+        """
+        values = self._backend_call("get_many", keys, default={})
+        found = {}
+        missing = set()
+        stale = []
+        for key in keys:
+            value, state = self._unwrap(values.get(key))
+            if state is MISS:
+                self.misses += 1
+                continue
+            if state is EARLY:
+                self.early_refreshes += 1
+                continue
+            if state is STALE:
+                self.stale_hits += 1
+                stale.append(key)
+            else:
+                self.hits += 1
+            if value == self.MISSING:
+                self.missing_hits += 1
+                missing.add(key)
+            else:
+                found[key] = value
+        return found, missing, stale
+
+    def set_many(self, mapping, delta=0.0):
+        self._backend_call(
+            "set_many",
+            {k: self._wrap(v, delta, self.ttl) for k, v in mapping.items()},
+            ttl=self.ttl + self.stale_ttl,
+        )
+
+    def set_missing(self, key):
+        self.set(key, self.MISSING, ttl=self.missing_ttl)
+
+    def load_failed(self, key, exception):
+        if isinstance(exception, DoesNotExistException):
+            self.set_missing(key)
+
+    def stats(self):
+        # missing_hits are the hits on entities known not to exist
+        stats = super().stats()
+        stats["missing_hits"] = self.missing_hits
+        return stats
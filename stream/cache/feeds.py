@@ -0,0 +1,64 @@
+from urllib.parse import urlencode
+from uuid import uuid4
+
+from stream.cache.base import ReadThroughCache
+from stream.cache.memory import MemoryCache
+
+
+class FeedCache(ReadThroughCache):
+    """
+    Read-through cache for Feed.get and AsyncFeed.get
+
+    :param backend: the cache backend, an in-memory LRU cache by default
+    :param ttl: how many seconds a feed page is served from the cache
+    :param stale_ttl: how many seconds past its ttl a feed page is still served
+     while it is refreshed in the background
+    :param beta: how eagerly entries are refreshed ahead of their expiration
+
+    Entries are keyed on the feed id, the endpoint and the normalized
+    params. Every feed has a version which is part of the key, writing to
+    the feed through the same client replaces the version so all the
+    cached pages of that feed become unreachable at once.
+
+    Writes performed by other clients or fan-out to the followers of a feed
+    are not seen by the cache, the ttl bounds how stale those reads can be.
+
+    **Example**::
+
+        client = stream.connect(key, secret, feed_cache=FeedCache(ttl=5))
+    """
+
+    # reads with side effects are never cached
+    UNCACHEABLE_PARAMS = ("mark_read", "mark_seen")
+
+    def __init__(self, backend=None, ttl=5, stale_ttl=0, beta=1.0):
+        if backend is None:
+            backend = MemoryCache(max_size=1024)
+        super().__init__(backend, ttl, stale_ttl=stale_ttl, beta=beta)
+
+    def get_key(self, feed_id, url, params):
+        """
+        Returns the cache key for a read or None if the read can't be cached
+        """
+        if any(params.get(p) for p in self.UNCACHEABLE_PARAMS):
+            return None
+        query = urlencode(sorted((k, str(v)) for k, v in params.items()))
+        return f"feed:{feed_id}:{self._get_version(feed_id)}:{url}?{query}"
+
+    def invalidate(self, feed_id):
+        """
+        Drops all the cached reads of the given feed
+        """
+        self._backend_call("set", self._version_key(feed_id), uuid4().hex)
+
+    def _version_key(self, feed_id):
+        return f"feed_version:{feed_id}"
+
+    def _get_version(self, feed_id):
+        version = self._backend_call("get", self._version_key(feed_id))
+        if version is None:
+            # a fresh version, never the same as one that was evicted, so
+            # older entries can't become reachable again
+            version = uuid4().hex
+            self._backend_call("set", self._version_key(feed_id), version)
+        return version
@@ -0,0 +1,68 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from stream.cache.base import AbstractCache
+
+
+class MemoryCache(AbstractCache):
+    """
+    In-process cache with TTL expiration and LRU eviction
+
+    :param max_size: the maximum number of keys to keep
+    :param ttl: the default time to live in seconds, None means no expiration
+
+    Values are copied when they are stored and returned so callers can
+    modify responses without changing the cached data.
+    """
+
+    def __init__(self, max_size=1024, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        now = time.monotonic()
+        result = {}
+        with self._lock:
+            for key in keys:
+                entry = self._data.get(key)
+                if entry is None:
+                    continue
+                expires_at, value = entry
+                if expires_at is not None and expires_at <= now:
+                    del self._data[key]
+                    continue
+                self._data.move_to_end(key)
+                result[key] = value
+        return copy.deepcopy(result)
+
+    def set(self, key, value, ttl=None):
+        self.set_many({key: value}, ttl=ttl)
+
+    def set_many(self, mapping, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = None if ttl is None else time.monotonic() + ttl
+        mapping = copy.deepcopy(mapping)
+        with self._lock:
+            for key, value in mapping.items():
+                self._data[key] = (expires_at, value)
+                self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
@@ -0,0 +1,32 @@
+from stream.cache.base import ReadThroughCache
+from stream.cache.memory import MemoryCache
+from stream.utils import normalize_url
+
+
+class OgCache(ReadThroughCache):
+    """
+    Cache for the Open Graph scrapes returned by client.og
+
+    :param backend: the cache backend, use a SQLiteCache to share the
+     results between worker processes and across restarts
+    :param ttl: how many seconds a scrape is served from the cache
+    :param stale_ttl: how many seconds past its ttl a scrape is still served
+     while it is refreshed in the background
+    :param beta: how eagerly entries are refreshed ahead of their expiration
+
+    Urls are normalized before they are used as keys so equivalent urls
+    share one entry.
+
+    **Example**::
+
+        og_cache = OgCache(SQLiteCache("/var/cache/stream/og.sqlite"))
+        client = stream.connect(key, secret, og_cache=og_cache)
+    """
+
+    def __init__(self, backend=None, ttl=24 * 60 * 60, stale_ttl=0, beta=1.0):
+        if backend is None:
+            backend = MemoryCache(max_size=1024)
+        super().__init__(backend, ttl, stale_ttl=stale_ttl, beta=beta)
+
+    def get_key(self, target_url):
+        return f"og:{normalize_url(target_url)}"
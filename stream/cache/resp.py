@@ -0,0 +1,156 @@
+import os
+import socket
+import threading
+
+from stream import serializer
+from stream.cache.base import AbstractCache
+
+
+class RESPError(Exception):
+    """
+    Raised when the server replies to a command with an error
+    """
+
+    pass
+
+
+class RESPCache(AbstractCache):
+    """
+    Cache stored in a Redis compatible server
+
+    :param host: the server host
+    :param port: the server port
+    :param db: the database number to select
+    :param prefix: prepended to every key, clear only removes prefixed keys
+    :param ttl: the default time to live in seconds, None means no expiration
+    :param timeout: the socket timeout in seconds
+
+    Speaks RESP, the Redis protocol, over a plain socket so no client
+    library is needed. Every thread and every forked process opens its own
+    connection, the commands of get_many and set_many are sent in one
+    round trip.
+    """
+
+    def __init__(
+        self, host="localhost", port=6379, db=0, prefix="stream:", ttl=None, timeout=1.0
+    ):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.prefix = prefix
+        self.ttl = ttl
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._local.socket = sock
+        self._local.reader = sock.makefile("rb")
+        self._local.pid = os.getpid()
+        if self.db:
+            self.execute(["SELECT", self.db])
+
+    def close(self):
+        """
+        Closes the connection of the calling thread
+        """
+        if getattr(self._local, "pid", None) == os.getpid():
+            self._local.reader.close()
+            self._local.socket.close()
+        self._local.pid = None
+
+    def _encode(self, command):
+        parts = [f"*{len(command)}\r\n".encode()]
+        for arg in command:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode("utf-8")
+            parts.append(f"${len(arg)}\r\n".encode() + arg + b"\r\n")
+        return b"".join(parts)
+
+    def _read_reply(self):
+        line = self._local.reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("connection closed by the server")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload.decode("utf-8")
+        if kind == b"-":
+            return RESPError(payload.decode("utf-8"))
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            length = int(payload)
+            if length == -1:
+                return None
+            data = self._local.reader.read(length + 2)
+            return data[:-2]
+        if kind == b"*":
+            length = int(payload)
+            if length == -1:
+                return None
+            return [self._read_reply() for _ in range(length)]
+        raise RESPError(f"unknown reply {line!r}")
+
+    def pipeline(self, commands):
+        """
+        Sends all the commands at once and returns their replies
+        """
+        if getattr(self._local, "pid", None) != os.getpid():
+            self._connect()
+        try:
+            self._local.socket.sendall(b"".join(self._encode(c) for c in commands))
+            replies = [self._read_reply() for _ in commands]
+        except (OSError, ValueError):
+            # the state of the connection is unknown, start over next time
+            self.close()
+            raise
+        for reply in replies:
+            if isinstance(reply, RESPError):
+                raise reply
+        return replies
+
+    def execute(self, command):
+        return self.pipeline([command])[0]
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+        values = self.execute(["MGET"] + [self.prefix + k for k in keys])
+        return {
+            key: serializer.loads(value)
+            for key, value in zip(keys, values)
+            if value is not None
+        }
+
+    def set(self, key, value, ttl=None):
+        self.set_many({key: value}, ttl=ttl)
+
+    def set_many(self, mapping, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        commands = []
+        for key, value in mapping.items():
+            command = ["SET", self.prefix + key, serializer.dumps(value)]
+            if ttl is not None:
+                command += ["PX", max(int(ttl * 1000), 1)]
+            commands.append(command)
+        if commands:
+            self.pipeline(commands)
+
+    def delete(self, key):
+        self.execute(["DEL", self.prefix + key])
+
+    def clear(self):
+        cursor = "0"
+        while True:
+            cursor, keys = self.execute(
+                ["SCAN", cursor, "MATCH", self.prefix + "*", "COUNT", 1000]
+            )
+            cursor = cursor.decode("utf-8")
+            if keys:
+                self.execute(["DEL"] + keys)
+            if cursor == "0":
+                break
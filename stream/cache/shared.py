@@ -0,0 +1,147 @@
+import hashlib
+import mmap
+import multiprocessing
+import struct
+import time
+
+from stream import serializer
+from stream.cache.base import AbstractCache
+
+# key hash, expires at, accessed at, key length, value length
+SLOT_HEADER = struct.Struct("<QddHI")
+
+
+class SharedMemoryCache(AbstractCache):
+    """
+    Cache shared between the processes forked from the one creating it
+
+    :param slots: the number of entries the cache can hold
+    :param slot_size: the size in bytes of a slot, larger values are not cached
+    :param ttl: the default time to live in seconds, None means no expiration
+    :param probes: how many neighbouring slots a key can be stored in
+
+    The entries live in an anonymous shared memory mapping, create the cache
+    before the workers are forked (ie. with gunicorn's preload_app) and every
+    worker reads and writes the same slots. A key is stored in one of the
+    `probes` slots following its hash, when they are all taken the least
+    recently used one is replaced.
+    """
+
+    def __init__(self, slots=4096, slot_size=4096, ttl=None, probes=8):
+        self.slots = slots
+        self.slot_size = slot_size
+        self.ttl = ttl
+        self.probes = min(probes, slots)
+        self._memory = mmap.mmap(-1, slots * slot_size)
+        self._lock = multiprocessing.Lock()
+
+    def _hash(self, key):
+        digest = hashlib.blake2b(key, digest_size=8).digest()
+        # 0 marks an empty slot
+        return int.from_bytes(digest, "little") or 1
+
+    def _probe(self, key_hash):
+        start = key_hash % self.slots
+        for i in range(self.probes):
+            yield ((start + i) % self.slots) * self.slot_size
+
+    def _find(self, key, key_hash):
+        for offset in self._probe(key_hash):
+            slot_hash, _, _, key_length, _ = SLOT_HEADER.unpack_from(
+                self._memory, offset
+            )
+            if slot_hash != key_hash:
+                continue
+            start = offset + SLOT_HEADER.size
+            end = start + key_length
+            if self._memory[start:end] == key:
+                return offset
+        return None
+
+    def _read(self, key, now):
+        key_hash = self._hash(key)
+        offset = self._find(key, key_hash)
+        if offset is None:
+            return None
+        _, expires_at, _, key_length, value_length = SLOT_HEADER.unpack_from(
+            self._memory, offset
+        )
+        if expires_at and expires_at <= now:
+            return None
+        SLOT_HEADER.pack_into(
+            self._memory, offset, key_hash, expires_at, now, key_length, value_length
+        )
+        start = offset + SLOT_HEADER.size + key_length
+        end = start + value_length
+        return self._memory[start:end]
+
+    def _write(self, key, value, expires_at, now):
+        key_hash = self._hash(key)
+        offset = self._find(key, key_hash)
+        if offset is None:
+            # an empty or expired slot, otherwise the least recently used one
+            candidates = []
+            for candidate in self._probe(key_hash):
+                header = SLOT_HEADER.unpack_from(self._memory, candidate)
+                slot_hash, slot_expires_at, accessed_at = header[:3]
+                if not slot_hash or (slot_expires_at and slot_expires_at <= now):
+                    accessed_at = -1
+                candidates.append((accessed_at, candidate))
+            offset = min(candidates)[1]
+        SLOT_HEADER.pack_into(
+            self._memory,
+            offset,
+            key_hash,
+            expires_at or 0,
+            now,
+            len(key),
+            len(value),
+        )
+        start = offset + SLOT_HEADER.size
+        end = start + len(key) + len(value)
+        self._memory[start:end] = key + value
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        now = time.time()
+        found = {}
+        with self._lock:
+            for key in keys:
+                value = self._read(key.encode("utf-8"), now)
+                if value is not None:
+                    found[key] = value
+        return {k: serializer.loads(v) for k, v in found.items()}
+
+    def set(self, key, value, ttl=None):
+        self.set_many({key: value}, ttl=ttl)
+
+    def set_many(self, mapping, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        now = time.time()
+        expires_at = None if ttl is None else now + ttl
+        entries = []
+        for key, value in mapping.items():
+            key = key.encode("utf-8")
+            value = serializer.dumps(value).encode("utf-8")
+            if SLOT_HEADER.size + len(key) + len(value) <= self.slot_size:
+                entries.append((key, value))
+            else:
+                # too large for a slot, drop a previous version of the key
+                self.delete(key.decode("utf-8"))
+        with self._lock:
+            for key, value in entries:
+                self._write(key, value, expires_at, now)
+
+    def delete(self, key):
+        key = key.encode("utf-8")
+        with self._lock:
+            offset = self._find(key, self._hash(key))
+            if offset is not None:
+                SLOT_HEADER.pack_into(self._memory, offset, 0, 0, 0, 0, 0)
+
+    def clear(self):
+        with self._lock:
+            for offset in range(0, self.slots * self.slot_size, self.slot_size):
+                SLOT_HEADER.pack_into(self._memory, offset, 0, 0, 0, 0, 0)
@@ -0,0 +1,176 @@
+import os
+import sqlite3
+import threading
+import time
+
+from stream import serializer
+from stream.cache.base import AbstractCache
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    expires_at REAL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at);
+"""
+
+
+class SQLiteCache(AbstractCache):
+    """
+    Persistent cache stored in a sqlite database
+
+    :param path: the path of the database file
+    :param max_bytes: the maximum size of the stored values, the least
+     recently used entries are evicted first
+    :param ttl: the default time to live in seconds, None means no expiration
+    :param timeout: how long a write waits for a lock held by another process
+    :param touch_interval: how many seconds pass before a read records again
+     that an entry was used
+
+    The database runs in WAL mode so many worker processes can read and
+    write the same file at the same time, every thread and every forked
+    process opens its own connection.
+
+    The cache never fails the calls it serves: a read which finds the
+    database locked is a miss and a write which can't get the lock in time
+    is skipped. Recording the use of an entry for the eviction never waits
+    for the lock.
+    """
+
+    def __init__(
+        self,
+        path,
+        max_bytes=64 * 1024 * 1024,
+        ttl=None,
+        timeout=5.0,
+        touch_interval=60.0,
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.timeout = timeout
+        self.touch_interval = touch_interval
+        self._local = threading.local()
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self):
+        # sqlite connections can't be shared between threads or across fork
+        if getattr(self._local, "pid", None) != os.getpid():
+            connection = sqlite3.connect(
+                self.path, timeout=self.timeout, isolation_level=None
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return self._local.connection
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+        connection = self._connection()
+        now = time.time()
+        placeholders = ",".join("?" * len(keys))
+        try:
+            rows = connection.execute(
+                f"SELECT key, value, expires_at, accessed_at FROM cache "
+                f"WHERE key IN ({placeholders})",
+                keys,
+            ).fetchall()
+        except sqlite3.OperationalError:
+            # the caller fetches the values instead
+            return {}
+        result = {}
+        touched = []
+        for key, value, expires_at, accessed_at in rows:
+            if expires_at is None or expires_at > now:
+                result[key] = serializer.loads(value)
+                if now - accessed_at >= self.touch_interval:
+                    touched.append((now, key))
+        if touched:
+            self._touch(connection, touched)
+        return result
+
+    def _touch(self, connection, rows):
+        # the access time only guides the eviction, a read never waits for
+        # the write lock to update it
+        connection.execute("PRAGMA busy_timeout = 0")
+        try:
+            connection.executemany(
+                "UPDATE cache SET accessed_at = ? WHERE key = ?", rows
+            )
+        except sqlite3.OperationalError:
+            pass
+        finally:
+            connection.execute(f"PRAGMA busy_timeout = {int(self.timeout * 1000)}")
+
+    def set(self, key, value, ttl=None):
+        self.set_many({key: value}, ttl=ttl)
+
+    def set_many(self, mapping, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        now = time.time()
+        expires_at = None if ttl is None else now + ttl
+        rows = []
+        for key, value in mapping.items():
+            value = serializer.dumps(value)
+            rows.append((key, value, len(value), expires_at, now))
+        connection = self._connection()
+        # BEGIN IMMEDIATE takes the write lock up front, so concurrent
+        # writers wait for each other instead of failing to upgrade
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+        except sqlite3.OperationalError:
+            # still locked after timeout seconds, the values aren't cached
+            return
+        try:
+            connection.executemany(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)", rows
+            )
+            self._evict(connection, now)
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def _evict(self, connection, now):
+        (total,) = connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM cache"
+        ).fetchone()
+        if total <= self.max_bytes:
+            return
+        connection.execute("DELETE FROM cache WHERE expires_at <= ?", (now,))
+        # keep the most recently used entries which fit in max_bytes
+        connection.execute(
+            """
+            DELETE FROM cache WHERE key IN (
+                SELECT key FROM (
+                    SELECT key, SUM(size) OVER (
+                        ORDER BY accessed_at DESC, key
+                    ) AS running_size FROM cache
+                ) WHERE running_size > ?
+            )
+            """,
+            (self.max_bytes,),
+        )
+
+    def delete(self, key):
+        self._connection().execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def clear(self):
+        self._connection().execute("DELETE FROM cache")
+
+    def close(self):
+        """
+        Closes the connection of the calling thread
+        """
+        if getattr(self._local, "pid", None) == os.getpid():
+            self._local.connection.close()
+            del self._local.pid
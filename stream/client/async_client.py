@@ -1,25 +1,40 @@
+import contextlib
+import contextvars
 import logging
 
 import aiohttp
 from aiohttp import ClientConnectionError
 
 from stream import serializer
+from stream.analytics import AsyncAnalyticsEmitter
+from stream.batching import AsyncActivityBatcher
+from stream.bulk import (
+    BulkReport,
+    async_call_with_retries,
+    async_isolate_failures,
+    async_map_concurrently,
+    chunked_unique,
+    merge_outcomes,
+)
 from stream.client.base import BaseStreamClient
 from stream.collections import AsyncCollections
 from stream.feed.feeds import AsyncFeed
+from stream.loader import loop_loader
 from stream.personalization import AsyncPersonalization
 from stream.reactions import AsyncReactions
-from stream.serializer import _datetime_encoder
+from stream.singleflight import AsyncSingleFlight
+from stream.spool import AsyncSpool
 from stream.users import AsyncUsers
 from stream.utils import (
     get_reaction_params,
     validate_feed_slug,
-    validate_foreign_id_time,
     validate_user_id,
 )
 
 logger = logging.getLogger(__name__)
 
+_shared_session = contextvars.ContextVar("stream_session", default=None)
+
 
 class AsyncStreamClient(BaseStreamClient):
     def __init__(
@@ -28,9 +43,16 @@ class AsyncStreamClient(BaseStreamClient):
         api_secret,
         app_id,
         version="v1.0",
-        timeout=6.0,
+        timeout=None,
         base_url=None,
         location=None,
+        connect_timeout=None,
+        read_timeout=None,
+        coalesce_reads=False,
+        feed_cache=None,
+        entity_cache=None,
+        og_cache=None,
+        token_cache=None,
     ):
         super().__init__(
             api_key,
@@ -40,7 +62,16 @@ class AsyncStreamClient(BaseStreamClient):
             timeout=timeout,
             base_url=base_url,
             location=location,
+            connect_timeout=connect_timeout,
+            read_timeout=read_timeout,
+            coalesce_reads=coalesce_reads,
+            feed_cache=feed_cache,
+            entity_cache=entity_cache,
+            og_cache=og_cache,
+            token_cache=token_cache,
         )
+        self.single_flight = AsyncSingleFlight() if coalesce_reads else None
+
         token = self.create_jwt_token("collections", "*", feed_id="*", user_id="*")
         self.collections = AsyncCollections(self, token)
 
@@ -71,10 +102,28 @@ class AsyncStreamClient(BaseStreamClient):
     async def delete(self, *args, **kwargs):
         return await self._make_request("DELETE", *args, **kwargs)
 
-    async def add_to_many(self, activity, feeds):
-        data = {"activity": activity, "feeds": feeds}
+    async def add_to_many(
+        self,
+        activity,
+        feeds,
+        chunk_size=1000,
+        max_bytes=512 * 1024,
+        concurrency=4,
+        retries=2,
+    ):
         token = self.create_jwt_token("feed", "*", feed_id="*")
-        return await self.post("feed/add_to_many/", token, data=data)
+
+        async def send(chunk):
+            data = {"activity": activity, "feeds": chunk}
+            return await async_call_with_retries(
+                lambda: self.post("feed/add_to_many/", token, data=data),
+                retries,
+                idempotent=False,
+            )
+
+        chunks = self._add_to_many_chunks(activity, feeds, chunk_size, max_bytes)
+        outcomes = [o async for o in async_map_concurrently(send, chunks, concurrency)]
+        return self._bulk_result(outcomes, "failed_feeds")
 
     async def follow_many(self, follows, activity_copy_limit=None):
         params = None
@@ -90,6 +139,51 @@ class AsyncStreamClient(BaseStreamClient):
         token = self.create_jwt_token("follower", "*", feed_id="*")
         return await self.post("unfollow_many/", token, params=params, data=unfollows)
 
+    async def bulk_follow(
+        self,
+        edges,
+        activity_copy_limit=None,
+        checkpoint=None,
+        chunk_size=2500,
+        concurrency=4,
+        retries=2,
+    ):
+        async def send(chunk):
+            return await async_call_with_retries(
+                lambda: self.follow_many(chunk, activity_copy_limit), retries
+            )
+
+        report, chunks = self._bulk_edges(edges, checkpoint, chunk_size)
+        await self._run_bulk(send, chunks, report, concurrency)
+        return report.result("failed_edges")
+
+    async def bulk_unfollow(
+        self, edges, checkpoint=None, chunk_size=2500, concurrency=4, retries=2
+    ):
+        async def send(chunk):
+            return await async_call_with_retries(
+                lambda: self.unfollow_many(chunk), retries
+            )
+
+        report, chunks = self._bulk_edges(edges, checkpoint, chunk_size)
+        await self._run_bulk(send, chunks, report, concurrency)
+        return report.result("failed_edges")
+
+    async def _run_bulk(
+        self, send, chunks, report, concurrency, keys=None, on_progress=None
+    ):
+        outcomes = async_map_concurrently(
+            lambda chunk: async_isolate_failures(send, chunk),
+            chunks,
+            concurrency,
+            keys,
+        )
+        async for chunk, failures, exception in outcomes:
+            report.add(chunk, failures, exception)
+            if on_progress is not None:
+                on_progress(report.stats())
+        return report
+
     async def update_activities(self, activities):
         if not isinstance(activities, (list, tuple, set)):
             raise TypeError("Activities parameter should be of type list")
@@ -98,6 +192,28 @@ class AsyncStreamClient(BaseStreamClient):
         data = dict(activities=activities)
         return await self.post("activities/", auth_token, data=data)
 
+    async def update_activities_stream(
+        self, activities, chunk_size=100, concurrency=4, retries=2, on_progress=None
+    ):
+        auth_token = self.create_jwt_token("activities", "*", feed_id="*")
+
+        async def send(chunk):
+            data = dict(activities=chunk)
+            return await async_call_with_retries(
+                lambda: self.post("activities/", auth_token, data=data), retries
+            )
+
+        report = BulkReport()
+        await self._run_bulk(
+            send,
+            chunked_unique(activities, chunk_size, self._update_key),
+            report,
+            concurrency,
+            self._update_keys,
+            on_progress,
+        )
+        return report.result("failed_activities")
+
     async def update_activity(self, activity):
         return await self.update_activities([activity])
 
@@ -121,20 +237,25 @@ class AsyncStreamClient(BaseStreamClient):
             endpoint = "enrich/" + endpoint
 
         query_params = {**params}
+        query_params.update(get_reaction_params(reactions))
+        queries = self._activities_queries(ids, foreign_id_times, query_params)
+        if len(queries) == 1:
+            return await self.get(endpoint, auth_token, params=queries[0])
 
-        if ids is not None:
-            query_params["ids"] = ",".join(ids)
+        async def send(query):
+            return await self.get(endpoint, auth_token, params=query)
 
-        if foreign_id_times is not None:
-            validate_foreign_id_time(foreign_id_times)
-            foreign_ids, timestamps = zip(*foreign_id_times)
-            timestamps = map(_datetime_encoder, timestamps)
-            query_params["foreign_ids"] = ",".join(foreign_ids)
-            query_params["timestamps"] = ",".join(timestamps)
+        outcomes = [o async for o in async_map_concurrently(send, queries)]
+        response, results = merge_outcomes(outcomes, lambda r: r["results"])
+        return dict(response, results=results)
 
-        query_params.update(get_reaction_params(reactions))
+    def activity_loader(self, **params):
+        async def fetch(ids):
+            response = await self.get_activities(ids=ids, **params)
+            return {a["id"]: a for a in response["results"]}
 
-        return await self.get(endpoint, auth_token, params=query_params)
+        key = ("activities", id(self), serializer.dumps(params, sort_keys=True))
+        return loop_loader(key, fetch)
 
     async def activity_partial_update(
         self, id=None, foreign_id=None, time=None, set=None, unset=None
@@ -165,6 +286,42 @@ class AsyncStreamClient(BaseStreamClient):
 
         return await self.post("activity/", auth_token, data=data)
 
+    async def activities_partial_update_stream(
+        self, updates, chunk_size=100, concurrency=4, retries=2, on_progress=None
+    ):
+        auth_token = self.create_jwt_token("activities", "*", feed_id="*")
+
+        async def send(chunk):
+            data = {"changes": chunk}
+            return await async_call_with_retries(
+                lambda: self.post("activity/", auth_token, data=data), retries
+            )
+
+        report = BulkReport()
+        await self._run_bulk(
+            send,
+            chunked_unique(updates, chunk_size, self._update_key),
+            report,
+            concurrency,
+            self._update_keys,
+            on_progress,
+        )
+        return report.result("failed_updates")
+
+    async def update_activities_diff(
+        self, changes, chunk_size=100, concurrency=4, retries=2, on_progress=None
+    ):
+        unchanged = {"count": 0}
+        result = await self.activities_partial_update_stream(
+            self._diff_updates(changes, unchanged),
+            chunk_size,
+            concurrency,
+            retries,
+            on_progress,
+        )
+        result["unchanged"] = unchanged["count"]
+        return result
+
     async def track_engagements(self, engagements):
         auth_token = self.create_jwt_token("*", "*", feed_id="*")
         await self.post(
@@ -183,7 +340,91 @@ class AsyncStreamClient(BaseStreamClient):
     async def og(self, target_url):
         auth_token = self.create_jwt_token("*", "*", feed_id="*")
         params = {"url": target_url}
-        return await self.get("og/", auth_token, params=params)
+        if self.og_cache is None:
+            return await self.get("og/", auth_token, params=params)
+        return await self.og_cache.async_fetch(
+            self.og_cache.get_key(target_url),
+            lambda: self.get("og/", auth_token, params=params),
+        )
+
+    def activity_batcher(self, window=0.05, max_size=100):
+        return AsyncActivityBatcher(window, max_size)
+
+    def analytics_emitter(
+        self,
+        batch_size=100,
+        interval=1.0,
+        max_queue=10000,
+        drop="oldest",
+        retries=2,
+        compact=True,
+        sample_rate=1.0,
+        spool=None,
+        dedupe_engagements=False,
+    ):
+        return AsyncAnalyticsEmitter(
+            self,
+            batch_size,
+            interval,
+            max_queue,
+            drop,
+            retries,
+            compact,
+            sample_rate,
+            spool,
+            dedupe_engagements,
+        )
+
+    def spool(self, directory, **options):
+        return AsyncSpool(self, directory, **options)
+
+    async def get_feeds(self, feeds, concurrency=10, timeout=None):
+        reads = self._feed_reads(feeds)
+
+        def read(entry):
+            _, feed, params = entry
+            return feed.get(**params)
+
+        async with self.shared_session():
+            with self._feeds_deadline(timeout):
+                outcomes = [
+                    outcome
+                    async for outcome in async_map_concurrently(
+                        read, reads, concurrency
+                    )
+                ]
+        return self._feeds_result(outcomes)
+
+    async def merged_timeline(
+        self, feeds, max_count=None, page_size=25, concurrency=10
+    ):
+        merge = self._timeline_merge(feeds, max_count, page_size)
+
+        async def fetch(cursor):
+            response = await cursor.feed.get(**cursor.page_params())
+            return response["results"]
+
+        async with self.shared_session():
+            async for cursor, page, exception in async_map_concurrently(
+                fetch, merge.cursors, concurrency
+            ):
+                if exception is not None:
+                    raise exception
+                cursor.add_page(page)
+        for index in range(len(merge.cursors)):
+            merge.push(index)
+        while True:
+            activity, index = merge.pop()
+            if activity is None:
+                return
+            if merge.is_new(activity):
+                yield activity
+                if merge.full():
+                    return
+            cursor = merge.cursors[index]
+            if cursor.needs_page:
+                cursor.add_page(await fetch(cursor))
+            merge.push(index)
 
     async def follow_stats(self, feed_id, followers_slugs=None, following_slugs=None):
         auth_token = self.create_jwt_token("*", "*", feed_id="*")
@@ -205,6 +446,28 @@ class AsyncStreamClient(BaseStreamClient):
 
         return await self.get("stats/follow/", auth_token, params=params)
 
+    @contextlib.asynccontextmanager
+    async def shared_session(self):
+        """
+        Sends the requests made in the block, and in the tasks it starts,
+        over one aiohttp session so their connections are reused
+
+        **Example**::
+
+            async with client.shared_session():
+                await asyncio.gather(*[client.users.get(id) for id in ids])
+        """
+        session = _shared_session.get()
+        if session is not None and not session.closed:
+            yield
+            return
+        async with aiohttp.ClientSession() as session:
+            token = _shared_session.set(session)
+            try:
+                yield
+            finally:
+                _shared_session.reset(token)
+
     async def _make_request(
         self,
         method,
@@ -213,6 +476,7 @@ class AsyncStreamClient(BaseStreamClient):
         service_name="api",
         params=None,
         data=None,
+        timeout=None,
     ):
         params = params or {}
         data = data or {}
@@ -232,14 +496,18 @@ class AsyncStreamClient(BaseStreamClient):
         if method.lower() in ["post", "put", "delete"]:
             serialized = serializer.dumps(data)
 
-        async with aiohttp.ClientSession() as session:
+        async def request(session):
+            total, connect_timeout, read_timeout = self.get_timeouts(timeout)
+            client_timeout = aiohttp.ClientTimeout(
+                total=total, connect=connect_timeout, sock_read=read_timeout
+            )
             async with session.request(
                 method,
                 url,
                 data=serialized,
                 headers=headers,
                 params=default_params,
-                timeout=self.timeout,
+                timeout=client_timeout,
             ) as response:
                 # remove JWT from logs
                 headers_to_log = headers.copy()
@@ -249,6 +517,18 @@ class AsyncStreamClient(BaseStreamClient):
                 )
                 return await self._parse_response(response)
 
+        async def send():
+            session = _shared_session.get()
+            if session is not None and not session.closed:
+                return await request(session)
+            async with aiohttp.ClientSession() as session:
+                return await request(session)
+
+        if self.single_flight is not None and method == "GET":
+            key = self.get_request_key(url, signature, default_params)
+            return await self.single_flight.do(key, send)
+        return await send()
+
     async def _parse_response(self, response):
         try:
             parsed_result = serializer.loads(await response.text())
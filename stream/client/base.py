@@ -1,10 +1,18 @@
+import contextlib
+import itertools
 import json
 import os
 from abc import ABC, abstractmethod
 
 import requests
 
-from stream import exceptions
+from stream import exceptions, serializer
+from stream.bulk import MAX_QUERY_BYTES, BulkReport, Checkpoint, chunked, query_size
+from stream.cache import MemoryCache
+from stream.deadline import deadline, remaining_time
+from stream.serializer import _datetime_encoder
+from stream.timeline import TimelineMerge
+from stream.utils import activity_diff, validate_feed_id, validate_foreign_id_time
 
 try:
     from urllib.parse import urlparse
@@ -25,6 +33,13 @@ class AbstractStreamClient(ABC):
         """
         pass
 
+    @abstractmethod
+    def get_request_key(self, url, signature, params):
+        """
+        Returns the key identifying a request for coalescing identical reads
+        """
+        pass
+
     @abstractmethod
     def get_default_params(self):
         """
@@ -98,13 +113,39 @@ class AbstractStreamClient(ABC):
         pass
 
     @abstractmethod
-    def add_to_many(self, activity, feeds):
+    def add_to_many(
+        self,
+        activity,
+        feeds,
+        chunk_size=1000,
+        max_bytes=512 * 1024,
+        concurrency=4,
+        retries=2,
+    ):
         """
         Adds an activity to many feeds
 
         :param activity: the activity data
         :param feeds: the list of follows (eg. ['feed:1', 'feed:2'])
+        :param chunk_size: the maximum number of feeds sent in one request
+        :param max_bytes: the maximum size of the body of one request
+        :param concurrency: how many requests are sent at the same time
+        :param retries: how many times a chunk is sent again when it
+         couldn't reach the API (connection errors and rate limits), never
+         after a timeout or a server error which could have added it already
+
+        Activities without foreign_id and time can't be told apart by the
+        API, when a chunk may have been added the feeds are reported as
+        failed rather than sent twice.
+
+        Returns the number of chunks sent, the feeds of the chunks which
+        failed and their exceptions. When every chunk failed the first
+        exception is raised instead.
 
+        **Example**::
+
+            result = client.add_to_many(activity, feeds)
+            retry_later(result['failed_feeds'])
         """
         pass
 
@@ -129,6 +170,48 @@ class AbstractStreamClient(ABC):
         """
         pass
 
+    @abstractmethod
+    def bulk_follow(
+        self,
+        edges,
+        activity_copy_limit=None,
+        checkpoint=None,
+        chunk_size=2500,
+        concurrency=4,
+        retries=2,
+    ):
+        """
+        Creates any number of follows with follow_many requests
+
+        :param edges: an iterable of follow relations, consumed lazily
+        :param activity_copy_limit: how many activities are copied per follow
+        :param checkpoint: a stream.bulk.Checkpoint or the path of its file,
+         a call with the same edges resumes after the edges it recorded
+        :param chunk_size: how many edges are sent in one request
+        :param concurrency: how many requests are sent at the same time
+        :param retries: how many times a chunk failing with a transient
+         error is sent again
+
+        Chunks rejected by the API are split until the edges causing the
+        rejection are found. Returns the number of chunks and edges
+        processed, the failed edges and their exceptions.
+
+        eg. client.bulk_follow(
+            {'source': f'timeline:{u}', 'target': f'user:{t}'} for u, t in rows
+        )
+        """
+        pass
+
+    @abstractmethod
+    def bulk_unfollow(
+        self, edges, checkpoint=None, chunk_size=2500, concurrency=4, retries=2
+    ):
+        """
+        Removes any number of follows with unfollow_many requests, the
+        parameters and the result are the ones of bulk_follow
+        """
+        pass
+
     @abstractmethod
     def update_activities(self, activities):
         """
@@ -136,6 +219,33 @@ class AbstractStreamClient(ABC):
         """
         pass
 
+    @abstractmethod
+    def update_activities_stream(
+        self, activities, chunk_size=100, concurrency=4, retries=2, on_progress=None
+    ):
+        """
+        Updates any number of activities with update_activities requests
+
+        :param activities: an iterable of activities, consumed lazily
+        :param chunk_size: how many activities are sent in one request
+        :param concurrency: how many requests are sent at the same time
+        :param retries: how many times a chunk failing with a transient
+         error is sent again
+        :param on_progress: called with the progress and the throughput
+         after every chunk
+
+        Updates of the same activity are applied in input order, a chunk
+        waits for the requests in flight which update one of its
+        activities. Returns the progress, the failed activities and their
+        exceptions.
+
+        **Example**::
+
+            result = client.update_activities_stream(rescored(), concurrency=8)
+            print(result['per_second'], len(result['failed_activities']))
+        """
+        pass
+
     @abstractmethod
     def update_activity(self, activity):
         """
@@ -157,6 +267,27 @@ class AbstractStreamClient(ABC):
         """
         pass
 
+    @abstractmethod
+    def activity_loader(self, **params):
+        """
+        Returns the loader batching the lookups of single activities by id
+
+        :param params: the params of the get_activities requests, eg. enrich
+
+        The lookups made in the same context (sync) or in the same event loop
+        iteration (async) are sent together, see stream.loader.
+
+        Sync loaders send the pending ids when a result is asked for or a
+        callback is added, call dispatch() on the loader before waiting for
+        the futures with concurrent.futures.wait or as_completed.
+
+        **Example**::
+
+            future = client.activity_loader().load(activity_id)
+            activity = future.result()  # async: await loader.load(activity_id)
+        """
+        pass
+
     @abstractmethod
     def activity_partial_update(
         self, id=None, foreign_id=None, time=None, set=None, unset=None
@@ -196,6 +327,39 @@ class AbstractStreamClient(ABC):
         """
         pass
 
+    @abstractmethod
+    def activities_partial_update_stream(
+        self, updates, chunk_size=100, concurrency=4, retries=2, on_progress=None
+    ):
+        """
+        Applies any number of partial updates with activities_partial_update
+        requests, the parameters and the result are the ones of
+        update_activities_stream
+        """
+        pass
+
+    @abstractmethod
+    def update_activities_diff(
+        self, changes, chunk_size=100, concurrency=4, retries=2, on_progress=None
+    ):
+        """
+        Applies the differences between old and new versions of activities
+        as partial updates
+
+        :param changes: an iterable of (old activity, new activity) pairs
+
+        Only the changed fields are sent, as dotted set and unset paths, and
+        pairs without changes are skipped. The updates are batched with
+        activities_partial_update_stream, which takes the other parameters.
+        Returns its result with the number of unchanged pairs.
+
+        **Example**::
+
+            new = dict(old, counts=dict(old['counts'], likes=42))
+            client.update_activities_diff([(old, new)])
+        """
+        pass
+
     @abstractmethod
     def create_redirect_url(self, target_url, user_id, events):
         """
@@ -276,6 +440,133 @@ class AbstractStreamClient(ABC):
         """
         pass
 
+    @abstractmethod
+    def activity_batcher(self, window=0.05, max_size=100):
+        """
+        Returns a batcher which groups the add_activity calls made to the
+        same feed within `window` seconds into add_activities requests
+
+        :param window: how long a batch waits for more activities
+        :param max_size: how many activities a batch holds at most
+
+        **Example**::
+
+            batcher = client.activity_batcher(window=0.02)
+            future = batcher.add_activity(feed, activity_data)
+            activity_id = future.result()['id']
+        """
+        pass
+
+    @abstractmethod
+    def analytics_emitter(
+        self,
+        batch_size=100,
+        interval=1.0,
+        max_queue=10000,
+        drop="oldest",
+        retries=2,
+        compact=True,
+        sample_rate=1.0,
+        spool=None,
+        dedupe_engagements=False,
+    ):
+        """
+        Returns an emitter which queues impressions and engagements and
+        sends them in the background with track_impressions and
+        track_engagements requests
+
+        :param batch_size: how many events of a kind are sent in one request
+        :param interval: how many seconds an event waits for its batch to fill
+        :param max_queue: how many events are queued at most
+        :param drop: which events are dropped when the queue is full,
+         "oldest" or "newest"
+        :param retries: how many times a failed batch is sent again
+        :param compact: merge the impressions of a batch which only differ by
+         their content and remove their repeated content ids
+        :param sample_rate: the share of the users whose events are sent
+        :param spool: a spool storing the batches which failed
+        :param dedupe_engagements: remove the engagements of a batch which
+         repeat an engagement with the same fields
+
+        **Example**::
+
+            emitter = client.analytics_emitter()
+            emitter.track_engagement({"content": "1", "label": "click"})
+            emitter.stats()['queued']
+        """
+        pass
+
+    @abstractmethod
+    def spool(self, directory, **options):
+        """
+        Returns a spool which stores analytics events and write operations
+        in `directory` and sends them when it is replayed, the options are
+        the ones of stream.spool.BaseSpool
+
+        Operations are appended to segment files, so they survive a crash
+        of the process or an outage of the API.
+
+        **Example**::
+
+            spool = client.spool('/var/spool/stream', fsync='always')
+            spool.replay()
+            spool.add_activities('user:1', [activity_data])
+            spool.start(interval=5)
+        """
+        pass
+
+    @abstractmethod
+    def get_feeds(self, feeds, concurrency=10, timeout=None):
+        """
+        Reads many feeds at the same time
+
+        :param feeds: an iterable of feed ids or of (feed id, params) tuples,
+         the params are the ones of Feed.get
+        :param concurrency: how many feeds are read at the same time, the
+         connection pool of the sync client keeps 10 connections
+        :param timeout: the seconds all the reads share, the reads still
+         pending when they are spent fail with a timeout error
+
+        Returns the responses by feed id and the exceptions of the feeds
+        which couldn't be read by feed id, a failed feed doesn't fail the
+        others.
+
+        **Example**::
+
+            response = client.get_feeds(
+                [('user:1', {'limit': 5}), ('timeline:1', {'enrich': True})],
+                timeout=0.5,
+            )
+            activities = response['results']['user:1']['results']
+        """
+        pass
+
+    @abstractmethod
+    def merged_timeline(self, feeds, max_count=None, page_size=25, concurrency=10):
+        """
+        Iterates over the activities of many feeds merged into one timeline,
+        from the newest to the oldest
+
+        :param feeds: an iterable of feed ids or of (feed id, params) tuples,
+         the params are the ones of Feed.get
+        :param max_count: how many activities are iterated over at most
+        :param page_size: how many activities of a feed are fetched in one
+         request
+        :param concurrency: how many first pages are fetched at the same time
+
+        The first page of every feed is fetched up front, a feed is paged
+        further only when the timeline reaches its last fetched activity.
+        An activity found in many feeds is only given once.
+
+        **Example**::
+
+            for activity in client.merged_timeline(
+                ['user:1', 'user:2', ('user:3', {'enrich': True})], max_count=20
+            ):
+                print(activity['id'])
+        """
+        pass
+
     @abstractmethod
     def follow_stats(self, feed_id, followers_slugs=None, following_slugs=None):
         """
@@ -300,6 +591,7 @@ class AbstractStreamClient(ABC):
         service_name="api",
         params=None,
         data=None,
+        timeout=None,
     ):
         pass
 
@@ -315,6 +607,19 @@ class BaseStreamClient(AbstractStreamClient, ABC):
     :param api_key: the api key
     :param api_secret: the api secret
     :param app_id: the app id
+    :param timeout: the total time in seconds a single request may take,
+     defaults to 6 seconds (20 when the LOCAL env variable is set)
+    :param connect_timeout: optional limit for establishing the connection
+    :param read_timeout: optional limit for waiting on the response
+    :param coalesce_reads: share one request between identical GET calls
+     which are in flight at the same time
+    :param feed_cache: a stream.cache.FeedCache used by Feed.get
+    :param entity_cache: a stream.cache.EntityCache for collections and users
+    :param og_cache: a stream.cache.OgCache used by og
+    :param token_cache: the cache backend for the JWT tokens the client
+     signs, an in-memory LRU cache by default. The tokens grant server side
+     access to the whole app and never expire, keep them in process memory
+     rather than in a cache shared over the network
 
     **Example usage**::
 
@@ -340,15 +645,29 @@ class BaseStreamClient(AbstractStreamClient, ABC):
         api_secret,
         app_id,
         version="v1.0",
-        timeout=6.0,
+        timeout=None,
         base_url=None,
         location=None,
+        connect_timeout=None,
+        read_timeout=None,
+        coalesce_reads=False,
+        feed_cache=None,
+        entity_cache=None,
+        og_cache=None,
+        token_cache=None,
     ):
         self.api_key = api_key
         self.api_secret = api_secret
         self.app_id = app_id
         self.version = version
         self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.coalesce_reads = coalesce_reads
+        self.feed_cache = feed_cache
+        self.entity_cache = entity_cache
+        self.og_cache = og_cache
+        self.token_cache = MemoryCache(1024) if token_cache is None else token_cache
         self.location = location
         self.base_domain_name = "stream-io-api.com"
         self.api_location = location
@@ -359,7 +678,6 @@ class BaseStreamClient(AbstractStreamClient, ABC):
             self.base_domain_name = "localhost"
             self.protocol = "http"
             self.custom_api_port = 8000
-            self.timeout = 20
         elif base_url is not None:
             parsed_url = urlparse(base_url)
             self.base_domain_name = parsed_url.hostname
@@ -369,8 +687,35 @@ class BaseStreamClient(AbstractStreamClient, ABC):
         elif location is not None:
             self.location = location
 
+        if self.timeout is None:
+            self.timeout = 20.0 if os.environ.get("LOCAL") else 6.0
+
         self.base_analytics_url = "https://analytics.stream-io-api.com/analytics/"
 
+    def deadline(self, seconds):
+        """
+        Returns a context manager which limits all the requests made inside
+        of it to a shared time budget, see stream.deadline.deadline
+        """
+        return deadline(seconds)
+
+    def get_timeouts(self, timeout=None):
+        """
+        Returns the (total, connect, read) timeouts for the next request
+
+        :param timeout: optional per call override of the total timeout
+
+        The total is capped by the time left in the current deadline, the
+        connect and read timeouts are capped by the total.
+        """
+        total = self.timeout if timeout is None else timeout
+        budget = remaining_time()
+        if budget is not None:
+            total = min(total, budget)
+        connect = total if self.connect_timeout is None else self.connect_timeout
+        read = total if self.read_timeout is None else self.read_timeout
+        return total, min(connect, total), min(read, total)
+
     def create_user_token(self, user_id, **extra_data):
         payload = {"user_id": user_id}
         for k, v in extra_data.items():
@@ -383,7 +728,146 @@ class BaseStreamClient(AbstractStreamClient, ABC):
             payload["feed_id"] = feed_id
         if user_id is not None:
             payload["user_id"] = user_id
-        return jwt.encode(payload, self.api_secret, algorithm="HS256")
+        # the tokens don't expire, the same payload always gives the same token
+        key = f"token:{self.api_key}:{serializer.dumps(payload, sort_keys=True)}"
+        try:
+            token = self.token_cache.get(key)
+        except Exception:
+            # the cache never fails the client, the token is signed again
+            token = None
+        if token is None:
+            token = jwt.encode(payload, self.api_secret, algorithm="HS256")
+            try:
+                self.token_cache.set(key, token)
+            except Exception:
+                pass
+        return token
+
+    def _activities_queries(self, ids, foreign_id_times, query_params):
+        """
+        Returns the query params of the get_activities requests, the ids are
+        split so every url stays under MAX_QUERY_BYTES
+        """
+        if ids is not None:
+            chunks = chunked(ids, 100, MAX_QUERY_BYTES, measure=query_size)
+            return [dict(query_params, ids=",".join(chunk)) for chunk in chunks] or [
+                dict(query_params, ids="")
+            ]
+
+        validate_foreign_id_time(foreign_id_times)
+        pairs = [(f, _datetime_encoder(t)) for f, t in foreign_id_times]
+        queries = []
+        for chunk in chunked(
+            pairs,
+            100,
+            MAX_QUERY_BYTES,
+            measure=lambda pair: query_size(pair[0]) + query_size(pair[1]),
+        ):
+            foreign_ids, timestamps = zip(*chunk)
+            queries.append(
+                dict(
+                    query_params,
+                    foreign_ids=",".join(foreign_ids),
+                    timestamps=",".join(timestamps),
+                )
+            )
+        return queries
+
+    def _diff_updates(self, changes, unchanged):
+        """
+        Yields the partial updates of the changed pairs, counts the others
+        in unchanged["count"]
+        """
+        for old, new in changes:
+            set_fields, unset_fields = activity_diff(old, new)
+            if not set_fields and not unset_fields:
+                unchanged["count"] += 1
+                continue
+            update = {"set": set_fields, "unset": unset_fields}
+            if old.get("id") is not None:
+                update["id"] = old["id"]
+            else:
+                update["foreign_id"] = old["foreign_id"]
+                update["time"] = old["time"]
+            yield update
+
+    def _feed_reads(self, feeds):
+        """
+        Returns the (feed id, feed, params) of every feed to read
+        """
+        reads = []
+        seen = set()
+        for entry in feeds:
+            feed_id, params = (entry, {}) if isinstance(entry, str) else entry
+            validate_feed_id(feed_id)
+            if feed_id in seen:
+                raise ValueError(f"{feed_id} is read more than once")
+            seen.add(feed_id)
+            feed_slug, user_id = feed_id.split(":")
+            reads.append((feed_id, self.feed(feed_slug, user_id), params or {}))
+        return reads
+
+    def _timeline_merge(self, feeds, max_count, page_size):
+        reads = self._feed_reads(feeds)
+        return TimelineMerge(
+            [(feed, params) for _, feed, params in reads], page_size, max_count
+        )
+
+    def _feeds_deadline(self, timeout):
+        if timeout is None:
+            return contextlib.nullcontext()
+        return deadline(timeout)
+
+    def _feeds_result(self, outcomes):
+        results = {}
+        exceptions = {}
+        for (feed_id, _, _), response, exception in outcomes:
+            if exception is None:
+                results[feed_id] = response
+            else:
+                exceptions[feed_id] = exception
+        return {"results": results, "exceptions": exceptions}
+
+    def _update_key(self, update):
+        """
+        Returns what identifies the activity an update applies to
+        """
+        if update.get("id") is not None:
+            return update["id"]
+        return (update.get("foreign_id"), str(update.get("time")))
+
+    def _update_keys(self, chunk):
+        return {self._update_key(update) for update in chunk}
+
+    def _add_to_many_chunks(self, activity, feeds, chunk_size, max_bytes):
+        body = serializer.dumps({"activity": activity, "feeds": []})
+        overhead = len(body.encode("utf-8"))
+        return chunked(feeds, chunk_size, max_bytes, overhead)
+
+    def _bulk_edges(self, edges, checkpoint, chunk_size):
+        """
+        Returns the report and the chunks of a bulk follow or unfollow
+        """
+        if isinstance(checkpoint, str):
+            checkpoint = Checkpoint(checkpoint)
+        report = BulkReport(checkpoint)
+        edges = itertools.islice(edges, report.offset, None)
+        return report, chunked(edges, chunk_size)
+
+    def _bulk_result(self, outcomes, failed_key):
+        """
+        Aggregates the (chunk, response, exception) outcomes of a bulk call,
+        raises the first exception when every chunk failed
+        """
+        result = {"chunks": 0, failed_key: [], "exceptions": []}
+        for chunk, _, exception in outcomes:
+            result["chunks"] += 1
+            if exception is not None:
+                result[failed_key].extend(chunk)
+                result["exceptions"].append(exception)
+        if result["exceptions"] and len(result["exceptions"]) == result["chunks"]:
+            raise result["exceptions"][0]
+        return result
 
     def raise_exception(self, result, status_code):
         from stream.exceptions import get_exception_dict
@@ -475,6 +959,12 @@ class BaseStreamClient(AbstractStreamClient, ABC):
 
         return url
 
+    def get_request_key(self, url, signature, params):
+        """
+        Returns the key identifying a request for coalescing identical reads
+        """
+        return (url, signature, tuple(sorted((k, str(v)) for k, v in params.items())))
+
     def get_default_params(self):
         params = dict(api_key=self.api_key)
         return params
@@ -1,21 +1,34 @@
 import json
 import logging
+import time
 
 import requests
 from requests import Request
 
 from stream import serializer
+from stream.analytics import AnalyticsEmitter
+from stream.batching import ActivityBatcher
+from stream.bulk import (
+    BulkReport,
+    call_with_retries,
+    chunked_unique,
+    isolate_failures,
+    map_concurrently,
+    merge_outcomes,
+)
 from stream.client.base import BaseStreamClient
 from stream.collections.collections import Collections
+from stream.deadline import remaining_time
 from stream.feed import Feed
+from stream.loader import context_loader
 from stream.personalization import Personalization
 from stream.reactions import Reactions
-from stream.serializer import _datetime_encoder
+from stream.singleflight import SingleFlight
+from stream.spool import Spool
 from stream.users import Users
 from stream.utils import (
     get_reaction_params,
     validate_feed_slug,
-    validate_foreign_id_time,
     validate_user_id,
 )
 
@@ -28,6 +41,56 @@ except ImportError:
 logger = logging.getLogger(__name__)
 
 
+# the most bytes read from a response body between two checks of the total
+# timeout
+CONTENT_CHUNK_SIZE = 64 * 1024
+
+
+def _content_reader(response):
+    """
+    Returns a function reading the next part of the body, b"" at the end
+    """
+    read1 = getattr(response.raw, "read1", None)
+    if read1 is not None:
+        # returns what a single socket read got instead of waiting for a
+        # full chunk
+        return lambda: read1(CONTENT_CHUNK_SIZE, decode_content=True)
+    # urllib3 < 2 can only wait for full chunks
+    chunks = response.iter_content(CONTENT_CHUNK_SIZE)
+    return lambda: next(chunks, b"")
+
+
+def _read_content(response, expires_at):
+    """
+    Reads the body of a streamed response before expires_at
+
+    requests only limits the connection and every single socket read, so a
+    response trickling in could take much longer than the total timeout. The
+    body is read in parts and the time left is checked between them, a
+    request outlasts its total timeout by one socket read at most.
+    """
+    read = _content_reader(response)
+    chunks = []
+    while True:
+        if time.monotonic() >= expires_at:
+            response.close()
+            # raises DeadlineExceeded when the deadline of the operation is
+            # what ran out
+            remaining_time()
+            raise requests.exceptions.ReadTimeout(
+                "the response took longer than the total timeout",
+                response=response,
+            )
+        chunk = read()
+        if not chunk:
+            break
+        chunks.append(chunk)
+    response._content = b"".join(chunks)
+    response._content_consumed = True
+    # returns the connection to the pool
+    response.close()
+
+
 class StreamClient(BaseStreamClient):
     def __init__(
         self,
@@ -35,9 +98,16 @@ class StreamClient(BaseStreamClient):
         api_secret,
         app_id,
         version="v1.0",
-        timeout=6.0,
+        timeout=None,
         base_url=None,
         location=None,
+        connect_timeout=None,
+        read_timeout=None,
+        coalesce_reads=False,
+        feed_cache=None,
+        entity_cache=None,
+        og_cache=None,
+        token_cache=None,
     ):
         super().__init__(
             api_key,
@@ -47,9 +117,17 @@ class StreamClient(BaseStreamClient):
             timeout=timeout,
             base_url=base_url,
             location=location,
+            connect_timeout=connect_timeout,
+            read_timeout=read_timeout,
+            coalesce_reads=coalesce_reads,
+            feed_cache=feed_cache,
+            entity_cache=entity_cache,
+            og_cache=og_cache,
+            token_cache=token_cache,
         )
 
         self.session = requests.Session()
+        self.single_flight = SingleFlight() if coalesce_reads else None
 
         token = self.create_jwt_token("personalization", "*", feed_id="*", user_id="*")
         self.personalization = Personalization(self, token)
@@ -81,10 +159,28 @@ class StreamClient(BaseStreamClient):
     def delete(self, *args, **kwargs):
         return self._make_request(self.session.delete, *args, **kwargs)
 
-    def add_to_many(self, activity, feeds):
-        data = {"activity": activity, "feeds": feeds}
+    def add_to_many(
+        self,
+        activity,
+        feeds,
+        chunk_size=1000,
+        max_bytes=512 * 1024,
+        concurrency=4,
+        retries=2,
+    ):
         token = self.create_jwt_token("feed", "*", feed_id="*")
-        return self.post("feed/add_to_many/", token, data=data)
+
+        def send(chunk):
+            data = {"activity": activity, "feeds": chunk}
+            return call_with_retries(
+                lambda: self.post("feed/add_to_many/", token, data=data),
+                retries,
+                idempotent=False,
+            )
+
+        chunks = self._add_to_many_chunks(activity, feeds, chunk_size, max_bytes)
+        outcomes = map_concurrently(send, chunks, concurrency)
+        return self._bulk_result(outcomes, "failed_feeds")
 
     def follow_many(self, follows, activity_copy_limit=None):
         params = None
@@ -100,6 +196,44 @@ class StreamClient(BaseStreamClient):
         token = self.create_jwt_token("follower", "*", feed_id="*")
         return self.post("unfollow_many/", token, params=params, data=unfollows)
 
+    def bulk_follow(
+        self,
+        edges,
+        activity_copy_limit=None,
+        checkpoint=None,
+        chunk_size=2500,
+        concurrency=4,
+        retries=2,
+    ):
+        def send(chunk):
+            return call_with_retries(
+                lambda: self.follow_many(chunk, activity_copy_limit), retries
+            )
+
+        report, chunks = self._bulk_edges(edges, checkpoint, chunk_size)
+        self._run_bulk(send, chunks, report, concurrency)
+        return report.result("failed_edges")
+
+    def bulk_unfollow(
+        self, edges, checkpoint=None, chunk_size=2500, concurrency=4, retries=2
+    ):
+        def send(chunk):
+            return call_with_retries(lambda: self.unfollow_many(chunk), retries)
+
+        report, chunks = self._bulk_edges(edges, checkpoint, chunk_size)
+        self._run_bulk(send, chunks, report, concurrency)
+        return report.result("failed_edges")
+
+    def _run_bulk(self, send, chunks, report, concurrency, keys=None, on_progress=None):
+        outcomes = map_concurrently(
+            lambda chunk: isolate_failures(send, chunk), chunks, concurrency, keys
+        )
+        for chunk, failures, exception in outcomes:
+            report.add(chunk, failures, exception)
+            if on_progress is not None:
+                on_progress(report.stats())
+        return report
+
     def update_activities(self, activities):
         if not isinstance(activities, (list, tuple, set)):
             raise TypeError("Activities parameter should be of type list")
@@ -108,6 +242,28 @@ class StreamClient(BaseStreamClient):
         data = dict(activities=activities)
         return self.post("activities/", auth_token, data=data)
 
+    def update_activities_stream(
+        self, activities, chunk_size=100, concurrency=4, retries=2, on_progress=None
+    ):
+        auth_token = self.create_jwt_token("activities", "*", feed_id="*")
+
+        def send(chunk):
+            data = dict(activities=chunk)
+            return call_with_retries(
+                lambda: self.post("activities/", auth_token, data=data), retries
+            )
+
+        report = BulkReport()
+        self._run_bulk(
+            send,
+            chunked_unique(activities, chunk_size, self._update_key),
+            report,
+            concurrency,
+            self._update_keys,
+            on_progress,
+        )
+        return report.result("failed_activities")
+
     def update_activity(self, activity):
         return self.update_activities([activity])
 
@@ -131,20 +287,24 @@ class StreamClient(BaseStreamClient):
             endpoint = "enrich/" + endpoint
 
         query_params = {**params}
+        query_params.update(get_reaction_params(reactions))
+        queries = self._activities_queries(ids, foreign_id_times, query_params)
+        if len(queries) == 1:
+            return self.get(endpoint, auth_token, params=queries[0])
 
-        if ids is not None:
-            query_params["ids"] = ",".join(ids)
-
-        if foreign_id_times is not None:
-            validate_foreign_id_time(foreign_id_times)
-            foreign_ids, timestamps = zip(*foreign_id_times)
-            timestamps = map(_datetime_encoder, timestamps)
-            query_params["foreign_ids"] = ",".join(foreign_ids)
-            query_params["timestamps"] = ",".join(timestamps)
+        outcomes = map_concurrently(
+            lambda query: self.get(endpoint, auth_token, params=query), queries
+        )
+        response, results = merge_outcomes(outcomes, lambda r: r["results"])
+        return dict(response, results=results)
 
-        query_params.update(get_reaction_params(reactions))
+    def activity_loader(self, **params):
+        def fetch(ids):
+            response = self.get_activities(ids=ids, **params)
+            return {a["id"]: a for a in response["results"]}
 
-        return self.get(endpoint, auth_token, params=query_params)
+        key = ("activities", id(self), serializer.dumps(params, sort_keys=True))
+        return context_loader(key, fetch)
 
     def activity_partial_update(
         self, id=None, foreign_id=None, time=None, set=None, unset=None
@@ -175,6 +335,42 @@ class StreamClient(BaseStreamClient):
 
         return self.post("activity/", auth_token, data=data)
 
+    def activities_partial_update_stream(
+        self, updates, chunk_size=100, concurrency=4, retries=2, on_progress=None
+    ):
+        auth_token = self.create_jwt_token("activities", "*", feed_id="*")
+
+        def send(chunk):
+            data = {"changes": chunk}
+            return call_with_retries(
+                lambda: self.post("activity/", auth_token, data=data), retries
+            )
+
+        report = BulkReport()
+        self._run_bulk(
+            send,
+            chunked_unique(updates, chunk_size, self._update_key),
+            report,
+            concurrency,
+            self._update_keys,
+            on_progress,
+        )
+        return report.result("failed_updates")
+
+    def update_activities_diff(
+        self, changes, chunk_size=100, concurrency=4, retries=2, on_progress=None
+    ):
+        unchanged = {"count": 0}
+        result = self.activities_partial_update_stream(
+            self._diff_updates(changes, unchanged),
+            chunk_size,
+            concurrency,
+            retries,
+            on_progress,
+        )
+        result["unchanged"] = unchanged["count"]
+        return result
+
     def create_redirect_url(self, target_url, user_id, events):
         # generate the JWT token
         auth_token = self.create_jwt_token(
@@ -209,7 +405,81 @@ class StreamClient(BaseStreamClient):
     def og(self, target_url):
         auth_token = self.create_jwt_token("*", "*", feed_id="*")
         params = {"url": target_url}
-        return self.get("og/", auth_token, params=params)
+        if self.og_cache is None:
+            return self.get("og/", auth_token, params=params)
+        return self.og_cache.fetch(
+            self.og_cache.get_key(target_url),
+            lambda: self.get("og/", auth_token, params=params),
+        )
+
+    def activity_batcher(self, window=0.05, max_size=100, max_workers=4):
+        return ActivityBatcher(window, max_size, max_workers)
+
+    def analytics_emitter(
+        self,
+        batch_size=100,
+        interval=1.0,
+        max_queue=10000,
+        drop="oldest",
+        retries=2,
+        compact=True,
+        sample_rate=1.0,
+        spool=None,
+        dedupe_engagements=False,
+    ):
+        return AnalyticsEmitter(
+            self,
+            batch_size,
+            interval,
+            max_queue,
+            drop,
+            retries,
+            compact,
+            sample_rate,
+            spool,
+            dedupe_engagements,
+        )
+
+    def spool(self, directory, **options):
+        return Spool(self, directory, **options)
+
+    def get_feeds(self, feeds, concurrency=10, timeout=None):
+        reads = self._feed_reads(feeds)
+
+        def read(entry):
+            _, feed, params = entry
+            return feed.get(**params)
+
+        with self._feeds_deadline(timeout):
+            outcomes = list(map_concurrently(read, reads, concurrency))
+        return self._feeds_result(outcomes)
+
+    def merged_timeline(self, feeds, max_count=None, page_size=25, concurrency=10):
+        merge = self._timeline_merge(feeds, max_count, page_size)
+
+        def fetch(cursor):
+            return cursor.feed.get(**cursor.page_params())["results"]
+
+        for cursor, page, exception in map_concurrently(
+            fetch, merge.cursors, concurrency
+        ):
+            if exception is not None:
+                raise exception
+            cursor.add_page(page)
+        for index in range(len(merge.cursors)):
+            merge.push(index)
+        while True:
+            activity, index = merge.pop()
+            if activity is None:
+                return
+            if merge.is_new(activity):
+                yield activity
+                if merge.full():
+                    return
+            cursor = merge.cursors[index]
+            if cursor.needs_page:
+                cursor.add_page(fetch(cursor))
+            merge.push(index)
 
     def follow_stats(self, feed_id, followers_slugs=None, following_slugs=None):
         auth_token = self.create_jwt_token("*", "*", feed_id="*")
@@ -242,6 +512,7 @@ class StreamClient(BaseStreamClient):
         service_name="api",
         params=None,
         data=None,
+        timeout=None,
     ):
         params = params or {}
         data = data or {}
@@ -259,20 +530,31 @@ class StreamClient(BaseStreamClient):
 
         if method.__name__ in ["post", "put", "delete"]:
             serialized = serializer.dumps(data)
-        response = method(
-            url,
-            data=serialized,
-            headers=headers,
-            params=default_params,
-            timeout=self.timeout,
-        )
-        # remove JWT from logs
-        headers_to_log = headers.copy()
-        headers_to_log.pop("Authorization", None)
-        logger.debug(
-            f"stream api call {response.url}, headers {headers_to_log} data {data}"
-        )
-        return self._parse_response(response)
+
+        def send():
+            total, connect_timeout, read_timeout = self.get_timeouts(timeout)
+            expires_at = time.monotonic() + total
+            response = method(
+                url,
+                data=serialized,
+                headers=headers,
+                params=default_params,
+                timeout=(connect_timeout, read_timeout),
+                stream=True,
+            )
+            _read_content(response, expires_at)
+            # remove JWT from logs
+            headers_to_log = headers.copy()
+            headers_to_log.pop("Authorization", None)
+            logger.debug(
+                f"stream api call {response.url}, headers {headers_to_log} data {data}"
+            )
+            return self._parse_response(response)
+
+        if self.single_flight is not None and method.__name__ == "get":
+            key = self.get_request_key(url, signature, default_params)
+            return self.single_flight.do(key, send)
+        return send()
 
     def _parse_response(self, response):
         try:
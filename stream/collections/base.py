@@ -1,5 +1,7 @@
 from abc import ABC, abstractmethod
 
+from stream.bulk import MAX_QUERY_BYTES, chunked, query_size
+
 
 class AbstractCollection(ABC):
     @abstractmethod
@@ -40,6 +42,23 @@ class AbstractCollection(ABC):
         """
         pass
 
+    @abstractmethod
+    def loader(self, collection_name):
+        """
+        Returns the loader batching the lookups of single entries by id,
+        the entries are fetched with select
+
+        Sync loaders send the pending ids when a result is asked for or a
+        callback is added, call dispatch() on the loader before waiting for
+        the futures with concurrent.futures.wait or as_completed.
+
+        **Example**::
+
+            future = client.collections.loader("product").load(product_id)
+            product = future.result()  # async: await loader.load(product_id)
+        """
+        pass
+
     @abstractmethod
     def delete_many(self, collection_name, ids):
         """
@@ -97,3 +116,81 @@ class BaseCollection(AbstractCollection, ABC):
                 "must call with collection_name and id or with entry arguments"
             )
         return f"SO:{_collection}:{_id}"
+
+    def _select_queries(self, collection_name, ids):
+        """
+        Returns the params of the select requests for ids, the foreign ids
+        are split so every url stays under MAX_QUERY_BYTES
+        """
+        foreign_ids = [f"{collection_name}:{k}" for k in ids]
+        chunks = chunked(foreign_ids, None, MAX_QUERY_BYTES, measure=query_size)
+        return [{"foreign_ids": ",".join(chunk)} for chunk in chunks] or [
+            {"foreign_ids": ""}
+        ]
+
+    def _delete_many_queries(self, collection_name, ids):
+        # ids are sent as a repeated param, "&ids=" takes 2 more bytes than
+        # the quoted comma query_size counts
+        chunks = chunked(
+            ids, None, MAX_QUERY_BYTES, measure=lambda id: query_size(id) + 2
+        )
+        return [
+            {"collection_name": collection_name, "ids": chunk} for chunk in chunks
+        ] or [{"collection_name": collection_name, "ids": []}]
+
+    def _cache_entry(self, collection_name, entry):
+        cache = self.client.entity_cache
+        if cache is not None:
+            cache.set(cache.collection_key(collection_name, entry["id"]), entry)
+
+    def _evict_entries(self, collection_name, ids):
+        cache = self.client.entity_cache
+        if cache is not None:
+            for id in ids:
+                cache.delete(cache.collection_key(collection_name, id))
+
+    def _split_cached(self, collection_name, ids):
+        """
+        Returns the cached entries by id, the ids which have to be fetched
+        and the stale entries to refresh in the background by cache key
+        """
+        cache = self.client.entity_cache
+        if cache is None:
+            return {}, ids, {}
+
+        ids = list(dict.fromkeys(str(i) for i in ids))
+        keys = {cache.collection_key(collection_name, id): id for id in ids}
+        found, known_missing, stale = cache.get_many(list(keys))
+        cached = {keys[key]: entry for key, entry in found.items()}
+        # select leaves out the ids which don't exist
+        missing = [
+            keys[key] for key in keys if key not in found and key not in known_missing
+        ]
+        return cached, missing, {key: keys[key] for key in stale}
+
+    def _merge_selected(
+        self, collection_name, ids, cached, missing, response, delta=0.0
+    ):
+        """
+        Caches the fetched entries and returns the select response for all ids
+        """
+        cache = self.client.entity_cache
+        if cache is None:
+            return response
+
+        entries = dict(cached)
+        if response is None:
+            response = {}
+        else:
+            fetched = {}
+            for entry in response["response"]["data"]:
+                entries[str(entry["id"])] = entry
+                fetched[cache.collection_key(collection_name, entry["id"])] = entry
+            cache.set_many(fetched, delta=delta)
+            for id in missing:
+                if id not in entries:
+                    cache.set_missing(cache.collection_key(collection_name, id))
+
+        ids = dict.fromkeys(str(i) for i in ids)
+        response["response"] = {"data": [entries[i] for i in ids if i in entries]}
+        return response
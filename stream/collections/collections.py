@@ -1,4 +1,8 @@
+import time
+
+from stream.bulk import async_map_concurrently, map_concurrently, merge_outcomes
 from stream.collections.base import BaseCollection
+from stream.loader import context_loader, loop_loader
 
 
 class Collections(BaseCollection):
@@ -8,71 +12,134 @@ class Collections(BaseCollection):
 
         data_json = {collection_name: data}
 
-        return self.client.post(
+        response = self.client.post(
             self.URL,
             service_name=self.SERVICE_NAME,
             signature=self.token,
             data={"data": data_json},
         )
+        self._evict_entries(collection_name, [d["id"] for d in data if "id" in d])
+        return response
 
     def select(self, collection_name, ids):
         if not isinstance(ids, list):
             ids = [ids]
 
-        foreign_ids = ",".join(f"{collection_name}:{k}" for i, k in enumerate(ids))
+        cached, missing, stale = self._split_cached(collection_name, ids)
+        if stale:
 
-        return self.client.get(
-            self.URL,
-            service_name=self.SERVICE_NAME,
-            params={"foreign_ids": foreign_ids},
-            signature=self.token,
+            def refresh(keys):
+                ids = [stale[key] for key in keys]
+                response, delta = self._fetch_selected(collection_name, ids)
+                self._merge_selected(collection_name, ids, {}, ids, response, delta)
+
+            self.client.entity_cache.refresh(list(stale), refresh)
+
+        response, delta = None, 0.0
+        if missing or not ids:
+            response, delta = self._fetch_selected(collection_name, missing)
+        return self._merge_selected(
+            collection_name, ids, cached, missing, response, delta
         )
 
+    def _fetch_selected(self, collection_name, ids):
+        """
+        Returns the select response for ids and how long it took
+        """
+
+        def send(params):
+            return self.client.get(
+                self.URL,
+                service_name=self.SERVICE_NAME,
+                params=params,
+                signature=self.token,
+            )
+
+        started = time.monotonic()
+        queries = self._select_queries(collection_name, ids)
+        if len(queries) == 1:
+            response = send(queries[0])
+        else:
+            outcomes = map_concurrently(send, queries)
+            response, data = merge_outcomes(outcomes, lambda r: r["response"]["data"])
+            response = dict(response, response={"data": data})
+        return response, time.monotonic() - started
+
+    def loader(self, collection_name):
+        def fetch(ids):
+            response = self.select(collection_name, ids)
+            return {str(e["id"]): e for e in response["response"]["data"]}
+
+        key = ("collections", id(self.client), collection_name)
+        return context_loader(key, fetch)
+
     def delete_many(self, collection_name, ids):
         if not isinstance(ids, list):
             ids = [ids]
         ids = [str(i) for i in ids]
 
-        params = {"collection_name": collection_name, "ids": ids}
+        def send(params):
+            return self.client.delete(
+                self.URL,
+                service_name=self.SERVICE_NAME,
+                params=params,
+                signature=self.token,
+            )
 
-        return self.client.delete(
-            self.URL,
-            service_name=self.SERVICE_NAME,
-            params=params,
-            signature=self.token,
-        )
+        queries = self._delete_many_queries(collection_name, ids)
+        try:
+            if len(queries) == 1:
+                return send(queries[0])
+            outcomes = map_concurrently(send, queries)
+            response, _ = merge_outcomes(outcomes, lambda r: [])
+            return response
+        finally:
+            # evicted even when a chunk failed, the others went through
+            self._evict_entries(collection_name, ids)
 
     def add(self, collection_name, data, id=None, user_id=None):
         payload = dict(id=id, data=data, user_id=user_id)
-        return self.client.post(
+        response = self.client.post(
             f"{self.URL}/{collection_name}",
             service_name=self.SERVICE_NAME,
             signature=self.token,
             data=payload,
         )
+        self._cache_entry(collection_name, response)
+        return response
 
     def get(self, collection_name, id):
-        return self.client.get(
-            f"{self.URL}/{collection_name}/{id}",
-            service_name=self.SERVICE_NAME,
-            signature=self.token,
-        )
+        def load():
+            return self.client.get(
+                f"{self.URL}/{collection_name}/{id}",
+                service_name=self.SERVICE_NAME,
+                signature=self.token,
+            )
+
+        cache = self.client.entity_cache
+        if cache is None:
+            return load()
+        return cache.fetch(cache.collection_key(collection_name, id), load)
 
     def update(self, collection_name, id, data=None):
         payload = dict(data=data)
-        return self.client.put(
+        response = self.client.put(
             f"{self.URL}/{collection_name}/{id}",
             service_name=self.SERVICE_NAME,
             signature=self.token,
             data=payload,
         )
+        self._cache_entry(collection_name, response)
+        return response
 
     def delete(self, collection_name, id):
-        return self.client.delete(
+        response = self.client.delete(
             f"{self.URL}/{collection_name}/{id}",
             service_name=self.SERVICE_NAME,
             signature=self.token,
         )
+        self._evict_entries(collection_name, [id])
+        return response
 
 
 class AsyncCollections(BaseCollection):
@@ -82,67 +149,131 @@ class AsyncCollections(BaseCollection):
 
         data_json = {collection_name: data}
 
-        return await self.client.post(
+        response = await self.client.post(
             self.URL,
             service_name=self.SERVICE_NAME,
             signature=self.token,
             data={"data": data_json},
         )
+        self._evict_entries(collection_name, [d["id"] for d in data if "id" in d])
+        return response
 
     async def select(self, collection_name, ids):
         if not isinstance(ids, list):
             ids = [ids]
 
-        foreign_ids = ",".join(f"{collection_name}:{k}" for i, k in enumerate(ids))
+        cached, missing, stale = self._split_cached(collection_name, ids)
+        if stale:
 
-        return await self.client.get(
-            self.URL,
-            service_name=self.SERVICE_NAME,
-            params={"foreign_ids": foreign_ids},
-            signature=self.token,
+            async def refresh(keys):
+                ids = [stale[key] for key in keys]
+                response, delta = await self._fetch_selected(collection_name, ids)
+                self._merge_selected(collection_name, ids, {}, ids, response, delta)
+
+            self.client.entity_cache.async_refresh(list(stale), refresh)
+
+        response, delta = None, 0.0
+        if missing or not ids:
+            response, delta = await self._fetch_selected(collection_name, missing)
+        return self._merge_selected(
+            collection_name, ids, cached, missing, response, delta
         )
 
+    async def _fetch_selected(self, collection_name, ids):
+        """
+        Returns the select response for ids and how long it took
+        """
+
+        async def send(params):
+            return await self.client.get(
+                self.URL,
+                service_name=self.SERVICE_NAME,
+                params=params,
+                signature=self.token,
+            )
+
+        started = time.monotonic()
+        queries = self._select_queries(collection_name, ids)
+        if len(queries) == 1:
+            response = await send(queries[0])
+        else:
+            outcomes = [o async for o in async_map_concurrently(send, queries)]
+            response, data = merge_outcomes(outcomes, lambda r: r["response"]["data"])
+            response = dict(response, response={"data": data})
+        return response, time.monotonic() - started
+
+    def loader(self, collection_name):
+        async def fetch(ids):
+            response = await self.select(collection_name, ids)
+            return {str(e["id"]): e for e in response["response"]["data"]}
+
+        key = ("collections", id(self.client), collection_name)
+        return loop_loader(key, fetch)
+
     async def delete_many(self, collection_name, ids):
         if not isinstance(ids, list):
             ids = [ids]
         ids = [str(i) for i in ids]
 
-        params = {"collection_name": collection_name, "ids": ids}
-        return await self.client.delete(
-            self.URL,
-            service_name=self.SERVICE_NAME,
-            params=params,
-            signature=self.token,
-        )
+        async def send(params):
+            return await self.client.delete(
+                self.URL,
+                service_name=self.SERVICE_NAME,
+                params=params,
+                signature=self.token,
+            )
+
+        queries = self._delete_many_queries(collection_name, ids)
+        try:
+            if len(queries) == 1:
+                return await send(queries[0])
+            outcomes = [o async for o in async_map_concurrently(send, queries)]
+            response, _ = merge_outcomes(outcomes, lambda r: [])
+            return response
+        finally:
+            # evicted even when a chunk failed, the others went through
+            self._evict_entries(collection_name, ids)
 
     async def get(self, collection_name, id):
-        return await self.client.get(
-            f"{self.URL}/{collection_name}/{id}",
-            service_name=self.SERVICE_NAME,
-            signature=self.token,
-        )
+        def load():
+            return self.client.get(
+                f"{self.URL}/{collection_name}/{id}",
+                service_name=self.SERVICE_NAME,
+                signature=self.token,
+            )
+
+        cache = self.client.entity_cache
+        if cache is None:
+            return await load()
+        return await cache.async_fetch(cache.collection_key(collection_name, id), load)
 
     async def add(self, collection_name, data, id=None, user_id=None):
         payload = dict(id=id, data=data, user_id=user_id)
-        return await self.client.post(
+        response = await self.client.post(
             f"{self.URL}/{collection_name}",
             service_name=self.SERVICE_NAME,
             signature=self.token,
             data=payload,
         )
+        self._cache_entry(collection_name, response)
+        return response
 
     async def update(self, collection_name, id, data=None):
         payload = dict(data=data)
-        return await self.client.put(
+        response = await self.client.put(
             f"{self.URL}/{collection_name}/{id}",
             service_name=self.SERVICE_NAME,
             signature=self.token,
             data=payload,
         )
+        self._cache_entry(collection_name, response)
+        return response
 
     async def delete(self, collection_name, id):
-        return await self.client.delete(
+        response = await self.client.delete(
             f"{self.URL}/{collection_name}/{id}",
             service_name=self.SERVICE_NAME,
             signature=self.token,
         )
+        self._evict_entries(collection_name, [id])
+        return response
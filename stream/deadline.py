@@ -0,0 +1,65 @@
+import contextvars
+import time
+from contextlib import contextmanager
+
+from stream.exceptions import DeadlineExceeded
+
+"""
+Time budgets shared by every request made in the same context
+
+A deadline is stored as an absolute monotonic timestamp in a context variable,
+so it follows the code path of a single operation: nested helpers, threads
+started with a copied context and asyncio tasks all see the same budget and
+every request only gets the time that is left.
+"""
+
+_current_deadline = contextvars.ContextVar("stream_deadline", default=None)
+
+
+@contextmanager
+def deadline(seconds):
+    """
+    Limits every request performed inside the block to a total of `seconds`
+
+    Nested deadlines can only shorten the budget, never extend it.
+
+    **Example**::
+
+        with client.deadline(0.15):
+            activities = feed.get(limit=10)
+            entries = client.collections.select('product', ids)
+    """
+    expires_at = time.monotonic() + seconds
+    current = _current_deadline.get()
+    if current is not None:
+        expires_at = min(expires_at, current)
+    token = _current_deadline.set(expires_at)
+    try:
+        yield expires_at
+    finally:
+        _current_deadline.reset(token)
+
+
+def remaining_time():
+    """
+    Returns the seconds left in the current deadline or None if there is none
+
+    Raises DeadlineExceeded once the budget has been spent
+    """
+    expires_at = _current_deadline.get()
+    if expires_at is None:
+        return None
+    remaining = expires_at - time.monotonic()
+    if remaining <= 0:
+        raise DeadlineExceeded("the deadline for this operation has passed")
+    return remaining
+
+
+def detach_deadline():
+    """
+    Removes the deadline from the current context
+
+    Used by background work started during an operation, which should not
+    be limited by the budget of that operation.
+    """
+    _current_deadline.set(None)
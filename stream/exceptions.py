@@ -154,6 +154,13 @@ class NotAllowedException(StreamApiException):
     code = 17
 
 
+class DeadlineExceeded(TimeoutError):
+    """
+    Raised on the client side when the time budget set with deadline() is
+    spent before a request could be sent
+    """
+
+
 def get_exceptions():
     from stream import exceptions
 
@@ -1,5 +1,6 @@
 from abc import ABC, abstractmethod
 
+from stream.bulk import Checkpoint
 from stream.utils import validate_feed_id
 
 
@@ -76,6 +77,35 @@ class AbstractFeed(ABC):
         """
         pass
 
+    @abstractmethod
+    def iter_activities(
+        self,
+        page_size=25,
+        enrich=False,
+        reactions=None,
+        max_count=None,
+        max_seconds=None,
+        **params,
+    ):
+        """
+        Iterates over the activities of the feed, newest first, fetching
+        pages of page_size activities with id_lt cursors
+
+        :param max_count: stop after this many activities
+        :param max_seconds: stop after this many seconds
+        :param params: other params of get, ie. ranking
+
+        The next page is fetched while the current one is consumed, at most
+        two pages are held in memory. The async feed returns an async
+        iterator.
+
+        **Example**::
+
+            for activity in feed.iter_activities(page_size=100, max_count=1000):
+                print(activity['id'])
+        """
+        pass
+
     @abstractmethod
     def follow(
         self, target_feed_slug, target_user_id, activity_copy_limit=None, **extra_data
@@ -111,6 +141,71 @@ class AbstractFeed(ABC):
         """
         pass
 
+    @abstractmethod
+    def iter_followers(
+        self, page_size=500, concurrency=4, feeds=None, offset=0, checkpoint=None
+    ):
+        """
+        Iterates over all the followers of the feed, fetching `concurrency`
+        pages of page_size follows at the same time
+
+        :param feeds: only list the follows of these feed ids
+        :param offset: how many follows to skip
+        :param checkpoint: a stream.bulk.Checkpoint or the path of its file,
+         it records the offset of every page consumed and a new call with the
+         same checkpoint resumes after them
+
+        The number of followers given by follow_stats decides how many pages
+        are fetched concurrently, follows added meanwhile are fetched after
+        them. The follows are yielded in the order of the pages, without the
+        duplicates caused by follows added while the pages are fetched.
+
+        **Example**::
+
+            for follow in feed.iter_followers(checkpoint='followers.json'):
+                print(follow['feed_id'])
+        """
+        pass
+
+    @abstractmethod
+    def iter_following(
+        self, page_size=500, concurrency=4, feeds=None, offset=0, checkpoint=None
+    ):
+        """
+        Iterates over all the feeds this feed follows, like iter_followers
+        """
+        pass
+
+    @abstractmethod
+    def reconcile_following(
+        self,
+        targets,
+        activity_copy_limit=None,
+        keep_history=False,
+        dry_run=False,
+        page_size=500,
+    ):
+        """
+        Makes this feed follow exactly the given target feeds
+
+        :param targets: the feed ids this feed should follow
+        :param activity_copy_limit: how many activities are copied per new follow
+        :param keep_history: keep the activities of the unfollowed feeds
+        :param dry_run: only compute the changes, don't apply them
+        :param page_size: how many follows are read per following request
+
+        Reads the current follows, then only follows the missing targets and
+        unfollows the extra ones. Returns the targets to follow and to
+        unfollow, the number of follows left untouched and the edges which
+        failed to apply.
+
+        **Example**::
+
+            plan = feed.reconcile_following(['user:1', 'user:2'], dry_run=True)
+            print(len(plan['follow']), len(plan['unfollow']))
+        """
+        pass
+
     @abstractmethod
     def add_to_signature(self, recipients):
         """
@@ -162,6 +257,86 @@ class BaseFeed(AbstractFeed, ABC):
     def get_readonly_token(self):
         return self.create_scope_token("*", "read")
 
+    def _invalidate_cache(self, feed_ids=()):
+        """
+        Drops the cached reads of this feed and of the given feed ids
+        """
+        cache = self.client.feed_cache
+        if cache is None:
+            return
+        cache.invalidate(self.id)
+        for feed_id in feed_ids:
+            cache.invalidate(feed_id)
+
+    def _page_limit(self, page_size, max_count, counted):
+        """
+        Returns the limit of the next page, 0 once max_count is reached
+        """
+        if max_count is None:
+            return page_size
+        return max(0, min(page_size, max_count - counted))
+
+    def _page_params(self, params, limit, cursor):
+        page_params = dict(params, limit=limit)
+        if cursor is not None:
+            page_params["id_lt"] = cursor
+        return page_params
+
+    def _follows_start(self, offset, checkpoint):
+        """
+        Returns the checkpoint, if any, and the offset to start from
+        """
+        if isinstance(checkpoint, str):
+            checkpoint = Checkpoint(checkpoint)
+        if checkpoint is not None and checkpoint.offset:
+            offset = checkpoint.offset
+        return checkpoint, offset
+
+    def _follows_offsets(self, offset, total, page_size, concurrency):
+        """
+        Returns the offsets of the next pages to fetch, the ones up to the
+        total then windows of `concurrency` pages
+        """
+        if total is not None and offset < total:
+            return range(offset, total, page_size)
+        return range(offset, offset + concurrency * page_size, page_size)
+
+    def _follow_stats_count(self, response, kind):
+        return response["results"][kind]["count"]
+
+    def _following_diff(self, current, targets):
+        """
+        Returns the targets to follow, the ones to unfollow and how many
+        follows are already right
+        """
+        targets = list(dict.fromkeys(validate_feed_id(t) for t in targets))
+        current = set(current)
+        desired = set(targets)
+        follow = [t for t in targets if t not in current]
+        unfollow = sorted(current - desired)
+        return follow, unfollow, len(current & desired)
+
+    def _follow_edges(self, follow, unfollow, keep_history):
+        follows = [{"source": self.id, "target": t} for t in follow]
+        unfollows = [
+            {"source": self.id, "target": t, "keep_history": keep_history}
+            for t in unfollow
+        ]
+        return follows, unfollows
+
+    def _reconcile_result(self, follow, unfollow, unchanged, results=()):
+        plan = {
+            "follow": follow,
+            "unfollow": unfollow,
+            "unchanged": unchanged,
+            "failed_edges": [],
+            "exceptions": [],
+        }
+        for result in results:
+            plan["failed_edges"].extend(result["failed_edges"])
+            plan["exceptions"].extend(result["exceptions"])
+        return plan
+
     def add_to_signature(self, recipients):
         data = []
         for recipient in recipients:
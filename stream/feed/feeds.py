@@ -1,3 +1,9 @@
+import asyncio
+import contextvars
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from stream.bulk import async_map_concurrently, map_concurrently
 from stream.feed.base import BaseFeed
 from stream.utils import get_reaction_params, validate_feed_slug, validate_user_id
 
@@ -11,24 +17,31 @@ class Feed(BaseFeed):
                 "please provide the activity's to field as a list not a string"
             )
 
-        if activity_data.get("to"):
+        targets = activity_data.get("to") or []
+        if targets:
             activity_data = activity_data.copy()
-            activity_data["to"] = self.add_to_signature(activity_data["to"])
+            activity_data["to"] = self.add_to_signature(targets)
 
         token = self.create_scope_token("feed", "write")
-        return self.client.post(self.feed_url, data=activity_data, signature=token)
+        response = self.client.post(self.feed_url, data=activity_data, signature=token)
+        self._invalidate_cache(targets)
+        return response
 
     def add_activities(self, activity_list):
         activities = []
+        targets = []
         for activity_data in activity_list:
             activity_data = activity_data.copy()
             activities.append(activity_data)
             if activity_data.get("to"):
+                targets.extend(activity_data["to"])
                 activity_data["to"] = self.add_to_signature(activity_data["to"])
         token = self.create_scope_token("feed", "write")
         data = dict(activities=activities)
         if activities:
-            return self.client.post(self.feed_url, data=data, signature=token)
+            response = self.client.post(self.feed_url, data=data, signature=token)
+            self._invalidate_cache(targets)
+            return response
         return None
 
     def remove_activity(self, activity_id=None, foreign_id=None):
@@ -40,7 +53,9 @@ class Feed(BaseFeed):
         token = self.create_scope_token("feed", "delete")
         if foreign_id is not None:
             params["foreign_id"] = "1"
-        return self.client.delete(url, signature=token, params=params)
+        response = self.client.delete(url, signature=token, params=params)
+        self._invalidate_cache()
+        return response
 
     def get(self, enrich=False, reactions=None, **params):
         for field in ["mark_read", "mark_seen"]:
@@ -55,7 +70,56 @@ class Feed(BaseFeed):
             feed_url = self.feed_url
 
         params.update(get_reaction_params(reactions))
-        return self.client.get(feed_url, params=params, signature=token)
+        cache = self.client.feed_cache
+        key = None if cache is None else cache.get_key(self.id, feed_url, params)
+        if key is None:
+            return self.client.get(feed_url, params=params, signature=token)
+        return cache.fetch(
+            key, lambda: self.client.get(feed_url, params=params, signature=token)
+        )
+
+    def iter_activities(
+        self,
+        page_size=25,
+        enrich=False,
+        reactions=None,
+        max_count=None,
+        max_seconds=None,
+        **params,
+    ):
+        expires_at = None if max_seconds is None else time.monotonic() + max_seconds
+
+        def fetch(limit, cursor):
+            page_params = self._page_params(params, limit, cursor)
+            return self.get(enrich, reactions, **page_params)["results"]
+
+        def prefetch(limit, cursor):
+            # the page is fetched in a copy of the caller's context
+            context = contextvars.copy_context()
+            return executor.submit(context.run, fetch, limit, cursor)
+
+        executor = ThreadPoolExecutor(1)
+        counted = 0
+        limit = self._page_limit(page_size, max_count, counted)
+        future = prefetch(limit, None) if limit else None
+        try:
+            while future is not None:
+                page = future.result()
+                next_limit = self._page_limit(page_size, max_count, counted + len(page))
+                future = None
+                # a short page is the last one
+                if len(page) == limit and next_limit:
+                    future = prefetch(next_limit, page[-1]["id"])
+                limit = next_limit
+                for activity in page:
+                    if expires_at is not None and time.monotonic() >= expires_at:
+                        return
+                    yield activity
+                    counted += 1
+        finally:
+            if future is not None:
+                future.cancel()
+            executor.shutdown(wait=False)
 
     def follow(
         self, target_feed_slug, target_user_id, activity_copy_limit=None, **extra_data
@@ -70,7 +134,9 @@ class Feed(BaseFeed):
             data["activity_copy_limit"] = activity_copy_limit
         token = self.create_scope_token("follower", "write")
         data.update(extra_data)
-        return self.client.post(url, data=data, signature=token)
+        response = self.client.post(url, data=data, signature=token)
+        self._invalidate_cache()
+        return response
 
     def unfollow(self, target_feed_slug, target_user_id, keep_history=False):
         target_feed_slug = validate_feed_slug(target_feed_slug)
@@ -81,7 +147,9 @@ class Feed(BaseFeed):
         params = {}
         if keep_history:
             params["keep_history"] = True
-        return self.client.delete(url, signature=token, params=params)
+        response = self.client.delete(url, signature=token, params=params)
+        self._invalidate_cache()
+        return response
 
     def followers(self, offset=0, limit=25, feeds=None):
         feeds = ",".join(feeds) if feeds is not None else ""
@@ -97,6 +165,89 @@ class Feed(BaseFeed):
         token = self.create_scope_token("follower", "read")
         return self.client.get(url, params=params, signature=token)
 
+    def iter_followers(
+        self, page_size=500, concurrency=4, feeds=None, offset=0, checkpoint=None
+    ):
+        def fetch(page_offset):
+            return self.followers(page_offset, page_size, feeds)["results"]
+
+        return self._iter_follows(
+            fetch, "followers", page_size, concurrency, feeds, offset, checkpoint
+        )
+
+    def iter_following(
+        self, page_size=500, concurrency=4, feeds=None, offset=0, checkpoint=None
+    ):
+        def fetch(page_offset):
+            return self.following(page_offset, page_size, feeds)["results"]
+
+        return self._iter_follows(
+            fetch, "following", page_size, concurrency, feeds, offset, checkpoint
+        )
+
+    def _iter_follows(
+        self, fetch, kind, page_size, concurrency, feeds, offset, checkpoint
+    ):
+        checkpoint, offset = self._follows_start(offset, checkpoint)
+        total = None
+        if feeds is None:
+            stats = self.client.follow_stats(self.id)
+            total = self._follow_stats_count(stats, kind)
+
+        # follows added during the crawl shift the pages, the ones already
+        # seen at the end of the previous page come again
+        previous = set()
+        full = True
+        while full:
+            offsets = self._follows_offsets(offset, total, page_size, concurrency)
+            pages = map_concurrently(fetch, offsets, concurrency)
+            try:
+                for page_offset, page, exception in pages:
+                    if exception is not None:
+                        raise exception
+                    keys = set()
+                    for follow in page:
+                        key = (follow["feed_id"], follow["target_id"])
+                        keys.add(key)
+                        if key not in previous:
+                            yield follow
+                    previous = keys
+                    offset = page_offset + len(page)
+                    if checkpoint is not None:
+                        checkpoint.save(offset)
+                    full = len(page) == page_size
+                    if not full:
+                        break
+            finally:
+                pages.close()
+
+    def reconcile_following(
+        self,
+        targets,
+        activity_copy_limit=None,
+        keep_history=False,
+        dry_run=False,
+        page_size=500,
+    ):
+        current = []
+        while True:
+            response = self.following(offset=len(current), limit=page_size)
+            current.extend(f["target_id"] for f in response["results"])
+            if len(response["results"]) < page_size:
+                break
+
+        follow, unfollow, unchanged = self._following_diff(current, targets)
+        if dry_run or not (follow or unfollow):
+            return self._reconcile_result(follow, unfollow, unchanged)
+
+        follows, unfollows = self._follow_edges(follow, unfollow, keep_history)
+        results = [
+            self.client.bulk_unfollow(unfollows),
+            self.client.bulk_follow(follows, activity_copy_limit),
+        ]
+        self._invalidate_cache()
+        return self._reconcile_result(follow, unfollow, unchanged, results)
+
     def update_activity_to_targets(
         self,
         foreign_id,
@@ -128,28 +279,35 @@ class AsyncFeed(BaseFeed):
                 "please provide the activity's to field as a list not a string"
             )
 
-        if activity_data.get("to"):
+        targets = activity_data.get("to") or []
+        if targets:
             activity_data = activity_data.copy()
-            activity_data["to"] = self.add_to_signature(activity_data["to"])
+            activity_data["to"] = self.add_to_signature(targets)
 
         token = self.create_scope_token("feed", "write")
-        return await self.client.post(
+        response = await self.client.post(
             self.feed_url, data=activity_data, signature=token
         )
+        self._invalidate_cache(targets)
+        return response
 
     async def add_activities(self, activity_list):
         activities = []
+        targets = []
         for activity_data in activity_list:
             activity_data = activity_data.copy()
             activities.append(activity_data)
             if activity_data.get("to"):
+                targets.extend(activity_data["to"])
                 activity_data["to"] = self.add_to_signature(activity_data["to"])
         token = self.create_scope_token("feed", "write")
         data = dict(activities=activities)
         if not activities:
             return
 
-        return await self.client.post(self.feed_url, data=data, signature=token)
+        response = await self.client.post(self.feed_url, data=data, signature=token)
+        self._invalidate_cache(targets)
+        return response
 
     async def remove_activity(self, activity_id=None, foreign_id=None):
         identifier = activity_id or foreign_id
@@ -160,7 +318,9 @@ class AsyncFeed(BaseFeed):
         token = self.create_scope_token("feed", "delete")
         if foreign_id is not None:
             params["foreign_id"] = "1"
-        return await self.client.delete(url, signature=token, params=params)
+        response = await self.client.delete(url, signature=token, params=params)
+        self._invalidate_cache()
+        return response
 
     async def get(self, enrich=False, reactions=None, **params):
         for field in ["mark_read", "mark_seen"]:
@@ -175,7 +335,48 @@ class AsyncFeed(BaseFeed):
             feed_url = self.feed_url
 
         params.update(get_reaction_params(reactions))
-        return await self.client.get(feed_url, params=params, signature=token)
+        cache = self.client.feed_cache
+        key = None if cache is None else cache.get_key(self.id, feed_url, params)
+        if key is None:
+            return await self.client.get(feed_url, params=params, signature=token)
+        return await cache.async_fetch(
+            key, lambda: self.client.get(feed_url, params=params, signature=token)
+        )
+
+    async def iter_activities(
+        self,
+        page_size=25,
+        enrich=False,
+        reactions=None,
+        max_count=None,
+        max_seconds=None,
+        **params,
+    ):
+        expires_at = None if max_seconds is None else time.monotonic() + max_seconds
+
+        async def fetch(limit, cursor):
+            page_params = self._page_params(params, limit, cursor)
+            return (await self.get(enrich, reactions, **page_params))["results"]
+
+        counted = 0
+        limit = self._page_limit(page_size, max_count, counted)
+        task = asyncio.ensure_future(fetch(limit, None)) if limit else None
+        try:
+            while task is not None:
+                page = await task
+                next_limit = self._page_limit(page_size, max_count, counted + len(page))
+                task = None
+                if len(page) == limit and next_limit:
+                    task = asyncio.ensure_future(fetch(next_limit, page[-1]["id"]))
+                limit = next_limit
+                for activity in page:
+                    if expires_at is not None and time.monotonic() >= expires_at:
+                        return
+                    yield activity
+                    counted += 1
+        finally:
+            if task is not None:
+                task.cancel()
 
     async def follow(
         self, target_feed_slug, target_user_id, activity_copy_limit=None, **extra_data
@@ -190,7 +391,9 @@ class AsyncFeed(BaseFeed):
             data["activity_copy_limit"] = activity_copy_limit
         token = self.create_scope_token("follower", "write")
         data.update(extra_data)
-        return await self.client.post(url, data=data, signature=token)
+        response = await self.client.post(url, data=data, signature=token)
+        self._invalidate_cache()
+        return response
 
     async def unfollow(self, target_feed_slug, target_user_id, keep_history=False):
         target_feed_slug = validate_feed_slug(target_feed_slug)
@@ -201,7 +404,9 @@ class AsyncFeed(BaseFeed):
         params = {}
         if keep_history:
             params["keep_history"] = True
-        return await self.client.delete(url, signature=token, params=params)
+        response = await self.client.delete(url, signature=token, params=params)
+        self._invalidate_cache()
+        return response
 
     async def followers(self, offset=0, limit=25, feeds=None):
         feeds = ",".join(feeds) if feeds is not None else ""
@@ -217,6 +422,91 @@ class AsyncFeed(BaseFeed):
         token = self.create_scope_token("follower", "read")
         return await self.client.get(url, params=params, signature=token)
 
+    def iter_followers(
+        self, page_size=500, concurrency=4, feeds=None, offset=0, checkpoint=None
+    ):
+        async def fetch(page_offset):
+            response = await self.followers(page_offset, page_size, feeds)
+            return response["results"]
+
+        return self._iter_follows(
+            fetch, "followers", page_size, concurrency, feeds, offset, checkpoint
+        )
+
+    def iter_following(
+        self, page_size=500, concurrency=4, feeds=None, offset=0, checkpoint=None
+    ):
+        async def fetch(page_offset):
+            response = await self.following(page_offset, page_size, feeds)
+            return response["results"]
+
+        return self._iter_follows(
+            fetch, "following", page_size, concurrency, feeds, offset, checkpoint
+        )
+
+    async def _iter_follows(
+        self, fetch, kind, page_size, concurrency, feeds, offset, checkpoint
+    ):
+        checkpoint, offset = self._follows_start(offset, checkpoint)
+        total = None
+        if feeds is None:
+            stats = await self.client.follow_stats(self.id)
+            total = self._follow_stats_count(stats, kind)
+
+        # follows added during the crawl shift the pages, the ones already
+        # seen at the end of the previous page come again
+        previous = set()
+        full = True
+        while full:
+            offsets = self._follows_offsets(offset, total, page_size, concurrency)
+            pages = async_map_concurrently(fetch, offsets, concurrency)
+            try:
+                async for page_offset, page, exception in pages:
+                    if exception is not None:
+                        raise exception
+                    keys = set()
+                    for follow in page:
+                        key = (follow["feed_id"], follow["target_id"])
+                        keys.add(key)
+                        if key not in previous:
+                            yield follow
+                    previous = keys
+                    offset = page_offset + len(page)
+                    if checkpoint is not None:
+                        checkpoint.save(offset)
+                    full = len(page) == page_size
+                    if not full:
+                        break
+            finally:
+                await pages.aclose()
+
+    async def reconcile_following(
+        self,
+        targets,
+        activity_copy_limit=None,
+        keep_history=False,
+        dry_run=False,
+        page_size=500,
+    ):
+        current = []
+        while True:
+            response = await self.following(offset=len(current), limit=page_size)
+            current.extend(f["target_id"] for f in response["results"])
+            if len(response["results"]) < page_size:
+                break
+
+        follow, unfollow, unchanged = self._following_diff(current, targets)
+        if dry_run or not (follow or unfollow):
+            return self._reconcile_result(follow, unfollow, unchanged)
+
+        follows, unfollows = self._follow_edges(follow, unfollow, keep_history)
+        results = [
+            await self.client.bulk_unfollow(unfollows),
+            await self.client.bulk_follow(follows, activity_copy_limit),
+        ]
+        self._invalidate_cache()
+        return self._reconcile_result(follow, unfollow, unchanged, results)
+
     async def update_activity_to_targets(
         self,
         foreign_id,
@@ -0,0 +1,214 @@
+import asyncio
+import contextvars
+import threading
+import weakref
+from concurrent.futures import Future
+
+from stream.bulk import (
+    MAX_QUERY_BYTES,
+    async_map_concurrently,
+    chunked,
+    map_concurrently,
+    query_size,
+)
+from stream.deadline import detach_deadline
+
+"""
+Batching of the lookups by id made independently from each other
+
+Every caller asks a loader for a single id and gets a future. The loader
+collects the ids asked for until the results are needed, dedupes them,
+fetches them with as few requests as the url length allows and resolves
+every future with its own result, None when the id wasn't found.
+
+Async loaders are shared by the coroutines of an event loop and fetch once
+per loop iteration. Sync loaders are shared by the code running in the same
+context (ie. one thread) and fetch when a result is first asked for.
+"""
+
+_context_loaders = contextvars.ContextVar("stream_loaders", default=None)
+_loop_loaders = weakref.WeakKeyDictionary()
+
+
+class BaseLoader:
+    """
+    :param fetch: called with a list of ids, returns the results by id
+    :param max_bytes: the maximum size of the comma separated ids of a request
+    :param max_count: the maximum number of ids in a request
+    :param concurrency: how many requests are sent at the same time
+    """
+
+    def __init__(self, fetch, max_bytes=MAX_QUERY_BYTES, max_count=100, concurrency=4):
+        self.fetch = fetch
+        self.max_bytes = max_bytes
+        self.max_count = max_count
+        self.concurrency = concurrency
+        self.loads = 0
+        self.requests = 0
+        self._pending = {}
+
+    def _chunks(self, ids):
+        chunks = list(chunked(ids, self.max_count, self.max_bytes, measure=query_size))
+        self.requests += len(chunks)
+        return chunks
+
+    def _resolve(self, pending, chunk, results, exception):
+        for id in chunk:
+            future = pending[id]
+            if future.done():
+                continue
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(results.get(id))
+
+    def stats(self):
+        """
+        Returns the number of ids asked for and of requests sent
+        """
+        return {"loads": self.loads, "requests": self.requests}
+
+
+class LoaderFuture(Future):
+    """
+    Future of a sync loader, the pending ids are sent when its result or
+    exception is asked for or a callback is added to it
+
+    concurrent.futures.wait and as_completed wait without asking, call
+    loader.dispatch() before passing them futures which aren't done.
+    """
+
+    def __init__(self, loader):
+        super().__init__()
+        self.loader = loader
+
+    def result(self, timeout=None):
+        # the first result asked for sends all the pending ids
+        if not self.done():
+            self.loader.dispatch()
+        return super().result(timeout)
+
+    def exception(self, timeout=None):
+        if not self.done():
+            self.loader.dispatch()
+        return super().exception(timeout)
+
+    def add_done_callback(self, fn):
+        # the callback would otherwise wait for a dispatch nobody asks for
+        if not self.done():
+            self.loader.dispatch()
+        super().add_done_callback(fn)
+
+
+class Loader(BaseLoader):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+
+    def load(self, id):
+        """
+        Returns a future resolving to the result for id
+        """
+        id = str(id)
+        with self._lock:
+            self.loads += 1
+            future = self._pending.get(id)
+            if future is None:
+                future = self._pending[id] = LoaderFuture(self)
+        return future
+
+    def load_many(self, ids):
+        """
+        Returns the results for ids, in the same order
+        """
+        futures = [self.load(id) for id in ids]
+        return [f.result() for f in futures]
+
+    def dispatch(self):
+        """
+        Fetches all the pending ids
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        chunks = self._chunks(list(pending))
+        if len(chunks) == 1:
+            try:
+                self._resolve(pending, chunks[0], self.fetch(chunks[0]), None)
+            except Exception as e:
+                self._resolve(pending, chunks[0], None, e)
+            return
+        for chunk, results, exception in map_concurrently(
+            self.fetch, chunks, self.concurrency
+        ):
+            self._resolve(pending, chunk, results, exception)
+
+
+class AsyncLoader(BaseLoader):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._tasks = set()
+
+    def load(self, id):
+        """
+        Returns an awaitable resolving to the result for id
+        """
+        id = str(id)
+        self.loads += 1
+        future = self._pending.get(id)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            if not self._pending:
+                # runs after the coroutines which are ready in this iteration
+                loop.call_soon(self.dispatch)
+            future = self._pending[id] = loop.create_future()
+        return future
+
+    async def load_many(self, ids):
+        return list(await asyncio.gather(*[self.load(id) for id in ids]))
+
+    def dispatch(self):
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        task = asyncio.ensure_future(self._send(pending))
+        # the loop only keeps weak references to its tasks
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, pending):
+        # the requests serve many callers, not only the one which
+        # scheduled them
+        detach_deadline()
+        chunks = self._chunks(list(pending))
+        outcomes = async_map_concurrently(self.fetch, chunks, self.concurrency)
+        async for chunk, results, exception in outcomes:
+            self._resolve(pending, chunk, results, exception)
+
+
+def context_loader(key, fetch, **options):
+    """
+    Returns the Loader stored for key in the current context, creates it
+    with fetch and options the first time
+    """
+    loaders = _context_loaders.get()
+    if loaders is None:
+        loaders = {}
+        _context_loaders.set(loaders)
+    loader = loaders.get(key)
+    if loader is None:
+        loader = loaders[key] = Loader(fetch, **options)
+    return loader
+
+
+def loop_loader(key, fetch, **options):
+    """
+    Returns the AsyncLoader stored for key in the running event loop,
+    creates it with fetch and options the first time
+    """
+    loaders = _loop_loaders.setdefault(asyncio.get_running_loop(), {})
+    loader = loaders.get(key)
+    if loader is None:
+        loader = loaders[key] = AsyncLoader(fetch, **options)
+    return loader
@@ -1,4 +1,8 @@
+import contextlib
 from abc import ABC, abstractmethod
+from urllib.parse import parse_qs, urlparse
+
+from stream import serializer
 
 
 class AbstractReactions(ABC):
@@ -46,6 +50,62 @@ class AbstractReactions(ABC):
     def filter(self, **params):
         pass
 
+    @abstractmethod
+    def iter_filter(self, page_size=25, with_activity_data=False, **params):
+        """
+        Iterates over all the reactions matching the filter params, following
+        the next cursor of the responses
+
+        :param page_size: how many reactions are fetched in one request
+        :param with_activity_data: add the activity the reactions belong to,
+         under the activity key of every reaction, when filtering by
+         activity_id
+
+        The next page is fetched while the current one is consumed. The
+        async reactions return an async iterator.
+
+        **Example**::
+
+            for reaction in client.reactions.iter_filter(
+                activity_id=activity_id, kind="comment"
+            ):
+                print(reaction["data"])
+        """
+        pass
+
+    @abstractmethod
+    def export_filter(self, sink, page_size=25, with_activity_data=False, **params):
+        """
+        Writes all the reactions matching the filter params to sink as json
+        lines and returns how many were written
+
+        :param sink: a path or a file opened for writing text
+
+        Only the page being written is held in memory.
+        """
+        pass
+
+    @abstractmethod
+    def add_many(self, reactions, concurrency=4, retries=2, check_references=True):
+        """
+        Adds any number of reactions with concurrent requests
+
+        :param reactions: an iterable of dicts with the arguments of add, or of
+         add_child when they have a parent_id, consumed lazily
+        :param concurrency: how many requests are sent at the same time
+        :param retries: how many times a reaction is sent again when it
+         couldn't reach the API (connection errors and rate limits), never
+         after a timeout or a server error which could have added it already,
+         as a reaction sent twice is added twice
+        :param check_references: fetch the SU: and SO: references found in the
+         data of the reactions, each one once, and fail the reactions whose
+         references don't exist instead of adding them
+
+        Returns the added reactions in input order, None for the failed ones,
+        the failed reactions and their exceptions.
+        """
+        pass
+
 
 class BaseReactions(AbstractReactions, ABC):
     API_ENDPOINT = "reaction/"
@@ -76,3 +136,78 @@ class BaseReactions(AbstractReactions, ABC):
             endpoint += f"{kind}/"
 
         return endpoint
+
+    def _filter_params(self, params, page_size, with_activity_data):
+        params = dict(params, limit=page_size)
+        if with_activity_data:
+            params["with_activity_data"] = True
+        return params
+
+    def _next_params(self, params, response):
+        """
+        Returns the params of the page after response, None on the last page
+        """
+        next_url = response.get("next")
+        if not next_url or not response.get("results"):
+            return None
+        query = parse_qs(urlparse(next_url).query)
+        cursors = {k: v[0] for k, v in query.items() if k.startswith("id_")}
+        if not cursors:
+            return None
+        params = {k: v for k, v in params.items() if not k.startswith("id_")}
+        params.update(cursors)
+        return params
+
+    def _page_reactions(self, response):
+        activity = response.get("activity")
+        if activity is None:
+            return response["results"]
+        return [dict(r, activity=activity) for r in response["results"]]
+
+    def _sink(self, sink):
+        if isinstance(sink, str):
+            return open(sink, "w")
+        # the caller's file stays open
+        return contextlib.nullcontext(sink)
+
+    def _write_reactions(self, f, reactions):
+        for reaction in reactions:
+            f.write(serializer.dumps(reaction) + "\n")
+        return len(reactions)
+
+    def _add_reaction(self, reaction):
+        if "parent_id" in reaction:
+            return self.add_child(**reaction)
+        return self.add(**reaction)
+
+    def _references(self, value, found=None):
+        """
+        Returns the set of user and collection references in value
+        """
+        found = set() if found is None else found
+        if isinstance(value, str):
+            if value.startswith(("SU:", "SO:")):
+                found.add(value)
+        elif isinstance(value, dict):
+            for item in value.values():
+                self._references(item, found)
+        elif isinstance(value, (list, tuple)):
+            for item in value:
+                self._references(item, found)
+        return found
+
+    def _reference_lookup(self, reference):
+        """
+        Returns the client method fetching what reference points to and its
+        arguments
+        """
+        kind, _, rest = reference.partition(":")
+        if kind == "SU":
+            return self.client.users.get, (rest,)
+        collection_name, _, id = rest.partition(":")
+        return self.client.collections.get, (collection_name, id)
+
+    def _add_many_result(self, report, responses):
+        result = report.result("failed_reactions")
+        result["reactions"] = responses
+        return result
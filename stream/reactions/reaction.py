@@ -1,3 +1,15 @@
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from stream.bulk import (
+    BulkReport,
+    async_call_with_retries,
+    async_map_concurrently,
+    call_with_retries,
+    map_concurrently,
+)
 from stream.reactions.base import BaseReactions
 
 
@@ -90,6 +102,76 @@ class Reactions(BaseReactions):
             params=params,
         )
 
+    def iter_filter(self, page_size=25, with_activity_data=False, **params):
+        for page in self._iter_pages(page_size, with_activity_data, params):
+            yield from page
+
+    def export_filter(self, sink, page_size=25, with_activity_data=False, **params):
+        count = 0
+        with self._sink(sink) as f:
+            for page in self._iter_pages(page_size, with_activity_data, params):
+                count += self._write_reactions(f, page)
+        return count
+
+    def _iter_pages(self, page_size, with_activity_data, params):
+        def prefetch(page_params):
+            context = contextvars.copy_context()
+            return executor.submit(context.run, self.filter, **page_params)
+
+        executor = ThreadPoolExecutor(1)
+        page_params = self._filter_params(params, page_size, with_activity_data)
+        future = prefetch(page_params)
+        try:
+            while future is not None:
+                response = future.result()
+                page_params = self._next_params(page_params, response)
+                future = None if page_params is None else prefetch(page_params)
+                yield self._page_reactions(response)
+        finally:
+            if future is not None:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def add_many(self, reactions, concurrency=4, retries=2, check_references=True):
+        lock = threading.Lock()
+        resolved = {}
+
+        def resolve(reference):
+            # the first reaction using a reference fetches it, the others
+            # wait for the same outcome
+            with lock:
+                future = resolved.get(reference)
+                leader = future is None
+                if leader:
+                    future = resolved[reference] = Future()
+            if leader:
+                get, args = self._reference_lookup(reference)
+                try:
+                    future.set_result(call_with_retries(lambda: get(*args), retries))
+                except Exception as e:
+                    future.set_exception(e)
+            return future.result()
+
+        def add(reaction):
+            if check_references:
+                data = [reaction.get("data"), reaction.get("target_feeds_extra_data")]
+                for reference in sorted(self._references(data)):
+                    resolve(reference)
+            # reactions have no idempotency key, one which may have been
+            # added is never sent again
+            return call_with_retries(
+                lambda: self._add_reaction(reaction), retries, idempotent=False
+            )
+
+        report = BulkReport()
+        responses = []
+        for reaction, response, exception in map_concurrently(
+            add, reactions, concurrency
+        ):
+            report.add([reaction], [], exception)
+            responses.append(response)
+        return self._add_many_result(report, responses)
+
 
 class AsyncReactions(BaseReactions):
     async def add(
@@ -179,3 +261,68 @@ class AsyncReactions(BaseReactions):
             signature=self.token,
             params=params,
         )
+
+    def iter_filter(self, page_size=25, with_activity_data=False, **params):
+        return self._iter_reactions(page_size, with_activity_data, params)
+
+    async def _iter_reactions(self, page_size, with_activity_data, params):
+        async for page in self._iter_pages(page_size, with_activity_data, params):
+            for reaction in page:
+                yield reaction
+
+    async def export_filter(
+        self, sink, page_size=25, with_activity_data=False, **params
+    ):
+        count = 0
+        with self._sink(sink) as f:
+            pages = self._iter_pages(page_size, with_activity_data, params)
+            async for page in pages:
+                count += self._write_reactions(f, page)
+        return count
+
+    async def _iter_pages(self, page_size, with_activity_data, params):
+        page_params = self._filter_params(params, page_size, with_activity_data)
+        task = asyncio.ensure_future(self.filter(**page_params))
+        try:
+            while task is not None:
+                response = await task
+                page_params = self._next_params(page_params, response)
+                task = None
+                if page_params is not None:
+                    task = asyncio.ensure_future(self.filter(**page_params))
+                yield self._page_reactions(response)
+        finally:
+            if task is not None:
+                task.cancel()
+
+    async def add_many(
+        self, reactions, concurrency=4, retries=2, check_references=True
+    ):
+        resolved = {}
+
+        async def resolve(reference):
+            task = resolved.get(reference)
+            if task is None:
+                get, args = self._reference_lookup(reference)
+                task = resolved[reference] = asyncio.ensure_future(
+                    async_call_with_retries(lambda: get(*args), retries)
+                )
+            # a cancelled reaction must not cancel the lookup for the others
+            return await asyncio.shield(task)
+
+        async def add(reaction):
+            if check_references:
+                data = [reaction.get("data"), reaction.get("target_feeds_extra_data")]
+                for reference in sorted(self._references(data)):
+                    await resolve(reference)
+            return await async_call_with_retries(
+                lambda: self._add_reaction(reaction), retries, idempotent=False
+            )
+
+        report = BulkReport()
+        responses = []
+        outcomes = async_map_concurrently(add, reactions, concurrency)
+        async for reaction, response, exception in outcomes:
+            report.add([reaction], [], exception)
+            responses.append(response)
+        return self._add_many_result(report, responses)
@@ -0,0 +1,112 @@
+import asyncio
+import contextvars
+import copy
+import threading
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from stream.deadline import detach_deadline, remaining_time
+from stream.exceptions import DeadlineExceeded
+
+"""
+Coalescing of identical concurrent calls
+
+When many threads or coroutines ask for the same resource at the same time
+only the first caller performs the request, the others wait for it. Every
+caller gets its own copy of the parsed result, so one changing it never
+affects the others. Failures are shared as well.
+
+The shared request is not limited by the deadline of the caller which
+started it, every caller only bounds its own wait with its own deadline.
+"""
+
+
+class BaseSingleFlight:
+    def __init__(self):
+        self.executed = 0
+        self.coalesced = 0
+
+    def stats(self):
+        """
+        Returns the number of calls that hit the network and the number of
+        calls which were served by an identical call already in flight
+        """
+        return {"executed": self.executed, "coalesced": self.coalesced}
+
+
+class SingleFlight(BaseSingleFlight):
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Future()
+                self.executed += 1
+            else:
+                self.coalesced += 1
+
+        if leader:
+            # the request serves every caller, it runs detached from the
+            # deadline of the first one
+            context = contextvars.copy_context()
+            threading.Thread(
+                target=context.run, args=(self._run, key, call, fn), daemon=True
+            ).start()
+        try:
+            result = call.result(timeout=remaining_time())
+        except FutureTimeoutError:
+            raise DeadlineExceeded("the deadline for this operation has passed")
+        # the result kept by the call stays pristine, every caller, the
+        # first one included, may change the copy it gets
+        return copy.deepcopy(result)
+
+    def _run(self, key, call, fn):
+        detach_deadline()
+        try:
+            result = fn()
+        except BaseException as e:
+            call.set_exception(e)
+        else:
+            call.set_result(result)
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+class AsyncSingleFlight(BaseSingleFlight):
+    def __init__(self):
+        super().__init__()
+        self._calls = {}
+
+    async def do(self, key, fn):
+        # futures are bound to their event loop, calls are only shared
+        # between coroutines running on the same loop
+        key = (id(asyncio.get_running_loop()), key)
+        task = self._calls.get(key)
+        leader = task is None
+        if leader:
+            task = self._calls[key] = asyncio.ensure_future(self._run(fn))
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+            self.executed += 1
+        else:
+            self.coalesced += 1
+
+        # a cancelled caller must not cancel the request for the others
+        try:
+            result = await asyncio.wait_for(asyncio.shield(task), remaining_time())
+        except asyncio.TimeoutError:
+            if task.done():
+                raise
+            raise DeadlineExceeded("the deadline for this operation has passed")
+        return copy.deepcopy(result)
+
+    async def _run(self, fn):
+        # the task has its own copy of the context, the deadline of the
+        # caller which started it is only removed from that copy
+        detach_deadline()
+        return await fn()
@@ -0,0 +1,578 @@
+import asyncio
+import json
+import os
+import threading
+import time
+
+from stream import serializer
+from stream.bulk import _is_rejection, is_unsent
+from stream.deadline import detach_deadline
+
+"""
+Durable queue of analytics events and write operations
+
+Operations are appended to segment files in a local directory and sent
+later in batches, when the process restarts or the API is reachable again.
+Records hold the name of the operation and its arguments, never the auth
+tokens, which are created again when the operations are replayed.
+
+A segment is a file of json lines, new records are appended to the last
+segment and a new one starts when it is full. The position of the first
+record not sent yet is stored in a cursor file and the segments before it
+are deleted.
+
+Records are sent at least once: one which failed with an error that leaves
+it applied or not is sent again. Adding activities without foreign_id and
+time isn't idempotent, those records are sent at most once. They are only
+kept when the API never got them (connection errors and rate limits), after
+a timeout or a server error they are counted as failed.
+"""
+
+# operations taking a list, consecutive records of the same one are sent
+# together
+LIST_OPERATIONS = (
+    "track_impressions",
+    "track_engagements",
+    "update_activities",
+    "activities_partial_update",
+    "follow_many",
+    "unfollow_many",
+)
+OPERATIONS = LIST_OPERATIONS + ("add_activities", "add_to_many")
+
+# add_to_many is replayed one chunk at a time, with the chunks it sends
+ADD_TO_MANY_CHUNK_SIZE = 1000
+ADD_TO_MANY_MAX_BYTES = 512 * 1024
+
+SEGMENT_SUFFIX = ".log"
+CURSOR_FILE = "cursor.json"
+
+
+def _idempotent(operation, argument):
+    """
+    Returns True when sending the argument of operation twice has no effect
+    """
+    if operation == "add_activities":
+        activities = argument
+    elif operation == "add_to_many":
+        activities = [argument["activity"]]
+    else:
+        return True
+    # the API replaces an activity with the same foreign_id and time
+    return all(a.get("foreign_id") and a.get("time") for a in activities)
+
+
+class BaseSpool:
+    """
+    :param client: the client replaying the operations
+    :param directory: where the segments are stored, created if needed
+    :param segment_size: the size in bytes after which a new segment starts
+    :param max_size: the disk space the segments may use, when it is used up
+     records are dropped following the drop policy
+    :param fsync: "always" syncs every append to disk, "interval" at most
+     once every fsync_interval seconds and "never" leaves it to the system
+    :param drop: "oldest" drops the oldest segment to make room for new
+     records, "newest" drops the new records
+    :param batch_size: how many items are sent in one request on replay
+    """
+
+    def __init__(
+        self,
+        client,
+        directory,
+        segment_size=16 * 1024 * 1024,
+        max_size=256 * 1024 * 1024,
+        fsync="interval",
+        fsync_interval=1.0,
+        drop="oldest",
+        batch_size=100,
+    ):
+        if fsync not in ("always", "interval", "never"):
+            raise ValueError("fsync must be 'always', 'interval' or 'never'")
+        if drop not in ("oldest", "newest"):
+            raise ValueError("drop must be 'oldest' or 'newest'")
+        self.client = client
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.drop = drop
+        self.batch_size = batch_size
+        self.appended = 0
+        self.replayed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.respooled = 0
+        self._lock = threading.Lock()
+        self._file = None
+        self._file_segment = None
+        self._synced_at = time.monotonic()
+        os.makedirs(directory, exist_ok=True)
+        self._cursor = self._load_cursor()
+        self._segments = self._list_segments()
+        self._sizes = {s: os.path.getsize(self._path(s)) for s in self._segments}
+        if self._segments:
+            self._repair(self._segments[-1])
+
+    def _path(self, segment):
+        return os.path.join(self.directory, f"{segment:012d}{SEGMENT_SUFFIX}")
+
+    def _list_segments(self):
+        segments = sorted(
+            int(name[: -len(SEGMENT_SUFFIX)])
+            for name in os.listdir(self.directory)
+            if name.endswith(SEGMENT_SUFFIX)
+        )
+        for segment in segments:
+            # sent, a crash happened before they were removed
+            if segment < self._cursor[0]:
+                os.remove(self._path(segment))
+        return [s for s in segments if s >= self._cursor[0]]
+
+    def _load_cursor(self):
+        try:
+            with open(os.path.join(self.directory, CURSOR_FILE)) as f:
+                cursor = json.load(f)
+        except FileNotFoundError:
+            return (0, 0)
+        return (cursor["segment"], cursor["offset"])
+
+    def _save_cursor(self, cursor):
+        path = os.path.join(self.directory, CURSOR_FILE)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"segment": cursor[0], "offset": cursor[1]}, f)
+            if self.fsync != "never":
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        self._cursor = cursor
+
+    def _repair(self, segment):
+        # a crash can leave half of a record at the end of the last segment
+        path = self._path(segment)
+        with open(path, "rb+") as f:
+            data = f.read()
+            end = data.rfind(b"\n") + 1
+            if end != len(data):
+                f.truncate(end)
+                self._sizes[segment] = end
+
+    def _open_segment(self, record_size):
+        if self._segments:
+            segment = self._segments[-1]
+            size = self._sizes[segment]
+            if size and size + record_size > self.segment_size:
+                segment += 1
+        else:
+            # the cursor is at the end of a segment which was removed
+            segment = self._cursor[0] + (1 if self._cursor[1] else 0)
+        if segment not in self._sizes:
+            self._segments.append(segment)
+            self._sizes[segment] = 0
+        if self._file_segment != segment:
+            if self._file is not None:
+                self._sync(force=True)
+                self._file.close()
+            self._file = open(self._path(segment), "ab")
+            self._file_segment = segment
+        return segment
+
+    def _make_room(self, record_size):
+        """
+        Returns False when the record has to be dropped
+        """
+        while sum(self._sizes.values()) + record_size > self.max_size:
+            if self.drop == "newest" or len(self._segments) < 2:
+                return False
+            oldest = self._segments.pop(0)
+            with open(self._path(oldest), "rb") as f:
+                if oldest == self._cursor[0]:
+                    f.seek(self._cursor[1])
+                self.dropped += sum(1 for _ in f)
+            del self._sizes[oldest]
+            os.remove(self._path(oldest))
+            self._save_cursor((self._segments[0], 0))
+        return True
+
+    def _sync(self, force=False):
+        if self._file is None or self.fsync == "never":
+            return
+        now = time.monotonic()
+        if (
+            force
+            or self.fsync == "always"
+            or now - self._synced_at >= self.fsync_interval
+        ):
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._synced_at = now
+
+    def append(self, operation, payload):
+        """
+        Stores an operation, payload holds its arguments
+        """
+        self.append_many([(operation, payload)])
+
+    def append_many(self, records):
+        """
+        Stores the (operation, payload) records with one write and one sync
+        """
+        lines = []
+        for operation, payload in records:
+            if operation not in OPERATIONS:
+                raise ValueError(f"{operation} can't be spooled")
+            line = serializer.dumps({"op": operation, "payload": payload}) + "\n"
+            lines.append(line.encode("utf-8"))
+        with self._lock:
+            for line in lines:
+                if not self._make_room(len(line)):
+                    self.dropped += 1
+                    continue
+                segment = self._open_segment(len(line))
+                self._file.write(line)
+                self._sizes[segment] += len(line)
+                self.appended += 1
+            if self._file is not None:
+                self._file.flush()
+                self._sync()
+
+    def track_impressions(self, impressions):
+        self.append("track_impressions", impressions)
+
+    def track_engagements(self, engagements):
+        self.append("track_engagements", engagements)
+
+    def update_activities(self, activities):
+        self.append("update_activities", activities)
+
+    def activities_partial_update(self, updates):
+        self.append("activities_partial_update", updates)
+
+    def follow_many(self, follows):
+        self.append("follow_many", follows)
+
+    def unfollow_many(self, unfollows):
+        self.append("unfollow_many", unfollows)
+
+    def add_activities(self, feed_id, activities):
+        self.append("add_activities", {"feed_id": feed_id, "activities": activities})
+
+    def add_to_many(self, activity, feeds):
+        self.append("add_to_many", {"activity": activity, "feeds": feeds})
+
+    def _read(self, limit):
+        """
+        Returns up to limit (operation, payload, end position) records
+        from the cursor on
+        """
+        records = []
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+            segment, offset = self._cursor
+            for s in self._segments:
+                if s < segment:
+                    continue
+                with open(self._path(s), "rb") as f:
+                    f.seek(offset if s == segment else 0)
+                    for line in f:
+                        record = serializer.loads(line.decode("utf-8"))
+                        records.append((record["op"], record["payload"], (s, f.tell())))
+                        if len(records) >= limit:
+                            return records
+        return records
+
+    def _batches(self, records):
+        """
+        Groups consecutive records which can be sent with one request, yields
+        (operation, key, argument, records)
+        """
+        batch = None
+        for record in records:
+            operation, payload, _ = record
+            if operation in LIST_OPERATIONS:
+                key, items = operation, list(payload)
+            elif operation == "add_activities":
+                key, items = payload["feed_id"], list(payload["activities"])
+            else:
+                key, items = None, payload
+            if (
+                batch is not None
+                and key is not None
+                and (operation, key) == tuple(batch[:2])
+                and len(batch[2]) + len(items) <= self.batch_size
+            ):
+                batch[2].extend(items)
+                batch[3].append(record)
+                continue
+            if batch is not None:
+                yield tuple(batch)
+            batch = [operation, key, items, [record]]
+        if batch is not None:
+            yield tuple(batch)
+
+    def _send(self, operation, key, argument):
+        if operation == "add_activities":
+            feed_slug, user_id = key.split(":", 1)
+            return self.client.feed(feed_slug, user_id).add_activities(argument)
+        return getattr(self.client, operation)(argument)
+
+    def _advance(self, position):
+        with self._lock:
+            self._save_cursor(position)
+            # the segments before the cursor were sent
+            while self._segments and self._segments[0] < position[0]:
+                segment = self._segments.pop(0)
+                del self._sizes[segment]
+                os.remove(self._path(segment))
+
+    def _add_to_many_chunks(self, payload):
+        return self.client._add_to_many_chunks(
+            payload["activity"],
+            payload["feeds"],
+            ADD_TO_MANY_CHUNK_SIZE,
+            ADD_TO_MANY_MAX_BYTES,
+        )
+
+    def _keep(self, exception, idempotent):
+        """
+        Returns True when what failed with exception has to be sent again
+        """
+        if _is_rejection(exception):
+            # the API will never accept it, it must not block the others
+            return False
+        # a write which isn't idempotent may have been applied already
+        return idempotent or is_unsent(exception)
+
+    def _add_to_many_done(self, payload, unsent, lost, records):
+        """
+        Advances the cursor past an add_to_many record, the feeds of the
+        chunks which didn't reach the API are stored again as a new record,
+        returns False when none of the chunks did
+        """
+        if len(unsent) == len(payload["feeds"]):
+            return False
+        if unsent:
+            self.respooled += len(unsent)
+            self.append(
+                "add_to_many", {"activity": payload["activity"], "feeds": unsent}
+            )
+        if lost:
+            self.failed += len(records)
+        else:
+            self.replayed += len(records)
+        self._advance(records[-1][2])
+        return True
+
+    def _done(self, records, exception, idempotent=True):
+        """
+        Advances the cursor past the records, returns False when they have
+        to be sent again later
+        """
+        if exception is None:
+            self.replayed += len(records)
+        elif self._keep(exception, idempotent):
+            return False
+        else:
+            self.failed += len(records)
+        self._advance(records[-1][2])
+        return True
+
+    def pending(self):
+        """
+        Returns the number of bytes of the records not sent yet
+        """
+        with self._lock:
+            return sum(self._sizes.values()) - (
+                self._cursor[1] if self._cursor[0] in self._sizes else 0
+            )
+
+    def stats(self):
+        return {
+            "appended": self.appended,
+            "replayed": self.replayed,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "respooled": self.respooled,
+            "segments": len(self._segments),
+            "pending_bytes": self.pending(),
+        }
+
+    def _close_file(self):
+        with self._lock:
+            if self._file is not None:
+                self._sync(force=True)
+                self._file.close()
+                self._file = None
+                self._file_segment = None
+
+
+class Spool(BaseSpool):
+    """
+    Stores operations on disk and replays them with the client
+
+    **Example**::
+
+        spool = client.spool('/var/spool/stream')
+        spool.replay()  # what a previous process left
+        spool.start(interval=5)
+        spool.track_impressions(impressions)
+        spool.add_activities('user:1', [activity_data])
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def replay(self):
+        """
+        Sends the stored operations in order until they are all sent or the
+        API can't be reached, returns the number of records sent
+        """
+        replayed = self.replayed
+        while True:
+            records = self._read(self.batch_size * 4)
+            if not records:
+                return self.replayed - replayed
+            for batch in self._batches(records):
+                if not self._replay_batch(*batch):
+                    return self.replayed - replayed
+
+    def _replay_batch(self, operation, key, argument, records):
+        if operation == "add_to_many":
+            return self._replay_add_to_many(argument, records)
+        try:
+            self._send(operation, key, argument)
+        except Exception as e:
+            if len(records) > 1 and _is_rejection(e):
+                # sent one by one, only the records refused are skipped
+                return all(
+                    self._replay_batch(*next(self._batches([record])))
+                    for record in records
+                )
+            return self._done(records, e, _idempotent(operation, argument))
+        return self._done(records, None)
+
+    def _replay_add_to_many(self, payload, records):
+        # add_to_many reports the feeds of its failed chunks without telling
+        # which error failed them, each chunk is sent on its own instead
+        idempotent = _idempotent("add_to_many", payload)
+        unsent = []
+        lost = False
+        for chunk in self._add_to_many_chunks(payload):
+            if unsent:
+                # the API can't be reached, the next chunks wait as well
+                unsent.extend(chunk)
+                continue
+            try:
+                self.client.add_to_many(payload["activity"], chunk)
+            except Exception as e:
+                if self._keep(e, idempotent):
+                    unsent.extend(chunk)
+                else:
+                    lost = True
+        return self._add_to_many_done(payload, unsent, lost, records)
+
+    def start(self, interval=5.0):
+        """
+        Replays the stored operations every interval seconds from a daemon
+        thread
+        """
+        if self._thread is not None:
+            return
+
+        def run():
+            while not self._stop.wait(interval):
+                try:
+                    self.replay()
+                except Exception:
+                    # records the API refuses are skipped by replay, this is
+                    # a local failure, try again at the next interval
+                    pass
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """
+        Stops replaying and syncs the last segment to disk
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._close_file()
+
+
+class AsyncSpool(BaseSpool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._task = None
+
+    async def replay(self):
+        replayed = self.replayed
+        while True:
+            records = self._read(self.batch_size * 4)
+            if not records:
+                return self.replayed - replayed
+            for batch in self._batches(records):
+                if not await self._replay_batch(*batch):
+                    return self.replayed - replayed
+
+    async def _replay_batch(self, operation, key, argument, records):
+        if operation == "add_to_many":
+            return await self._replay_add_to_many(argument, records)
+        try:
+            await self._send(operation, key, argument)
+        except Exception as e:
+            if len(records) > 1 and _is_rejection(e):
+                for record in records:
+                    batch = next(self._batches([record]))
+                    if not await self._replay_batch(*batch):
+                        return False
+                return True
+            return self._done(records, e, _idempotent(operation, argument))
+        return self._done(records, None)
+
+    async def _replay_add_to_many(self, payload, records):
+        idempotent = _idempotent("add_to_many", payload)
+        unsent = []
+        lost = False
+        for chunk in self._add_to_many_chunks(payload):
+            if unsent:
+                unsent.extend(chunk)
+                continue
+            try:
+                await self.client.add_to_many(payload["activity"], chunk)
+            except Exception as e:
+                if self._keep(e, idempotent):
+                    unsent.extend(chunk)
+                else:
+                    lost = True
+        return self._add_to_many_done(payload, unsent, lost, records)
+
+    def start(self, interval=5.0):
+        if self._task is not None:
+            return
+
+        async def run():
+            detach_deadline()
+            while True:
+                await asyncio.sleep(interval)
+                try:
+                    await self.replay()
+                except Exception:
+                    pass
+
+        self._task = asyncio.ensure_future(run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._close_file()
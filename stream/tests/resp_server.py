@@ -0,0 +1,98 @@
+import fnmatch
+import socketserver
+import threading
+import time
+
+
+class RESPStandIn(socketserver.ThreadingTCPServer):
+    """
+    A tiny in-memory server speaking the subset of RESP used by RESPCache
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), RESPHandler)
+        self.data = {}
+        self.lock = threading.Lock()
+        self.commands = []
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class RESPHandler(socketserver.StreamRequestHandler):
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        command = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            command.append(self.rfile.read(length + 2)[:-2])
+        return command
+
+    def write(self, reply):
+        if reply is None:
+            self.wfile.write(b"$-1\r\n")
+        elif isinstance(reply, Exception):
+            self.wfile.write(b"-%s\r\n" % str(reply).encode())
+        elif isinstance(reply, int):
+            self.wfile.write(b":%d\r\n" % reply)
+        elif isinstance(reply, str):
+            self.wfile.write(b"+%s\r\n" % reply.encode())
+        elif isinstance(reply, list):
+            self.wfile.write(b"*%d\r\n" % len(reply))
+            for item in reply:
+                self.write(item)
+        else:
+            self.wfile.write(b"$%d\r\n%s\r\n" % (len(reply), reply))
+
+    def lookup(self, key):
+        value, expires_at = self.server.data.get(key, (None, None))
+        if expires_at is not None and expires_at <= time.monotonic():
+            self.server.data.pop(key, None)
+            return None
+        return value
+
+    def handle(self):
+        while True:
+            command = self.read_command()
+            if command is None:
+                return
+            name = command[0].upper().decode()
+            self.server.commands.append(name)
+            with self.server.lock:
+                self.write(self.execute(name, command[1:]))
+
+    def execute(self, name, args):
+        data = self.server.data
+        if name in ("PING", "SELECT"):
+            return "OK"
+        if name == "GET":
+            return self.lookup(args[0])
+        if name == "MGET":
+            return [self.lookup(key) for key in args]
+        if name == "SET":
+            expires_at = None
+            if len(args) == 4 and args[2].upper() == b"PX":
+                expires_at = time.monotonic() + int(args[3]) / 1000
+            data[args[0]] = (args[1], expires_at)
+            return "OK"
+        if name == "DEL":
+            return sum(data.pop(key, None) is not None for key in args)
+        if name == "SCAN":
+            pattern = args[2].decode() if len(args) > 2 else "*"
+            keys = [k for k in data if fnmatch.fnmatchcase(k.decode(), pattern)]
+            return [b"0", keys]
+        return ValueError(f"ERR unknown command '{name}'")
@@ -8,7 +8,13 @@ import pytz
 from dateutil.tz import tzlocal
 
 import stream
-from stream.exceptions import ApiKeyException, InputException, DoesNotExistException
+from stream.analytics import in_sample
+from stream.exceptions import (
+    ApiKeyException,
+    DeadlineExceeded,
+    DoesNotExistException,
+    InputException,
+)
 
 
 def assert_first_activity_id_equal(activities, correct_activity_id):
@@ -1379,3 +1385,424 @@ async def test_follow_stats(async_client):
     result = response["results"]
     assert result["following"]["count"] == 0
     assert result["followers"]["count"] == 1
+
+
+@pytest.mark.asyncio
+async def test_timeouts():
+    client = stream.connect(
+        "key", "secret", timeout=3.0, read_timeout=1.0, use_async=True
+    )
+    assert client.get_timeouts() == (3.0, 3.0, 1.0)
+    assert client.get_timeouts(timeout=0.5) == (0.5, 0.5, 0.5)
+
+    with client.deadline(2.0):
+        total, connect_timeout, read_timeout = client.get_timeouts()
+        assert total <= 2.0
+        assert connect_timeout <= 2.0
+        assert read_timeout == 1.0
+
+
+@pytest.mark.asyncio
+async def test_deadline_exceeded(user1):
+    with pytest.raises(DeadlineExceeded):
+        with user1.client.deadline(0.01):
+            await asyncio.sleep(0.02)
+            await user1.get()
+
+
+@pytest.mark.asyncio
+async def test_coalesce_reads(async_client):
+    client = stream.connect(
+        async_client.api_key,
+        async_client.api_secret,
+        location="qa",
+        coalesce_reads=True,
+        use_async=True,
+    )
+    feed = client.feed("user", str(uuid4()))
+    await feed.add_activity({"actor": 1, "verb": "tweet", "object": 1})
+    responses = await asyncio.gather(*[feed.get(limit=5) for _ in range(5)])
+
+    for response in responses:
+        assert response["results"] == responses[0]["results"]
+    assert client.single_flight.stats() == {"executed": 1, "coalesced": 4}
+
+
+@pytest.mark.asyncio
+async def test_feed_cache(async_client):
+    from stream.cache import FeedCache
+
+    client = stream.connect(
+        async_client.api_key,
+        async_client.api_secret,
+        location="qa",
+        feed_cache=FeedCache(),
+        use_async=True,
+    )
+    feed = client.feed("user", str(uuid4()))
+    assert (await feed.get())["results"] == []
+    assert (await feed.get())["results"] == []
+    assert client.feed_cache.stats()["hits"] == 1
+
+    await feed.add_activity({"actor": 1, "verb": "tweet", "object": 1})
+    assert len((await feed.get())["results"]) == 1
+    assert client.feed_cache.stats()["misses"] == 2
+
+
+@pytest.mark.asyncio
+async def test_entity_cache(async_client):
+    from stream.cache import EntityCache
+
+    client = stream.connect(
+        async_client.api_key,
+        async_client.api_secret,
+        location="qa",
+        entity_cache=EntityCache(),
+        use_async=True,
+    )
+    entry = await client.collections.add("items", {"data": 1}, id=str(uuid1()))
+    assert (await client.collections.get("items", entry["id"]))["data"] == {"data": 1}
+    assert client.entity_cache.stats()["hits"] == 1
+
+    missing = str(uuid1())
+    response = await client.collections.select("items", [entry["id"], missing])
+    assert len(response["response"]["data"]) == 1
+    with pytest.raises(DoesNotExistException):
+        await client.collections.get("items", missing)
+    assert client.entity_cache.stats()["missing_hits"] == 1
+
+    await client.collections.delete("items", entry["id"])
+    with pytest.raises(DoesNotExistException):
+        await client.collections.get("items", entry["id"])
+
+
+@pytest.mark.asyncio
+async def test_cache_stale_while_revalidate():
+    from stream.cache import MemoryCache, ReadThroughCache
+
+    loads = []
+
+    async def loader():
+        loads.append(1)
+        await asyncio.sleep(0.05)
+        return len(loads)
+
+    cache = ReadThroughCache(MemoryCache(), ttl=0.01, stale_ttl=10, beta=0)
+    assert await cache.async_fetch("key", loader) == 1
+    await asyncio.sleep(0.02)
+    values = await asyncio.gather(*[cache.async_fetch("key", loader) for _ in range(5)])
+    assert values == [1] * 5
+    await asyncio.sleep(0.1)
+    assert len(loads) == 2
+    assert await cache.async_fetch("key", loader) == 2
+
+
+@pytest.mark.asyncio
+async def test_activity_batcher(async_client):
+    feed = async_client.feed("user", str(uuid4()))
+    async with async_client.activity_batcher(window=0.05) as batcher:
+        activities = await asyncio.gather(
+            *[
+                batcher.add_activity(feed, {"actor": 1, "verb": "tweet", "object": i})
+                for i in range(3)
+            ]
+        )
+    assert [a["object"] for a in activities] == ["0", "1", "2"]
+    assert batcher.stats() == {"batches": 1, "activities": 3}
+    assert len((await feed.get())["results"]) == 3
+
+
+@pytest.mark.asyncio
+async def test_add_to_many_chunked(async_client):
+    activity = {"actor": 1, "verb": "tweet", "object": 1, "custom": "chunked"}
+    feeds = [async_client.feed("flat", str(uuid4())).id for _ in range(5)]
+    result = await async_client.add_to_many(
+        activity, feeds, chunk_size=2, concurrency=2
+    )
+    assert result["chunks"] == 3
+    assert result["failed_feeds"] == []
+
+    for feed in feeds:
+        feed = async_client.feed(*feed.split(":"))
+        response = await feed.get()
+        assert response["results"][0]["custom"] == "chunked"
+
+
+@pytest.mark.asyncio
+async def test_bulk_follow(async_client):
+    sources = [async_client.feed("user", str(uuid4())).id for _ in range(5)]
+    target = async_client.feed("flat", str(uuid4()))
+    edges = [{"source": s, "target": target.id} for s in sources]
+    result = await async_client.bulk_follow(iter(edges), chunk_size=2)
+    assert result["chunks"] == 3
+    assert result["processed"] == 5
+    assert result["failed_edges"] == []
+
+    followers = (await target.followers())["results"]
+    assert sorted(f["feed_id"] for f in followers) == sorted(sources)
+
+    result = await async_client.bulk_unfollow(edges, chunk_size=2)
+    assert result["failed_edges"] == []
+    assert (await target.followers())["results"] == []
+
+
+@pytest.mark.asyncio
+async def test_reconcile_following(async_client):
+    feed = async_client.feed("timeline", str(uuid4()))
+    old, kept, new = [async_client.feed("user", str(uuid4())).id for _ in range(3)]
+    await feed.follow(*old.split(":"))
+    await feed.follow(*kept.split(":"))
+
+    plan = await feed.reconcile_following([kept, new], dry_run=True)
+    assert plan["follow"] == [new]
+    assert plan["unfollow"] == [old]
+    assert plan["unchanged"] == 1
+
+    plan = await feed.reconcile_following([kept, new])
+    assert plan["failed_edges"] == []
+    following = (await feed.following())["results"]
+    assert sorted(f["target_id"] for f in following) == sorted([kept, new])
+
+
+@pytest.mark.asyncio
+async def test_loaders(async_client):
+    feed = async_client.feed("user", str(uuid4()))
+    response = await feed.add_activities(
+        [{"actor": 1, "verb": "tweet", "object": i} for i in range(3)]
+    )
+    ids = [a["id"] for a in response["activities"]]
+
+    async def handler(activity_id):
+        return await async_client.activity_loader().load(activity_id)
+
+    activities = await asyncio.gather(*[handler(i) for i in ids + [str(uuid1())]])
+    assert [a["id"] for a in activities[:3]] == ids
+    assert activities[3] is None
+    assert async_client.activity_loader().stats()["requests"] == 1
+
+    entry = await async_client.collections.add("items", {"data": 1}, id=str(uuid1()))
+    loader = async_client.collections.loader("items")
+    assert (await loader.load(entry["id"]))["data"] == {"data": 1}
+
+
+@pytest.mark.asyncio
+async def test_chunked_id_lists(async_client):
+    feed = async_client.feed("user", str(uuid4()))
+    activity = await feed.add_activity({"actor": 1, "verb": "tweet", "object": 1})
+    ids = [str(uuid1()) for _ in range(250)] + [activity["id"]]
+    results = (await async_client.get_activities(ids=ids))["results"]
+    assert [a["id"] for a in results] == [activity["id"]]
+
+    entry = await async_client.collections.add("items", {"data": 1}, id=str(uuid1()))
+    ids = [str(uuid1()) for _ in range(250)] + [entry["id"]]
+    response = await async_client.collections.select("items", ids)
+    assert [e["id"] for e in response["response"]["data"]] == [entry["id"]]
+
+    await async_client.collections.delete_many("items", ids)
+    with pytest.raises(DoesNotExistException):
+        await async_client.collections.get("items", entry["id"])
+
+
+@pytest.mark.asyncio
+async def test_update_activities_stream(async_client):
+    feed = async_client.feed("user", str(uuid4()))
+    response = await feed.add_activities(
+        [
+            {"actor": 1, "verb": "tweet", "object": i, "foreign_id": f"tweet:{i}"}
+            for i in range(5)
+        ]
+    )
+    activities = response["activities"]
+    rescored = (dict(a, score=s) for s in (1, 2) for a in activities)
+    result = await async_client.update_activities_stream(
+        rescored, chunk_size=2, concurrency=3
+    )
+    assert result["processed"] == 10
+    assert result["failed_activities"] == []
+
+    ids = [a["id"] for a in activities]
+    updates = ({"id": id, "set": {"score": 3}} for id in ids)
+    result = await async_client.activities_partial_update_stream(updates, chunk_size=2)
+    assert result["failed_updates"] == []
+    stored = (await async_client.get_activities(ids=ids))["results"]
+    assert [a["score"] for a in stored] == [3] * 5
+
+
+@pytest.mark.asyncio
+async def test_update_activities_diff(async_client):
+    feed = async_client.feed("user", str(uuid4()))
+    response = await feed.add_activities(
+        [
+            {"actor": 1, "verb": "tweet", "object": i, "counts": {"likes": 0}}
+            for i in range(4)
+        ]
+    )
+    activities = response["activities"]
+    changes = [(a, dict(a, counts={"likes": i % 2})) for i, a in enumerate(activities)]
+    result = await async_client.update_activities_diff(changes, chunk_size=1)
+    assert result["processed"] == 2
+    assert result["unchanged"] == 2
+    assert result["failed_updates"] == []
+    stored = (await async_client.get_activities(ids=[a["id"] for a in activities]))[
+        "results"
+    ]
+    assert [a["counts"]["likes"] for a in stored] == [0, 1, 0, 1]
+
+
+@pytest.mark.asyncio
+async def test_reaction_add_many(async_client):
+    activity_id = "54a60c1e-4ee3-494b-a1e3-50c06acb5ed4"
+    user = await async_client.users.add(str(uuid4()))
+    reactions = [
+        {
+            "kind": "comment",
+            "activity_id": activity_id,
+            "user_id": "mike",
+            "data": {
+                "text": str(i),
+                "mention": async_client.users.create_reference(user),
+            },
+        }
+        for i in range(5)
+    ]
+    reactions[3]["data"]["mention"] = async_client.users.create_reference(str(uuid4()))
+    result = await async_client.reactions.add_many(reactions, concurrency=3)
+    assert [r and r["data"]["text"] for r in result["reactions"]] == [
+        "0",
+        "1",
+        "2",
+        None,
+        "4",
+    ]
+    assert result["failed_reactions"] == [reactions[3]]
+
+
+@pytest.mark.asyncio
+async def test_users_bulk(async_client):
+    ids = [str(uuid1()) for _ in range(3)]
+    users = [ids[0], {"id": ids[1], "data": {"n": 1}}, ids[0], ids[2]]
+    result = await async_client.users.add_many(users, get_or_create=True)
+    assert list(result["users"]) == ids
+    assert result["users"][ids[1]]["data"] == {"n": 1}
+
+    users = await async_client.users.get_many([ids[2], str(uuid1()), ids[0]])
+    assert list(users) == [ids[2], ids[0]]
+
+    result = await async_client.users.delete_many(ids)
+    assert result["processed"] == 3
+    assert await async_client.users.get_many(ids) == {}
+
+
+@pytest.mark.asyncio
+async def test_analytics_emitter(async_client):
+    async with async_client.analytics_emitter(
+        batch_size=2, interval=60, max_queue=4, compact=False
+    ) as emitter:
+        for i in range(5):
+            emitter.track_impression({"content_list": [str(i)], "user_data": "tommaso"})
+        emitter.track_engagement({"content": "1", "label": "click"})
+    stats = emitter.stats()
+    assert stats["dropped"] == 2
+    assert stats["sent"] == 4
+    assert stats["queued"] == 0
+
+
+@pytest.mark.asyncio
+async def test_analytics_compaction(async_client):
+    emitter = async_client.analytics_emitter(sample_rate=0.5, interval=60)
+    assert emitter.compact
+    assert emitter.sample_rate == 0.5
+    users = [str(i) for i in range(100)]
+    emitter.track_impressions(
+        [{"content_list": ["1"], "user_data": u} for u in users * 2]
+    )
+    kept = [u for u in users if in_sample({"user_data": u}, 0.5)]
+    assert emitter.stats()["sampled_out"] == 2 * (100 - len(kept))
+    await emitter.close()
+    assert emitter.stats()["compacted"] == len(kept)
+
+
+@pytest.mark.asyncio
+async def test_spool(async_client, tmp_path):
+    feed = async_client.feed("user", str(uuid4()))
+    spool = async_client.spool(str(tmp_path))
+    for i in range(3):
+        spool.add_activities(
+            feed.id, [{"actor": "1", "verb": "tweet", "object": str(i)}]
+        )
+    assert await spool.replay() == 3
+    await spool.close()
+    response = await feed.get()
+    assert [a["object"] for a in response["results"]] == ["2", "1", "0"]
+
+
+@pytest.mark.asyncio
+async def test_iter_activities(async_client):
+    feed = async_client.feed("user", str(uuid4()))
+    await feed.add_activities(
+        [{"actor": "1", "verb": "tweet", "object": str(i)} for i in range(7)]
+    )
+    activities = [a async for a in feed.iter_activities(page_size=3)]
+    assert [a["object"] for a in activities] == [str(i) for i in range(6, -1, -1)]
+    activities = [a async for a in feed.iter_activities(page_size=2, max_count=5)]
+    assert len(activities) == 5
+
+
+@pytest.mark.asyncio
+async def test_iter_followers(async_client):
+    target = async_client.feed("user", str(uuid4()))
+    followers = [async_client.feed("timeline", str(uuid4())) for _ in range(5)]
+    await async_client.follow_many(
+        [{"source": f.id, "target": target.id} for f in followers]
+    )
+    follows = [f async for f in target.iter_followers(page_size=2, concurrency=2)]
+    assert sorted(f["feed_id"] for f in follows) == sorted(f.id for f in followers)
+
+
+@pytest.mark.asyncio
+async def test_reaction_iter_filter(async_client):
+    activity = await async_client.feed("user", "mike").add_activity(
+        {"actor": "1", "verb": "tweet", "object": "1"}
+    )
+    for i in range(5):
+        await async_client.reactions.add("like", activity["id"], f"user{i}")
+    reactions = [
+        r
+        async for r in async_client.reactions.iter_filter(
+            page_size=2, activity_id=activity["id"], kind="like"
+        )
+    ]
+    assert len({r["id"] for r in reactions}) == 5
+
+
+@pytest.mark.asyncio
+async def test_get_feeds(async_client):
+    feeds = [async_client.feed("user", str(uuid4())) for _ in range(3)]
+    for i, feed in enumerate(feeds):
+        await feed.add_activity({"actor": "1", "verb": "tweet", "object": str(i)})
+    response = await async_client.get_feeds(
+        [(feeds[0].id, {"limit": 1}), feeds[1].id, feeds[2].id], timeout=5
+    )
+    assert [response["results"][f.id]["results"][0]["object"] for f in feeds] == [
+        "0",
+        "1",
+        "2",
+    ]
+    assert response["exceptions"] == {}
+
+
+@pytest.mark.asyncio
+async def test_merged_timeline(async_client):
+    feeds = [async_client.feed("user", str(uuid4())) for _ in range(2)]
+    now = datetime.utcnow()
+    for i in range(4):
+        await feeds[i % 2].add_activity(
+            {
+                "actor": "1",
+                "verb": "tweet",
+                "object": str(i),
+                "time": now - timedelta(minutes=i),
+            }
+        )
+    activities = [a async for a in async_client.merged_timeline([f.id for f in feeds])]
+    assert [a["object"] for a in activities] == ["0", "1", "2", "3"]
@@ -17,8 +17,15 @@ from unittest import TestCase
 
 import stream
 from stream import serializer
-from stream.exceptions import ApiKeyException, InputException, DoesNotExistException
+from stream.analytics import compact_engagements, compact_impressions, in_sample
+from stream.exceptions import (
+    ApiKeyException,
+    DeadlineExceeded,
+    DoesNotExistException,
+    InputException,
+)
 from stream.feed import Feed
+from stream.utils import activity_diff
 
 
 def connect_debug():
@@ -1726,3 +1733,784 @@ class ClientTest(TestCase):
 
         with_str = Feed(client, "user", "1", "token")
         self.assertEqual(with_str.token, "token")
+
+    def test_timeouts(self):
+        c = stream.connect("key", "secret", timeout=3.0, read_timeout=1.0)
+        self.assertEqual(c.get_timeouts(), (3.0, 3.0, 1.0))
+        self.assertEqual(c.get_timeouts(timeout=0.5), (0.5, 0.5, 0.5))
+        self.assertEqual(
+            stream.connect("key", "secret").timeout,
+            20.0 if os.environ.get("LOCAL") else 3.0,
+        )
+        self.assertEqual(
+            stream.connect("key", "secret", use_async=True).timeout,
+            20.0 if os.environ.get("LOCAL") else 3.0,
+        )
+
+        with c.deadline(2.0):
+            total, connect_timeout, read_timeout = c.get_timeouts()
+            self.assertTrue(total <= 2.0)
+            self.assertTrue(connect_timeout <= 2.0)
+            self.assertEqual(read_timeout, 1.0)
+
+    def test_deadline_exceeded(self):
+        with self.assertRaises(DeadlineExceeded):
+            with self.c.deadline(0.01):
+                time.sleep(0.02)
+                self.user1.get()
+
+    def test_coalesce_reads(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        c = stream.connect(
+            self.c.api_key, self.c.api_secret, location="qa", coalesce_reads=True
+        )
+        feed = c.feed("user", self.user1.user_id)
+        feed.add_activity({"actor": 1, "verb": "tweet", "object": 1})
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            responses = list(executor.map(lambda _: feed.get(limit=5), range(5)))
+
+        for response in responses:
+            self.assertEqual(response["results"], responses[0]["results"])
+        stats = c.single_flight.stats()
+        self.assertEqual(stats["executed"] + stats["coalesced"], 5)
+
+    def test_coalesce_reads_deadline(self):
+        import threading
+
+        from stream.singleflight import SingleFlight
+
+        single_flight = SingleFlight()
+        started = threading.Event()
+
+        def fetch():
+            started.set()
+            time.sleep(0.2)
+            return {"results": []}
+
+        errors = []
+
+        def leader():
+            with self.c.deadline(0.05):
+                try:
+                    single_flight.do("key", fetch)
+                except DeadlineExceeded as e:
+                    errors.append(e)
+
+        thread = threading.Thread(target=leader)
+        thread.start()
+        started.wait()
+        # the follower has no deadline, the one of the leader doesn't apply
+        self.assertEqual(single_flight.do("key", fetch), {"results": []})
+        thread.join()
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(single_flight.stats(), {"executed": 1, "coalesced": 1})
+
+    def test_coalesce_reads_copies(self):
+        import threading
+
+        from stream.singleflight import SingleFlight
+
+        single_flight = SingleFlight()
+        started = threading.Event()
+        response = {"results": [{"id": "1"}]}
+
+        def fetch():
+            started.set()
+            time.sleep(0.1)
+            return response
+
+        results = []
+
+        def leader():
+            result = single_flight.do("key", fetch)
+            result["results"].clear()
+            results.append(result)
+
+        thread = threading.Thread(target=leader)
+        thread.start()
+        started.wait()
+        follower = single_flight.do("key", fetch)
+        thread.join()
+        self.assertEqual(follower, {"results": [{"id": "1"}]})
+        self.assertIsNot(results[0], response)
+        self.assertEqual(response, {"results": [{"id": "1"}]})
+
+    def test_feed_cache(self):
+        from stream.cache import FeedCache
+
+        c = stream.connect(
+            self.c.api_key, self.c.api_secret, location="qa", feed_cache=FeedCache()
+        )
+        feed = c.feed("user", self.user1.user_id)
+        self.assertEqual(feed.get()["results"], [])
+        self.assertEqual(feed.get()["results"], [])
+        self.assertEqual(c.feed_cache.stats()["hits"], 1)
+
+        feed.add_activity({"actor": 1, "verb": "tweet", "object": 1})
+        self.assertEqual(len(feed.get()["results"]), 1)
+        self.assertEqual(c.feed_cache.stats()["misses"], 2)
+
+    def test_entity_cache(self):
+        from stream.cache import EntityCache
+
+        c = stream.connect(
+            self.c.api_key,
+            self.c.api_secret,
+            location="qa",
+            entity_cache=EntityCache(),
+        )
+        entry = c.collections.add("items", {"data": 1}, id=str(uuid1()))
+        self.assertEqual(c.collections.get("items", entry["id"])["data"], {"data": 1})
+        self.assertEqual(c.entity_cache.stats()["hits"], 1)
+
+        missing = str(uuid1())
+        response = c.collections.select("items", [entry["id"], missing])
+        self.assertEqual(len(response["response"]["data"]), 1)
+        with self.assertRaises(DoesNotExistException):
+            c.collections.get("items", missing)
+        self.assertEqual(c.entity_cache.stats()["missing_hits"], 1)
+
+        c.collections.delete("items", entry["id"])
+        with self.assertRaises(DoesNotExistException):
+            c.collections.get("items", entry["id"])
+
+        user = c.users.add(str(uuid1()), {"name": "Mike"})
+        self.assertEqual(c.users.get(user["id"])["data"], {"name": "Mike"})
+        c.users.update(user["id"], {"name": "Bob"})
+        self.assertEqual(c.users.get(user["id"])["data"], {"name": "Bob"})
+
+    def test_og_cache(self):
+        import tempfile
+
+        from stream.cache import OgCache, SQLiteCache
+
+        with tempfile.TemporaryDirectory() as directory:
+            og_cache = OgCache(SQLiteCache(os.path.join(directory, "og.sqlite")))
+            c = stream.connect(
+                self.c.api_key, self.c.api_secret, location="qa", og_cache=og_cache
+            )
+            response = c.og("https://google.com")
+            self.assertEqual(c.og("HTTPS://GOOGLE.COM/"), response)
+            self.assertEqual(og_cache.stats()["hits"], 1)
+
+            # a new cache on the same file sees the stored scrape
+            other = OgCache(SQLiteCache(os.path.join(directory, "og.sqlite")))
+            self.assertEqual(other.get(other.get_key("https://google.com")), response)
+
+    def test_sqlite_cache_locked(self):
+        import sqlite3
+        import tempfile
+
+        from stream.cache import SQLiteCache
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "og.sqlite")
+            cache = SQLiteCache(path, timeout=0.1, touch_interval=0)
+            cache.set("a", 1)
+            # another process holds the write lock
+            other = sqlite3.connect(path, isolation_level=None)
+            other.execute("BEGIN IMMEDIATE")
+            self.assertEqual(cache.get("a"), 1)
+            cache.set("b", 2)
+            self.assertIsNone(cache.get("b"))
+            other.execute("COMMIT")
+            other.close()
+            cache.close()
+
+    def test_normalize_url(self):
+        from stream.utils import normalize_url
+
+        self.assertEqual(
+            normalize_url("HTTPS://Example.com:443/a?b=2&a=1#top"),
+            "https://example.com/a?a=1&b=2",
+        )
+        self.assertEqual(
+            normalize_url("http://example.com:8080"), "http://example.com:8080/"
+        )
+
+    def test_cache_backends(self):
+        from stream.cache import MemoryCache, RESPCache, SharedMemoryCache
+        from stream.tests.resp_server import RESPStandIn
+
+        server = RESPStandIn().start()
+        backends = [
+            MemoryCache(),
+            SharedMemoryCache(slots=64, slot_size=512),
+            RESPCache(port=server.port),
+        ]
+        try:
+            for cache in backends:
+                cache.set("a", {"value": 1})
+                cache.set_many({"b": [1, 2], "c": "three"})
+                self.assertEqual(cache.get("a"), {"value": 1})
+                self.assertEqual(
+                    cache.get_many(["a", "b", "c", "d"]),
+                    {"a": {"value": 1}, "b": [1, 2], "c": "three"},
+                )
+                cache.delete("a")
+                self.assertIsNone(cache.get("a"))
+
+                cache.set("short", 1, ttl=0.01)
+                time.sleep(0.02)
+                self.assertIsNone(cache.get("short"))
+
+                cache.clear()
+                self.assertEqual(cache.get_many(["b", "c"]), {})
+        finally:
+            server.stop()
+
+    def test_token_cache(self):
+        from stream.cache import MemoryCache
+
+        token_cache = MemoryCache()
+        c = stream.connect("key", "secret", token_cache=token_cache)
+        token = c.create_jwt_token("feed", "*", feed_id="*")
+        self.assertEqual(c.create_jwt_token("feed", "*", feed_id="*"), token)
+        self.assertTrue(len(token_cache) > 0)
+
+    def test_cache_stale_while_revalidate(self):
+        from stream.cache import MemoryCache, ReadThroughCache
+
+        loads = []
+
+        def loader():
+            loads.append(1)
+            time.sleep(0.05)
+            return len(loads)
+
+        cache = ReadThroughCache(MemoryCache(), ttl=0.01, stale_ttl=10, beta=0)
+        self.assertEqual(cache.fetch("key", loader), 1)
+        time.sleep(0.02)
+        # every reader gets the stale value while a single refresh runs
+        self.assertEqual([cache.fetch("key", loader) for _ in range(5)], [1] * 5)
+        time.sleep(0.1)
+        self.assertEqual(len(loads), 2)
+        self.assertEqual(cache.stats()["stale_hits"], 5)
+
+    def test_cache_early_refresh(self):
+        from stream.cache import MemoryCache, ReadThroughCache
+
+        cache = ReadThroughCache(MemoryCache(), ttl=1)
+        # a slow load close to the expiration is almost always refreshed early
+        cache.set("key", 1, delta=100)
+        for _ in range(10):
+            cache.fetch("key", lambda: 2)
+        self.assertGreater(cache.stats()["early_refreshes"], 0)
+
+        cache.set("key", 1, delta=0)
+        self.assertEqual(cache.fetch("key", lambda: 2), 1)
+
+    def test_cache_backend_down(self):
+        from stream.cache import FeedCache, ReadThroughCache, RESPCache
+
+        # nothing listens on port 1
+        cache = ReadThroughCache(RESPCache(port=1, timeout=0.1), ttl=1)
+        self.assertEqual(cache.fetch("key", lambda: 2), 2)
+        cache.delete("key")
+        self.assertEqual(cache.stats()["misses"], 1)
+        self.assertEqual(cache.stats()["errors"], 3)
+
+        c = stream.connect(
+            "key",
+            "secret",
+            token_cache=RESPCache(port=1, timeout=0.1),
+            feed_cache=FeedCache(RESPCache(port=1, timeout=0.1)),
+        )
+        self.assertEqual(
+            c.feed_cache.get_key("user:1", "feed/user/1/", {})[:11], "feed:user:1"
+        )
+
+    def test_activity_batcher(self):
+        feed = getfeed("user", str(uuid4()))
+        with self.c.activity_batcher(window=0.05) as batcher:
+            futures = [
+                batcher.add_activity(feed, {"actor": 1, "verb": "tweet", "object": i})
+                for i in range(3)
+            ]
+        self.assertEqual([f.result()["object"] for f in futures], ["0", "1", "2"])
+        self.assertEqual(batcher.stats(), {"batches": 1, "activities": 3})
+        self.assertEqual(len(feed.get()["results"]), 3)
+
+        with self.assertRaises(RuntimeError):
+            batcher.add_activity(feed, {"actor": 1, "verb": "tweet", "object": 1})
+
+    def test_add_to_many_chunked(self):
+        activity = {"actor": 1, "verb": "tweet", "object": 1, "custom": "chunked"}
+        feeds = [getfeed("flat", str(uuid4())).id for _ in range(5)]
+        result = self.c.add_to_many(activity, feeds, chunk_size=2, concurrency=2)
+        self.assertEqual(result["chunks"], 3)
+        self.assertEqual(result["failed_feeds"], [])
+
+        for feed in feeds:
+            feed = self.c.feed(*feed.split(":"))
+            self.assertEqual(feed.get()["results"][0]["custom"], "chunked")
+
+    def test_chunked(self):
+        from stream.bulk import chunked
+
+        self.assertEqual(list(chunked(range(5), 2)), [[0, 1], [2, 3], [4]])
+        # "aaaa" takes 7 bytes with its quotes and comma
+        self.assertEqual(
+            list(chunked(["aaaa", "bbbb", "cccc"], 10, max_bytes=15)),
+            [["aaaa", "bbbb"], ["cccc"]],
+        )
+        self.assertEqual(list(chunked(["aaaa"], 10, max_bytes=1)), [["aaaa"]])
+
+    def test_retry_unsent(self):
+        from stream.bulk import call_with_retries, is_unsent
+        from stream.exceptions import StreamApiException
+
+        self.assertTrue(is_unsent(requests.ConnectTimeout()))
+        self.assertTrue(is_unsent(StreamApiException("slow down", status_code=429)))
+        self.assertFalse(is_unsent(requests.ReadTimeout()))
+        self.assertFalse(is_unsent(StreamApiException("oops", status_code=503)))
+
+        calls = []
+
+        def write():
+            calls.append(1)
+            raise requests.ReadTimeout()
+
+        # the write may have been applied, it isn't sent again
+        with self.assertRaises(requests.ReadTimeout):
+            call_with_retries(write, retries=2, backoff=0, idempotent=False)
+        self.assertEqual(len(calls), 1)
+
+    def test_bulk_follow(self):
+        import tempfile
+
+        sources = [getfeed("user", str(uuid4())).id for _ in range(5)]
+        target = getfeed("flat", str(uuid4())).id
+        edges = [{"source": s, "target": target} for s in sources]
+        with tempfile.TemporaryDirectory() as tmp:
+            checkpoint = os.path.join(tmp, "follows.json")
+            result = self.c.bulk_follow(
+                iter(edges), checkpoint=checkpoint, chunk_size=2
+            )
+            self.assertEqual(result["chunks"], 3)
+            self.assertEqual(result["processed"], 5)
+            self.assertEqual(result["failed_edges"], [])
+            # everything was recorded in the checkpoint, nothing is left to do
+            result = self.c.bulk_follow(edges, checkpoint=checkpoint)
+            self.assertEqual(result["processed"], 0)
+
+        followers = self.c.feed(*target.split(":")).followers()["results"]
+        self.assertEqual(sorted(f["feed_id"] for f in followers), sorted(sources))
+
+        result = self.c.bulk_unfollow(edges, chunk_size=2)
+        self.assertEqual(result["failed_edges"], [])
+        self.assertEqual(self.c.feed(*target.split(":")).followers()["results"], [])
+
+    def test_reconcile_following(self):
+        feed = getfeed("timeline", str(uuid4()))
+        old, kept, new = [getfeed("user", str(uuid4())).id for _ in range(3)]
+        feed.follow(*old.split(":"))
+        feed.follow(*kept.split(":"))
+
+        plan = feed.reconcile_following([kept, new], dry_run=True)
+        self.assertEqual(plan["follow"], [new])
+        self.assertEqual(plan["unfollow"], [old])
+        self.assertEqual(plan["unchanged"], 1)
+        self.assertEqual(len(feed.following()["results"]), 2)
+
+        plan = feed.reconcile_following([kept, new])
+        self.assertEqual(plan["failed_edges"], [])
+        following = feed.following()["results"]
+        self.assertEqual(sorted(f["target_id"] for f in following), sorted([kept, new]))
+
+    def test_loaders(self):
+        feed = getfeed("user", str(uuid4()))
+        activities = feed.add_activities(
+            [{"actor": 1, "verb": "tweet", "object": i} for i in range(3)]
+        )["activities"]
+        ids = [a["id"] for a in activities]
+
+        loader = self.c.activity_loader()
+        futures = [loader.load(i) for i in ids + ids[:1] + [str(uuid1())]]
+        self.assertEqual([f.result()["id"] for f in futures[:4]], ids + ids[:1])
+        self.assertIsNone(futures[4].result())
+        self.assertEqual(loader.stats(), {"loads": 5, "requests": 1})
+
+        entry = self.c.collections.add("items", {"data": 1}, id=str(uuid1()))
+        loader = self.c.collections.loader("items")
+        self.assertEqual(loader.load_many([entry["id"]])[0]["data"], {"data": 1})
+
+    def test_loader_callbacks(self):
+        from stream.loader import Loader
+
+        loader = Loader(lambda ids: {id: id.upper() for id in ids})
+        first, second = loader.load("a"), loader.load("b")
+        results = []
+        # adding a callback sends the pending ids
+        first.add_done_callback(lambda f: results.append(f.result()))
+        self.assertEqual(results, ["A"])
+        self.assertTrue(second.done())
+        self.assertEqual(loader.stats(), {"loads": 2, "requests": 1})
+
+    def test_chunked_id_lists(self):
+        feed = getfeed("user", str(uuid4()))
+        activity = feed.add_activity({"actor": 1, "verb": "tweet", "object": 1})
+        ids = [str(uuid1()) for _ in range(250)] + [activity["id"]]
+        # too many ids for one url, the chunks are merged back in order
+        results = self.c.get_activities(ids=ids)["results"]
+        self.assertEqual([a["id"] for a in results], [activity["id"]])
+
+        entry = self.c.collections.add("items", {"data": 1}, id=str(uuid1()))
+        ids = [str(uuid1()) for _ in range(250)] + [entry["id"]]
+        data = self.c.collections.select("items", ids)["response"]["data"]
+        self.assertEqual([e["id"] for e in data], [entry["id"]])
+
+        self.c.collections.delete_many("items", ids)
+        with self.assertRaises(DoesNotExistException):
+            self.c.collections.get("items", entry["id"])
+
+    def test_update_activities_stream(self):
+        feed = getfeed("user", str(uuid4()))
+        activities = feed.add_activities(
+            [
+                {"actor": 1, "verb": "tweet", "object": i, "foreign_id": f"tweet:{i}"}
+                for i in range(5)
+            ]
+        )["activities"]
+
+        def rescored():
+            # the same activities twice, the second update must win
+            for score in (1, 2):
+                for activity in activities:
+                    yield dict(activity, score=score)
+
+        progress = []
+        result = self.c.update_activities_stream(
+            rescored(), chunk_size=2, concurrency=3, on_progress=progress.append
+        )
+        self.assertEqual(result["processed"], 10)
+        self.assertEqual(result["failed_activities"], [])
+        self.assertEqual(len(progress), result["chunks"])
+        ids = [a["id"] for a in activities]
+        stored = self.c.get_activities(ids=ids)["results"]
+        self.assertEqual([a["score"] for a in stored], [2] * 5)
+
+        updates = ({"id": id, "set": {"score": 3}} for id in ids)
+        result = self.c.activities_partial_update_stream(updates, chunk_size=2)
+        self.assertEqual(result["failed_updates"], [])
+        stored = self.c.get_activities(ids=ids)["results"]
+        self.assertEqual([a["score"] for a in stored], [3] * 5)
+
+    def test_activity_diff(self):
+        old = {
+            "id": "1",
+            "actor": "1",
+            "counts": {"likes": 1, "shares": 2},
+            "tags": ["a"],
+            "popular": True,
+        }
+        new = dict(old, counts={"likes": 2, "shares": 2}, tags=["a", "b"])
+        del new["popular"]
+        self.assertEqual(
+            activity_diff(old, new),
+            ({"counts.likes": 2, "tags": ["a", "b"]}, ["popular"]),
+        )
+        self.assertEqual(activity_diff(old, dict(old)), ({}, []))
+
+    def test_update_activities_diff(self):
+        feed = getfeed("user", str(uuid4()))
+        activities = feed.add_activities(
+            [
+                {
+                    "actor": 1,
+                    "verb": "tweet",
+                    "object": i,
+                    "counts": {"likes": 0, "shares": 0},
+                }
+                for i in range(4)
+            ]
+        )["activities"]
+        changes = [
+            (a, dict(a, counts={"likes": i % 2, "shares": 0}))
+            for i, a in enumerate(activities)
+        ]
+        result = self.c.update_activities_diff(changes, chunk_size=1)
+        self.assertEqual(result["processed"], 2)
+        self.assertEqual(result["unchanged"], 2)
+        self.assertEqual(result["failed_updates"], [])
+        ids = [a["id"] for a in activities]
+        stored = self.c.get_activities(ids=ids)["results"]
+        self.assertEqual([a["counts"]["likes"] for a in stored], [0, 1, 0, 1])
+
+    def test_reaction_add_many(self):
+        activity_id = "54a60c1e-4ee3-494b-a1e3-50c06acb5ed4"
+        user = self.c.users.add(str(uuid4()))
+        reactions = [
+            {
+                "kind": "comment",
+                "activity_id": activity_id,
+                "user_id": "mike",
+                "data": {
+                    "text": str(i),
+                    "mention": self.c.users.create_reference(user),
+                },
+            }
+            for i in range(5)
+        ]
+        reactions[3]["data"]["mention"] = self.c.users.create_reference(str(uuid4()))
+        result = self.c.reactions.add_many(reactions, concurrency=3)
+        self.assertEqual(
+            [r and r["data"]["text"] for r in result["reactions"]],
+            ["0", "1", "2", None, "4"],
+        )
+        self.assertEqual(result["failed_reactions"], [reactions[3]])
+        self.assertIsInstance(result["exceptions"][0], DoesNotExistException)
+
+        children = [
+            {"kind": "like", "parent_id": result["reactions"][0]["id"], "user_id": u}
+            for u in ("rob", "mike")
+        ]
+        result = self.c.reactions.add_many(children)
+        self.assertEqual([r["user_id"] for r in result["reactions"]], ["rob", "mike"])
+
+    def test_users_bulk(self):
+        existing = self.c.users.add(str(uuid1()))
+        ids = [str(uuid1()) for _ in range(3)]
+        users = [ids[0], {"id": ids[1], "data": {"n": 1}}, ids[0], ids[2]]
+        result = self.c.users.add_many(users + [existing["id"]], get_or_create=True)
+        self.assertEqual(list(result["users"]), ids + [existing["id"]])
+        self.assertEqual(result["users"][ids[1]]["data"], {"n": 1})
+        self.assertEqual(
+            result["users"][existing["id"]]["created_at"], existing["created_at"]
+        )
+        self.assertEqual(result["failed_users"], [])
+
+        users = self.c.users.get_many([ids[2], str(uuid1()), ids[0], ids[2]])
+        self.assertEqual(list(users), [ids[2], ids[0]])
+
+        result = self.c.users.delete_many(ids)
+        self.assertEqual(result["processed"], 3)
+        self.assertEqual(self.c.users.get_many(ids), {})
+
+    def test_analytics_emitter(self):
+        emitter = self.c.analytics_emitter(
+            batch_size=2, interval=60, max_queue=4, compact=False
+        )
+        for i in range(5):
+            emitter.track_impression({"content_list": [str(i)], "user_data": "tommaso"})
+        emitter.track_engagement({"content": "1", "label": "click"})
+        emitter.close()
+        stats = emitter.stats()
+        self.assertEqual(stats["dropped"], 2)
+        self.assertEqual(stats["sent"] + stats["failed"], 4)
+        self.assertEqual(stats["queued"], 0)
+        self.assertRaises(RuntimeError, emitter.track_impression, {})
+
+        emitter = self.c.analytics_emitter(max_queue=1, drop="newest")
+        emitter.track_engagements([{"content": str(i)} for i in range(3)])
+        self.assertEqual(emitter.stats()["dropped"], 2)
+        emitter.close()
+
+    def test_analytics_compaction(self):
+        features = [{"group": "topic", "value": "js"}]
+        impressions = [
+            {"content_list": ["1", "2"], "user_data": "tommaso", "features": features},
+            {"content_list": ["2", "3"], "user_data": "tommaso", "features": features},
+            {"content_list": ["1"], "user_data": "julian", "features": features},
+        ]
+        self.assertEqual(
+            compact_impressions(impressions),
+            [
+                {
+                    "content_list": ["1", "2", "3"],
+                    "user_data": "tommaso",
+                    "features": features,
+                },
+                {"content_list": ["1"], "user_data": "julian", "features": features},
+            ],
+        )
+        engagements = [{"content": "1", "label": "click"}] * 2
+        self.assertEqual(compact_engagements(engagements), engagements[:1])
+
+        emitter = self.c.analytics_emitter(sample_rate=0.5, interval=60)
+        users = [str(i) for i in range(100)]
+        emitter.track_impressions(
+            [{"content_list": ["1"], "user_data": u} for u in users * 2]
+        )
+        kept = [u for u in users if in_sample({"user_data": u}, 0.5)]
+        self.assertEqual(emitter.stats()["sampled_out"], 2 * (100 - len(kept)))
+        emitter.close()
+        self.assertEqual(emitter.stats()["compacted"], len(kept))
+
+        emitter = self.c.analytics_emitter(interval=60)
+        emitter.track_engagements(engagements)
+        self.assertEqual(len(emitter._take()[0][1]), 2)
+        emitter.close()
+        emitter = self.c.analytics_emitter(interval=60, dedupe_engagements=True)
+        emitter.track_engagements(engagements)
+        self.assertEqual(emitter._take(), [("engagement", engagements[:1])])
+        self.assertEqual(emitter.stats()["compacted"], 1)
+        emitter.close()
+
+    def test_spool(self):
+        import tempfile
+
+        feed = getfeed("user", str(uuid4()))
+        with tempfile.TemporaryDirectory() as directory:
+            spool = self.c.spool(directory, segment_size=300, fsync="always")
+            for i in range(5):
+                spool.add_activities(
+                    feed.id, [{"actor": "1", "verb": "tweet", "object": str(i)}]
+                )
+            spool.track_impressions([{"content_list": ["1"], "user_data": "tommaso"}])
+            spool.close()
+            self.assertGreater(spool.stats()["segments"], 1)
+
+            # a new process finds the operations and sends them
+            spool = self.c.spool(directory)
+            self.assertEqual(spool.replay(), 6)
+            self.assertEqual(spool.stats()["pending_bytes"], 0)
+            self.assertEqual(spool.replay(), 0)
+            spool.close()
+        activities = feed.get()["results"]
+        self.assertEqual([a["object"] for a in activities], ["4", "3", "2", "1", "0"])
+
+        with tempfile.TemporaryDirectory() as directory:
+            spool = self.c.spool(directory, segment_size=200, max_size=500)
+            for i in range(20):
+                spool.track_engagements([{"content": str(i), "label": "click"}])
+            self.assertGreater(spool.stats()["dropped"], 0)
+            self.assertRaises(ValueError, spool.append, "delete_activity", {})
+            spool.close()
+
+    def test_spool_at_most_once(self):
+        import tempfile
+
+        from stream.spool import Spool
+
+        sent = []
+        client = self.c
+
+        class TimingOut:
+            def _add_to_many_chunks(self, *args):
+                return client._add_to_many_chunks(*args)
+
+            def add_to_many(self, activity, feeds):
+                sent.append(feeds)
+                raise requests.ReadTimeout()
+
+        activity = {"actor": "1", "verb": "tweet", "object": "1"}
+        with tempfile.TemporaryDirectory() as directory:
+            spool = Spool(TimingOut(), directory)
+            spool.add_to_many(activity, ["user:1", "user:2"])
+            # the activity may have been added, it is not sent again
+            self.assertEqual(spool.replay(), 0)
+            self.assertEqual(spool.replay(), 0)
+            self.assertEqual(sent, [["user:1", "user:2"]])
+            self.assertEqual(spool.stats()["failed"], 1)
+            self.assertEqual(spool.stats()["pending_bytes"], 0)
+            spool.close()
+
+    def test_iter_activities(self):
+        feed = getfeed("user", str(uuid4()))
+        feed.add_activities(
+            [{"actor": "1", "verb": "tweet", "object": str(i)} for i in range(7)]
+        )
+        activities = list(feed.iter_activities(page_size=3))
+        self.assertEqual(
+            [a["object"] for a in activities], [str(i) for i in range(6, -1, -1)]
+        )
+        activities = list(feed.iter_activities(page_size=2, max_count=5))
+        self.assertEqual(len(activities), 5)
+        self.assertEqual(list(feed.iter_activities(max_count=0)), [])
+
+    def test_iter_followers(self):
+        import tempfile
+
+        target = getfeed("user", str(uuid4()))
+        followers = [getfeed("timeline", str(uuid4())) for _ in range(5)]
+        self.c.follow_many([{"source": f.id, "target": target.id} for f in followers])
+        follows = list(target.iter_followers(page_size=2, concurrency=2))
+        self.assertEqual(
+            sorted(f["feed_id"] for f in follows), sorted(f.id for f in followers)
+        )
+        following = list(followers[0].iter_following(page_size=2))
+        self.assertEqual([f["target_id"] for f in following], [target.id])
+
+        with tempfile.TemporaryDirectory() as tmp:
+            checkpoint = os.path.join(tmp, "followers.json")
+            pages = target.iter_followers(page_size=2, checkpoint=checkpoint)
+            first = [next(pages) for _ in range(3)]
+            pages.close()
+            rest = list(target.iter_followers(page_size=2, checkpoint=checkpoint))
+        # the page being consumed when the crawl stopped comes again
+        self.assertEqual(first[2:] + rest[1:], follows[2:])
+
+    def test_reaction_iter_filter(self):
+        import tempfile
+
+        activity = getfeed("user", "mike").add_activity(
+            {"actor": "1", "verb": "tweet", "object": "1"}
+        )
+        for i in range(5):
+            self.c.reactions.add("like", activity["id"], f"user{i}")
+        reactions = list(
+            self.c.reactions.iter_filter(
+                page_size=2,
+                activity_id=activity["id"],
+                kind="like",
+                with_activity_data=True,
+            )
+        )
+        self.assertEqual(len({r["id"] for r in reactions}), 5)
+        self.assertEqual(reactions[0]["activity"]["id"], activity["id"])
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "likes.jsonl")
+            count = self.c.reactions.export_filter(
+                path, page_size=2, activity_id=activity["id"], kind="like"
+            )
+            with open(path) as f:
+                lines = [json.loads(line) for line in f]
+        self.assertEqual(count, 5)
+        self.assertEqual([r["id"] for r in lines], [r["id"] for r in reactions])
+
+    def test_get_feeds(self):
+        feeds = [getfeed("user", str(uuid4())) for _ in range(3)]
+        for i, feed in enumerate(feeds):
+            feed.add_activity({"actor": "1", "verb": "tweet", "object": str(i)})
+        response = self.c.get_feeds(
+            [(feeds[0].id, {"limit": 1}), feeds[1].id, (feeds[2].id, {"enrich": True})]
+            + ["nosuchgroup:1"],
+            timeout=5,
+        )
+        self.assertEqual(
+            [response["results"][f.id]["results"][0]["object"] for f in feeds],
+            ["0", "1", "2"],
+        )
+        self.assertEqual(len(response["exceptions"]), 1)
+        self.assertRaises(ValueError, self.c.get_feeds, [feeds[0].id, feeds[0].id])
+
+    def test_merged_timeline(self):
+        feeds = [getfeed("user", str(uuid4())) for _ in range(3)]
+        now = datetime.datetime.utcnow()
+        shared = {
+            "actor": "1",
+            "verb": "tweet",
+            "object": "shared",
+            "foreign_id": "shared",
+            "time": now,
+        }
+        for i in range(6):
+            feeds[i % 3].add_activity(
+                {
+                    "actor": "1",
+                    "verb": "tweet",
+                    "object": str(i),
+                    "time": now - datetime.timedelta(minutes=i + 1),
+                }
+            )
+        feeds[0].add_activity(shared)
+        feeds[1].add_activity(shared)
+        activities = list(
+            self.c.merged_timeline([f.id for f in feeds], max_count=5, page_size=1)
+        )
+        self.assertEqual(
+            [a["object"] for a in activities], ["shared", "0", "1", "2", "3"]
+        )
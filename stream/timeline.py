@@ -0,0 +1,106 @@
+import heapq
+from collections import deque
+
+"""
+Merging of the activities of many feeds into one timeline
+
+Every feed is read with its own id_lt cursor. A heap holds the newest
+activity not yet merged of every feed, so the next activity of the timeline
+is always at its top. A feed is only paged further when its last fetched
+activity was merged, the timeline never asks for more than it needs.
+"""
+
+
+class Newest:
+    """
+    Heap key ordering the activities from the newest to the oldest
+    """
+
+    __slots__ = ("key",)
+
+    def __init__(self, activity):
+        self.key = (activity["time"], activity["id"])
+
+    def __lt__(self, other):
+        return self.key > other.key
+
+
+class FeedCursor:
+    """
+    The activities fetched from a feed and not merged yet
+    """
+
+    def __init__(self, feed, params, limit):
+        self.feed = feed
+        self.params = params
+        self.limit = limit
+        self.activities = deque()
+        self.id_lt = None
+        self.done = False
+
+    def page_params(self):
+        page_params = dict(self.params, limit=self.limit)
+        if self.id_lt is not None:
+            page_params["id_lt"] = self.id_lt
+        return page_params
+
+    def add_page(self, page):
+        self.activities.extend(page)
+        # a short page is the last one
+        self.done = len(page) < self.limit
+        if page:
+            self.id_lt = page[-1]["id"]
+
+    @property
+    def needs_page(self):
+        return not self.activities and not self.done
+
+
+class TimelineMerge:
+    """
+    :param feeds: the (feed, params) of the feeds to merge, the params are
+     the ones of Feed.get
+    :param page_size: how many activities are fetched in one request
+    :param max_count: how many activities the timeline holds at most, a
+     feed never has to give more than that
+    """
+
+    def __init__(self, feeds, page_size=25, max_count=None):
+        limit = page_size if max_count is None else min(page_size, max_count)
+        self.cursors = [FeedCursor(feed, params, limit) for feed, params in feeds]
+        self.max_count = max_count
+        self.count = 0
+        self._heap = []
+        # copies of an activity have the same time and id, so they come
+        # out of the heap one after the other
+        self._last_key = None
+
+    def push(self, index):
+        """
+        Moves the next activity of a cursor to the heap
+        """
+        cursor = self.cursors[index]
+        if cursor.activities:
+            activity = cursor.activities.popleft()
+            heapq.heappush(self._heap, (Newest(activity), index, activity))
+
+    def pop(self):
+        """
+        Returns the next activity of the timeline and the index of its
+        cursor, (None, None) when the timeline is complete
+        """
+        if not self._heap or self.full():
+            return None, None
+        _, index, activity = heapq.heappop(self._heap)
+        return activity, index
+
+    def is_new(self, activity):
+        key = (activity["time"], activity["id"])
+        if key == self._last_key:
+            return False
+        self._last_key = key
+        self.count += 1
+        return True
+
+    def full(self):
+        return self.max_count is not None and self.count >= self.max_count
@@ -1,5 +1,7 @@
 from abc import ABC, abstractmethod
 
+from stream.exceptions import DoesNotExistException
+
 
 class AbstractUsers(ABC):
     @abstractmethod
@@ -22,6 +24,42 @@ class AbstractUsers(ABC):
     def delete(self, user_id):
         pass
 
+    @abstractmethod
+    def add_many(self, users, get_or_create=False, concurrency=4, retries=2):
+        """
+        Adds any number of users with concurrent requests
+
+        :param users: an iterable of user ids or of dicts with an id and
+         data, consumed lazily, only the first occurrence of an id is added
+        :param concurrency: how many requests are sent at the same time
+        :param retries: how many times a user failing with a transient error
+         is sent again, without get_or_create only the requests which were
+         not received are
+
+        Returns the added users by id, the ids which failed and their
+        exceptions.
+        """
+        pass
+
+    @abstractmethod
+    def get_many(self, user_ids, concurrency=4, retries=2):
+        """
+        Returns the users by id, in the order of user_ids, the ones which
+        don't exist are left out
+
+        Users are read from the entity cache when the client has one and
+        the others are fetched concurrently and cached.
+        """
+        pass
+
+    @abstractmethod
+    def delete_many(self, user_ids, concurrency=4, retries=2):
+        """
+        Deletes any number of users with concurrent requests, returns the
+        ids which failed and their exceptions
+        """
+        pass
+
 
 class BaseUsers(AbstractUsers, ABC):
     API_ENDPOINT = "user/"
@@ -36,3 +74,70 @@ class BaseUsers(AbstractUsers, ABC):
         if isinstance(id, (dict,)) and id.get("id") is not None:
             _id = id.get("id")
         return f"SU:{_id}"
+
+    def _cache_user(self, user):
+        cache = self.client.entity_cache
+        if cache is not None:
+            cache.set(cache.user_key(user["id"]), user)
+
+    def _unique_users(self, users):
+        """
+        Yields the (id, data) of users, skipping the ids already seen
+        """
+        seen = set()
+        for user in users:
+            if isinstance(user, dict):
+                user_id, data = str(user["id"]), user.get("data")
+            else:
+                user_id, data = str(user), None
+            if user_id not in seen:
+                seen.add(user_id)
+                yield user_id, data
+
+    def _split_cached(self, user_ids):
+        """
+        Returns the cached users by id, the ids which have to be fetched
+        and the stale users to refresh in the background by cache key
+        """
+        cache = self.client.entity_cache
+        if cache is None:
+            return {}, user_ids, {}
+
+        keys = {cache.user_key(user_id): user_id for user_id in user_ids}
+        found, known_missing, stale = cache.get_many(list(keys))
+        cached = {keys[key]: user for key, user in found.items()}
+        missing = [
+            keys[key] for key in keys if key not in found and key not in known_missing
+        ]
+        return cached, missing, {key: keys[key] for key in stale}
+
+    def _cache_fetched(self, outcomes):
+        """
+        Caches the fetched users and the ids which don't exist, returns the
+        users by id and raises the first other error
+        """
+        cache = self.client.entity_cache
+        fetched = {}
+        for user_id, loaded, exception in outcomes:
+            if isinstance(exception, DoesNotExistException):
+                if cache is not None:
+                    cache.set_missing(cache.user_key(user_id))
+                continue
+            if exception is not None:
+                raise exception
+            user, delta = loaded
+            fetched[user_id] = user
+            if cache is not None:
+                cache.set_many({cache.user_key(user_id): user}, delta=delta)
+        return fetched
+
+    def _bulk_result(self, report, users=None):
+        result = report.result("failed_users")
+        if users is not None:
+            result["users"] = users
+        return result
+
+    def _evict_user(self, user_id):
+        cache = self.client.entity_cache
+        if cache is not None:
+            cache.delete(cache.user_key(user_id))
@@ -1,73 +1,235 @@
+import time
+
+from stream.bulk import (
+    BulkReport,
+    async_call_with_retries,
+    async_map_concurrently,
+    call_with_retries,
+    map_concurrently,
+)
 from stream.users.base import BaseUsers
 
 
 class Users(BaseUsers):
     def add(self, user_id, data=None, get_or_create=False):
         payload = dict(id=user_id, data=data)
-        return self.client.post(
+        response = self.client.post(
             self.API_ENDPOINT,
             service_name=self.SERVICE_NAME,
             signature=self.token,
             data=payload,
             params={"get_or_create": get_or_create},
         )
+        self._cache_user(response)
+        return response
 
     def get(self, user_id, **params):
-        return self.client.get(
-            f"{self.API_ENDPOINT}/{user_id}",
-            service_name=self.SERVICE_NAME,
-            params=params,
-            signature=self.token,
-        )
+        def load():
+            return self.client.get(
+                f"{self.API_ENDPOINT}/{user_id}",
+                service_name=self.SERVICE_NAME,
+                params=params,
+                signature=self.token,
+            )
+
+        cache = self.client.entity_cache
+        # params such as with_follow_counts change the response
+        if cache is None or params:
+            return load()
+        return cache.fetch(cache.user_key(user_id), load)
 
     def update(self, user_id, data=None):
         payload = dict(data=data)
-        return self.client.put(
+        response = self.client.put(
             f"{self.API_ENDPOINT}/{user_id}",
             service_name=self.SERVICE_NAME,
             signature=self.token,
             data=payload,
         )
+        self._cache_user(response)
+        return response
 
     def delete(self, user_id):
-        return self.client.delete(
+        response = self.client.delete(
             f"{self.API_ENDPOINT}/{user_id}",
             service_name=self.SERVICE_NAME,
             signature=self.token,
         )
+        self._evict_user(user_id)
+        return response
+
+    def add_many(self, users, get_or_create=False, concurrency=4, retries=2):
+        def add(user):
+            user_id, data = user
+            return call_with_retries(
+                lambda: self.add(user_id, data, get_or_create),
+                retries,
+                idempotent=get_or_create,
+            )
+
+        report = BulkReport()
+        added = {}
+        outcomes = map_concurrently(add, self._unique_users(users), concurrency)
+        for (user_id, _), response, exception in outcomes:
+            report.add([user_id], [], exception)
+            if exception is None:
+                added[user_id] = response
+        return self._bulk_result(report, added)
+
+    def get_many(self, user_ids, concurrency=4, retries=2):
+        user_ids = [user_id for user_id, _ in self._unique_users(user_ids)]
+        cached, missing, stale = self._split_cached(user_ids)
+        if stale:
+            self.client.entity_cache.refresh(
+                list(stale),
+                lambda keys: self._fetch_many(
+                    [stale[key] for key in keys], concurrency, retries
+                ),
+            )
+        fetched = self._fetch_many(missing, concurrency, retries)
+        users = {**cached, **fetched}
+        return {user_id: users[user_id] for user_id in user_ids if user_id in users}
+
+    def _fetch_many(self, user_ids, concurrency, retries):
+        def load(user_id):
+            started = time.monotonic()
+            user = call_with_retries(
+                lambda: self.client.get(
+                    f"{self.API_ENDPOINT}/{user_id}",
+                    service_name=self.SERVICE_NAME,
+                    signature=self.token,
+                ),
+                retries,
+            )
+            return user, time.monotonic() - started
+
+        return self._cache_fetched(map_concurrently(load, user_ids, concurrency))
+
+    def delete_many(self, user_ids, concurrency=4, retries=2):
+        def delete(user_id):
+            return call_with_retries(lambda: self.delete(user_id), retries)
+
+        report = BulkReport()
+        user_ids = (user_id for user_id, _ in self._unique_users(user_ids))
+        for user_id, _, exception in map_concurrently(delete, user_ids, concurrency):
+            report.add([user_id], [], exception)
+        return self._bulk_result(report)
 
 
 class AsyncUsers(BaseUsers):
     async def add(self, user_id, data=None, get_or_create=False):
         payload = dict(id=user_id, data=data)
-        return await self.client.post(
+        response = await self.client.post(
             self.API_ENDPOINT,
             service_name=self.SERVICE_NAME,
             signature=self.token,
             data=payload,
             params={"get_or_create": str(get_or_create)},
         )
+        self._cache_user(response)
+        return response
 
     async def get(self, user_id, **params):
-        return await self.client.get(
-            f"{self.API_ENDPOINT}/{user_id}",
-            service_name=self.SERVICE_NAME,
-            params=params,
-            signature=self.token,
-        )
+        def load():
+            return self.client.get(
+                f"{self.API_ENDPOINT}/{user_id}",
+                service_name=self.SERVICE_NAME,
+                params=params,
+                signature=self.token,
+            )
+
+        cache = self.client.entity_cache
+        # params such as with_follow_counts change the response
+        if cache is None or params:
+            return await load()
+        return await cache.async_fetch(cache.user_key(user_id), load)
 
     async def update(self, user_id, data=None):
         payload = dict(data=data)
-        return await self.client.put(
+        response = await self.client.put(
             f"{self.API_ENDPOINT}/{user_id}",
             service_name=self.SERVICE_NAME,
             signature=self.token,
             data=payload,
         )
+        self._cache_user(response)
+        return response
 
     async def delete(self, user_id):
-        return await self.client.delete(
+        response = await self.client.delete(
             f"{self.API_ENDPOINT}/{user_id}",
             service_name=self.SERVICE_NAME,
             signature=self.token,
         )
+        self._evict_user(user_id)
+        return response
+
+    async def add_many(self, users, get_or_create=False, concurrency=4, retries=2):
+        def add(user):
+            user_id, data = user
+            return async_call_with_retries(
+                lambda: self.add(user_id, data, get_or_create),
+                retries,
+                idempotent=get_or_create,
+            )
+
+        report = BulkReport()
+        added = {}
+        async with self.client.shared_session():
+            outcomes = async_map_concurrently(
+                add, self._unique_users(users), concurrency
+            )
+            async for (user_id, _), response, exception in outcomes:
+                report.add([user_id], [], exception)
+                if exception is None:
+                    added[user_id] = response
+        return self._bulk_result(report, added)
+
+    async def get_many(self, user_ids, concurrency=4, retries=2):
+        user_ids = [user_id for user_id, _ in self._unique_users(user_ids)]
+        cached, missing, stale = self._split_cached(user_ids)
+        if stale:
+            self.client.entity_cache.async_refresh(
+                list(stale),
+                lambda keys: self._fetch_many(
+                    [stale[key] for key in keys], concurrency, retries
+                ),
+            )
+        fetched = await self._fetch_many(missing, concurrency, retries)
+        users = {**cached, **fetched}
+        return {user_id: users[user_id] for user_id in user_ids if user_id in users}
+
+    async def _fetch_many(self, user_ids, concurrency, retries):
+        if not user_ids:
+            return {}
+
+        async def load(user_id):
+            started = time.monotonic()
+            user = await async_call_with_retries(
+                lambda: self.client.get(
+                    f"{self.API_ENDPOINT}/{user_id}",
+                    service_name=self.SERVICE_NAME,
+                    signature=self.token,
+                ),
+                retries,
+            )
+            return user, time.monotonic() - started
+
+        async with self.client.shared_session():
+            outcomes = [
+                outcome
+                async for outcome in async_map_concurrently(load, user_ids, concurrency)
+            ]
+        return self._cache_fetched(outcomes)
+
+    async def delete_many(self, user_ids, concurrency=4, retries=2):
+        def delete(user_id):
+            return async_call_with_retries(lambda: self.delete(user_id), retries)
+
+        report = BulkReport()
+        user_ids = (user_id for user_id, _ in self._unique_users(user_ids))
+        async with self.client.shared_session():
+            outcomes = async_map_concurrently(delete, user_ids, concurrency)
+            async for user_id, _, exception in outcomes:
+                report.add([user_id], [], exception)
+        return self._bulk_result(report)
@@ -1,4 +1,5 @@
 import re
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
 valid_re = re.compile(r"^[\w-]+$")
 
@@ -77,3 +78,60 @@ def get_reaction_params(reactions):
                 kinds = ",".join(k.strip() for k in kinds if k.strip())
             params["reactionKindsFilter"] = kinds
     return params
+
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def normalize_url(url):
+    """
+    Normalizes a url so that equivalent urls are equal
+
+    Lowercases the scheme and the host, drops the default port and the
+    fragment and sorts the query params
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or "").lower()
+    if parts.port is not None and parts.port != DEFAULT_PORTS.get(scheme):
+        netloc = f"{netloc}:{parts.port}"
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, netloc, parts.path or "/", query, ""))
+
+
+# the fields identifying an activity, a partial update can't change them
+ACTIVITY_KEY_FIELDS = ("id", "foreign_id", "time")
+
+
+def activity_diff(old, new, prefix=""):
+    """
+    Returns the set and unset operations of a partial update turning the
+    old activity into the new one
+
+    Nested dicts are compared field by field and produce dotted paths (eg.
+    'counts.likes'), other values are replaced as a whole. Keys containing
+    a dot can't be addressed, their parent is set instead.
+    """
+    skipped = ACTIVITY_KEY_FIELDS if not prefix else ()
+    set_fields = {}
+    unset_fields = []
+    for key, value in new.items():
+        if key in skipped:
+            continue
+        path = f"{prefix}{key}"
+        if key not in old:
+            set_fields[path] = value
+        elif isinstance(value, dict) and isinstance(old[key], dict):
+            nested_set, nested_unset = activity_diff(old[key], value, f"{path}.")
+            if any("." in str(k) for k in set(old[key]) | set(value)):
+                if nested_set or nested_unset:
+                    set_fields[path] = value
+            else:
+                set_fields.update(nested_set)
+                unset_fields.extend(nested_unset)
+        elif value != old[key]:
+            set_fields[path] = value
+    for key in old:
+        if key not in new and key not in skipped:
+            unset_fields.append(f"{prefix}{key}")
+    return set_fields, unset_fields